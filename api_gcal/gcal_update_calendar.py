@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 import sys, os
 
+# util_gcal and util_ical live in scripts/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
 from util_gcal import *
 from util_ical import *
 
@@ -28,7 +31,9 @@ to control what steps are being run.
 # https://developers.google.com/resources/api-libraries/documentation/calendar/v3/python/latest/
 
 
-FUTURE = '2018-11-01T00:00:00Z'
+# The sample .ics files are from 2018, so sync the
+# whole history of the calendar (no rolling window)
+WINDOW = None
 
 
 
@@ -37,11 +42,11 @@ def populate_calendar(ical_file):
     calendar_id = create_gcal("Another Test GCal Integration")
 
     # get all vevents
-    components_map = ics_components_map(get_ical_contents(ical_file))
+    components_map = ics_components_map(get_ical_contents(ical_file), {}, WINDOW)
     print("Preparing to add %d events to the calendar."%len(components_map.keys()))
 
     # add each event to google calendar
-    populate_gcal_from_components_map(calendar_id, components_map)
+    populate_gcal_from_components_map(calendar_id, components_map, window=WINDOW)
 
 
 def update_calendar(ical_file):
@@ -49,10 +54,10 @@ def update_calendar(ical_file):
     calendar_id = create_gcal("Another Test GCal Integration")
 
     # get all vevents
-    components_map = ics_components_map(get_ical_contents(ical_file))
+    components_map = ics_components_map(get_ical_contents(ical_file), {}, WINDOW)
 
     # add each event to google calendar
-    update_gcal_from_components_map(calendar_id, components_map)
+    update_gcal_from_components_map(calendar_id, components_map, window=WINDOW)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,278 @@
+import argparse
+import logging
+import os
+import random
+import time
+import util_gcal
+from util_ical import *
+from util_gcal import *
+from util_fakegcal import *
+
+
+"""
+Benchmark: Google Calendar Sync
+
+Run the sync against the fake Google Calendar API
+(see util_fakegcal.py, started in this process), time
+each step, count the requests it took, and check that
+the calendar ends up holding exactly the events of the
+.ics files.
+
+Steps:
+
+    create - create the calendar and add every event
+    no changes - sync again, nothing should be written
+    changes - remove some events and rename some others, then sync
+
+Example (the sample files, copied 20 times, with 50 ms of
+latency per request and 1% of rate limit errors):
+
+    python bench_gcal_sync.py -n 20 --latency=0.05 --quota-error-rate=0.01
+"""
+
+
+basename = os.path.split(os.path.abspath(__file__))[0]
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    ics_files = args.ics_files
+    if len(ics_files)==0:
+        ics_files = [os.path.join(basename,'..','samples','integrated_calendar.ics')]
+    components_map = {}
+    for ics_file in ics_files:
+        with open(ics_file,'r') as f:
+            ics = f.read()
+        try:
+            components_map = ics_components_map(ics, components_map)
+        except Exception as e:
+            print("Skipping %s, could not parse it: %s"%(os.path.basename(ics_file), e))
+    components_map = copy_events(components_map, args.copies)
+
+    server = start_fake_gcal_server(
+            port=0,
+            latency=args.latency,
+            op_latency=args.op_latency,
+            quota_error_rate=args.quota_error_rate,
+            failure_rate=args.failure_rate,
+            max_rate=args.max_rate,
+            seed=args.seed
+    )
+    set_api_endpoint(server.endpoint)
+    if args.api_rate is not None:
+        util_gcal.rate_limiter = AdaptiveRateLimiter(args.api_rate, API_BURST, max_rate=args.api_rate)
+    api = server.api
+
+    print("%d events, batches of %d, %d workers"%(len(components_map), args.batch_size, args.api_workers))
+    print("%-12s %10s %8s %8s %8s %8s %8s %8s"%(
+        "step","time (s)","http","ops","insert","patch","delete","errors"))
+
+    calendar_name = 'Benchmark %d'%(time.time())
+    calendar_id = None
+    try:
+        def create():
+            calendar_id = create_gcal(calendar_name)
+            plan = plan_gcal_update(calendar_id, components_map)
+            apply_gcal_plan(plan, args.batch_size, args.api_workers)
+            return calendar_id
+        calendar_id = run_step("create", api, create)
+        check_calendar(api, calendar_id, components_map)
+
+        def sync():
+            plan = plan_gcal_update(calendar_id, components_map)
+            apply_gcal_plan(plan, args.batch_size, args.api_workers)
+        run_step("no changes", api, sync)
+        check_calendar(api, calendar_id, components_map)
+
+        components_map = change_events(components_map, args.change, random.Random(args.seed))
+        run_step("changes", api, sync)
+        check_calendar(api, calendar_id, components_map)
+    finally:
+        if calendar_id is not None:
+            # Forget the local state of the calendar
+            state_db = open_state_db()
+            delete_fingerprints(state_db, calendar_id, list(load_fingerprints(state_db, calendar_id).keys()))
+            state_db.close()
+            clear_state('gcal_mirror', calendar_id)
+        clear_state('calendar_id', calendar_name)
+        server.shutdown()
+        set_api_endpoint(None)
+
+
+def run_step(name, api, step):
+    """
+    Run one step, and print how long it took
+    and how many requests it sent
+    """
+    before = api.get_counters()
+    start = time.time()
+    result = step()
+    elapsed = time.time() - start
+    after = api.get_counters()
+
+    def diff(k):
+        return after.get(k, 0) - before.get(k, 0)
+    print("%-12s %10.2f %8d %8d %8d %8d %8d %8d"%(
+        name,
+        elapsed,
+        diff('http_requests'),
+        diff('operations'),
+        diff('events.insert'),
+        diff('events.patch'),
+        diff('events.delete'),
+        diff('quota_errors') + diff('failures')
+    ))
+    return result
+
+
+def copy_events(components_map, copies):
+    """
+    Make copies of every event (with new ids),
+    for a bigger calendar
+    """
+    if copies<=1:
+        return components_map
+    copied = {}
+    for i in range(copies):
+        for e in components_map.values():
+            t = list(e.astuple())
+            t[0] = '%s-%d'%(e.uid, i)
+            t[1] = '%s%d'%(e.safe_id, i)
+            copied[t[1]] = IcsEvent(*t)
+    return copied
+
+
+def change_events(components_map, fraction, rand):
+    """
+    Remove a fraction of the events, and
+    change the title of another fraction
+    """
+    events = sorted(components_map.keys())
+    n = int(len(events)*fraction)
+    rand.shuffle(events)
+    changed = dict(components_map)
+    for eid in events[:n]:
+        del changed[eid]
+    for eid in events[n:2*n]:
+        t = list(changed[eid].astuple())
+        t[IcsEvent.__slots__.index('summary')] = '%s (changed)'%(t[IcsEvent.__slots__.index('summary')])
+        changed[eid] = IcsEvent(*t)
+    return changed
+
+
+def check_calendar(api, calendar_id, components_map):
+    """
+    Check that the fake calendar holds exactly
+    the events of components_map, with the
+    right titles and times
+    """
+    with api.lock:
+        gcal_events = dict((eid, e) for eid, (seq, e) in api.calendars[calendar_id]['events'].items()
+                if e['status']!='cancelled')
+    missing = set(components_map.keys()) - set(gcal_events.keys())
+    extra = set(gcal_events.keys()) - set(components_map.keys())
+    if len(missing)>0 or len(extra)>0:
+        print("WARNING: %d events missing from the calendar, %d extra events"%(len(missing), len(extra)))
+    n_wrong = 0
+    for eid in set(components_map.keys()) & set(gcal_events.keys()):
+        expected = ics2gcal_event(components_map[eid])
+        actual = gcal_events[eid]
+        if expected['summary']!=actual.get('summary') \
+                or fake_event_time(expected['start'])!=fake_event_time(actual['start']) \
+                or fake_event_time(expected['end'])!=fake_event_time(actual['end']):
+            n_wrong += 1
+    if n_wrong>0:
+        print("WARNING: %d events on the calendar do not match the .ics files"%(n_wrong))
+
+
+def parse_args():
+    """
+    Parse the user arguments
+    """
+    descr = "Time the Google Calendar sync against a fake Google Calendar API, "
+    descr += "and check the result. Uses samples/integrated_calendar.ics if no .ics files are given."
+
+    parser = argparse.ArgumentParser(description=descr)
+    parser.add_argument(
+            'ics_files',
+            nargs='*',
+            help='(OPTIONAL) .ics files with the events to sync'
+    )
+    parser.add_argument(
+            '-n', '--copies',
+            type=int,
+            default=1,
+            help='(OPTIONAL) Number of copies of each event, for a bigger calendar (1 by default)'
+    )
+    parser.add_argument(
+            '-c', '--change',
+            type=float,
+            default=0.1,
+            help='(OPTIONAL) Fraction of events to remove, and fraction to rename, in the changes step (0.1 by default)'
+    )
+    parser.add_argument(
+            '-b', '--batch-size',
+            type=int,
+            default=BATCH_SIZE,
+            help='(OPTIONAL) Number of requests in each batch request (%d by default)'%(BATCH_SIZE)
+    )
+    parser.add_argument(
+            '-a', '--api-workers',
+            type=int,
+            default=API_WORKERS,
+            help='(OPTIONAL) Number of batch requests to send at once (%d by default)'%(API_WORKERS)
+    )
+    parser.add_argument(
+            '-R', '--api-rate',
+            type=float,
+            default=None,
+            help='(OPTIONAL) Requests per second sent by the sync (the limits used with Google by default)'
+    )
+    parser.add_argument(
+            '-l', '--latency',
+            type=float,
+            default=0,
+            help='(OPTIONAL) Seconds added by the fake API to every HTTP request (0 by default)'
+    )
+    parser.add_argument(
+            '--op-latency',
+            type=float,
+            default=0,
+            help='(OPTIONAL) Seconds added by the fake API to every operation (0 by default)'
+    )
+    parser.add_argument(
+            '-q', '--quota-error-rate',
+            type=float,
+            default=0,
+            help='(OPTIONAL) Fraction of operations that fail with a rate limit error (0 by default)'
+    )
+    parser.add_argument(
+            '-e', '--failure-rate',
+            type=float,
+            default=0,
+            help='(OPTIONAL) Fraction of operations that fail with a server error (0 by default)'
+    )
+    parser.add_argument(
+            '-r', '--max-rate',
+            type=float,
+            default=None,
+            help='(OPTIONAL) Operations per second accepted by the fake API (no limit by default)'
+    )
+    parser.add_argument(
+            '--seed',
+            type=int,
+            default=1,
+            help='(OPTIONAL) Seed for the random errors and changes (1 by default)'
+    )
+    parser.add_argument(
+            '-v', '--verbose',
+            action='store_true',
+            help='(OPTIONAL) Log every request'
+    )
+    return parser.parse_args()
+
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,96 @@
+import argparse
+import glob
+import os
+import timeit
+from util_ical import *
+
+
+"""
+Benchmark: .ics Parsers
+
+Compare the fast Groups.io parser (fast_components_generator)
+with the icalendar parser (icalendar_components_generator)
+on the sample .ics files, and check that both parsers
+produce the same IcsEvent records.
+
+Example:
+
+    python bench_ics_parser.py -n 50 ../samples/*.ics
+"""
+
+
+basename = os.path.split(os.path.abspath(__file__))[0]
+
+
+def main():
+    args = parse_args()
+
+    ics_files = args.ics_files
+    if len(ics_files)==0:
+        ics_files = sorted(glob.glob(os.path.join(basename,'..','samples','*.ics')))
+
+    print("%-30s %8s %14s %14s %8s"%("file","events","icalendar (ms)","fast (ms)","speedup"))
+    for ics_file in ics_files:
+        with open(ics_file,'r') as f:
+            ics = f.read()
+
+        try:
+            slow_events = list(icalendar_components_generator(ics))
+        except Exception as e:
+            print("%-30s icalendar parser failed: %s"%(os.path.basename(ics_file), e))
+            continue
+
+        fast_events = list(fast_components_generator(ics))
+        check_same_events(ics_file, slow_events, fast_events)
+
+        slow = timeit.timeit(lambda: list(icalendar_components_generator(ics)), number=args.number)
+        fast = timeit.timeit(lambda: list(fast_components_generator(ics)), number=args.number)
+
+        print("%-30s %8d %14.2f %14.2f %7.1fx"%(
+            os.path.basename(ics_file),
+            len(fast_events),
+            1000.0*slow/args.number,
+            1000.0*fast/args.number,
+            slow/fast
+        ))
+
+
+def check_same_events(ics_file, slow_events, fast_events):
+    """
+    Check that both parsers produced the same IcsEvent records
+    """
+    if len(slow_events)!=len(fast_events):
+        print("WARNING: %s: icalendar found %d events, fast parser found %d"%(
+            ics_file, len(slow_events), len(fast_events)))
+        return
+    for slow, fast in zip(slow_events, fast_events):
+        if slow!=fast:
+            print("WARNING: %s: event %s differs"%(ics_file, fast.uid))
+            print("    icalendar: %r"%(slow))
+            print("    fast:      %r"%(fast))
+
+
+def parse_args():
+    """
+    Parse the user arguments
+    """
+    descr = "Benchmark the fast .ics parser against the icalendar parser. "
+    descr += "Uses the files in samples/ if no .ics files are given."
+
+    parser = argparse.ArgumentParser(description=descr)
+    parser.add_argument(
+            'ics_files',
+            nargs='*',
+            help='(OPTIONAL) .ics files to parse'
+    )
+    parser.add_argument(
+            '-n', '--number',
+            type=int,
+            default=20,
+            help='(OPTIONAL) Number of times to parse each file (20 by default)'
+    )
+    return parser.parse_args()
+
+
+if __name__=="__main__":
+    main()
@@ -3,8 +3,11 @@ import logging
 import argparse
 import os
 import sys
+import time
 from util_ical import *
 from util_gcal import *
+from util_daemon import *
+from util_webhook import *
 
 
 basename = os.path.split(os.path.abspath(__file__))[0]
@@ -43,6 +46,30 @@ Example of updating the existing calendar:
     python dcppc_calendar.py --update \
             --name="DCPPC Calendar" \
             --ical-list=ical_list.txt
+
+Example of planning an update without touching the
+calendar, then applying the plan later:
+
+    python dcppc_calendar.py --update \
+            --name="DCPPC Calendar" \
+            --ical-list=ical_list.txt \
+            --plan=plan.json
+
+    python dcppc_calendar.py --apply=plan.json
+
+Example of keeping the calendar in sync from a
+long-running process (stop it with SIGTERM):
+
+    python dcppc_calendar.py --update --daemon \
+            --name="DCPPC Calendar" \
+            --ical-list=ical_list.txt
+
+Example of trying a run against a local fake
+Google Calendar API (see fake_gcal_server.py):
+
+    python dcppc_calendar.py --create \
+            --ical-list=ical_list.txt \
+            --api-endpoint=http://127.0.0.1:8902/
 """
 
 class ValidationException(Exception):
@@ -51,7 +78,13 @@ class ValidationException(Exception):
 
 def main():
     args = parse_args()
-    if args.create:
+    if args.api_endpoint:
+        set_api_endpoint(args.api_endpoint)
+    if args.apply:
+        apply_plan(args)
+    elif args.daemon:
+        run_daemon(args)
+    elif args.create:
         create_calendar(args)
     else:
         update_calendar(args)
@@ -70,7 +103,7 @@ def parse_args():
     Parse the user arguments
     """
     descr = "This script creates/updates an integrated calendar of DCPPC events. "
-    descr += "Pass either the --create or --update flag. "
+    descr += "Pass either the --create or --update flag (or --apply a plan). "
     descr += "The --ical-list flag is required and should point to a file "
     descr += "with one .ics URL per line."
     descr += "The --name flag is optional."
@@ -88,24 +121,109 @@ def parse_args():
     )
     parser.add_argument(
             '-i', '--ical-list', 
-            required = True,
-            help='(REQUIRED) Name of a file containing a list of Groups.io .ics URLs, one per line'
+            help='(REQUIRED, except with --apply) Name of a file containing a list of Groups.io .ics URLs, one per line'
     )
     parser.add_argument(
             '-f', '--force-sync', 
             action='store_true',
             help='(OPTIONAL, use with -u) Force every event on the calendar to synchronize, regardless of whether there are changes.'
     )
+    parser.add_argument(
+            '-p', '--plan', 
+            default = None,
+            help='(OPTIONAL, use with -u) Do not change the calendar, instead write a plan of the changes (JSON) to this file'
+    )
+    parser.add_argument(
+            '--plan-timeout', 
+            type=int,
+            default = PLAN_TIMEOUT,
+            help='(OPTIONAL, use with -p) Give up if the plan is not done after this many seconds, fetching the feeds included (%d by default)'%(PLAN_TIMEOUT)
+    )
+    parser.add_argument(
+            '--apply', 
+            default = None,
+            metavar = 'PLAN',
+            help='(OPTIONAL) Apply the changes in a plan file written by --plan (instead of -c or -u)'
+    )
+    parser.add_argument(
+            '-D', '--daemon', 
+            action='store_true',
+            help='(OPTIONAL, use with -u) Keep running, polling the feeds and syncing the calendar until stopped with SIGTERM'
+    )
+    parser.add_argument(
+            '-t', '--interval', 
+            type=int,
+            default = DAEMON_INTERVAL,
+            help='(OPTIONAL, use with -D) Seconds between syncs, and between polls of feeds that do not set their own interval in the ical list (%d by default)'%(DAEMON_INTERVAL)
+    )
+    parser.add_argument(
+            '--webhook-port', 
+            type=int,
+            default = None,
+            help='(OPTIONAL, use with -D) Listen for notifications on this port (on %s), to sync right away when a feed or the calendar changes'%(WEBHOOK_HOST)
+    )
+    parser.add_argument(
+            '--webhook-url', 
+            default = None,
+            help='(OPTIONAL, use with --webhook-port) Public HTTPS address of the webhook server for Google Calendar push notifications'
+    )
+    parser.add_argument(
+            '-o', '--ics-output', 
+            default = None,
+            help='(OPTIONAL) Also write the integrated calendar to this .ics file (e.g. integrated_calendar.ics in the htdocs directory), along with per-subgroup .ics files and an event index next to it'
+    )
     parser.add_argument(
             '-n', '--name', 
             default = "DCPPC Calendar",
             help='(OPTIONAL) Name of the calendar ("DCPPC Calendar" by default)'
     )
+    parser.add_argument(
+            '-C', '--calendar-id', 
+            default = None,
+            help='(OPTIONAL) Id of an existing Google Calendar to use, instead of looking up the calendar by name'
+    )
+    parser.add_argument(
+            '--api-endpoint', 
+            default = None,
+            help='(OPTIONAL) Send Google Calendar API requests to this server (e.g. fake_gcal_server.py at http://127.0.0.1:8902/) instead of Google, without credentials'
+    )
+    parser.add_argument(
+            '-w', '--fetch-workers', 
+            type=int,
+            default = FETCH_WORKERS,
+            help='(OPTIONAL) Number of .ics feeds to download at once (%d by default)'%(FETCH_WORKERS)
+    )
+    parser.add_argument(
+            '-b', '--batch-size', 
+            type=int,
+            default = BATCH_SIZE,
+            help='(OPTIONAL) Number of Google Calendar API requests to send in each batch request (%d by default)'%(BATCH_SIZE)
+    )
+    parser.add_argument(
+            '-a', '--api-workers', 
+            type=int,
+            default = API_WORKERS,
+            help='(OPTIONAL) Number of batch requests to send to Google Calendar at once (%d by default)'%(API_WORKERS)
+    )
+    parser.add_argument(
+            '-P', '--past-days', 
+            type=int,
+            default = SYNC_PAST_DAYS,
+            help='(OPTIONAL) Only sync events that end less than this many days ago (%d by default)'%(SYNC_PAST_DAYS)
+    )
+    parser.add_argument(
+            '-F', '--future-days', 
+            type=int,
+            default = SYNC_FUTURE_DAYS,
+            help='(OPTIONAL) Only sync events that start less than this many days from now (%d by default)'%(SYNC_FUTURE_DAYS)
+    )
     args = parser.parse_args()
 
     validate(parser)
 
-    if args.create:
+    if args.apply:
+        logging.info("Applying plan %s"%args.apply)
+    elif args.create:
         logging.info("Creating calendar \"%s\""%args.name)
     elif args.update:
         logging.info("Updating calendar \"%s\""%args.name)
@@ -120,6 +238,17 @@ def validate(parser):
     Validate the input arguments provided by the user
     """
     args = parser.parse_args()
+    if args.apply:
+        if args.create or args.update or args.plan:
+            err = "ERROR: --apply can not be used with --create, --update or --plan.\n"
+            logging.error(err)
+            die(parser)
+        if not os.path.isfile(args.apply):
+            err = "ERROR: Could not find plan file at %s "%(args.apply)
+            logging.error(err)
+            raise ValidationException(err)
+        return
+
     if (args.create and args.update):
         err = "ERROR: both create and update arguments were specified."
         err += "You must specify one or the other.\n"
@@ -132,6 +261,37 @@ def validate(parser):
         logging.error(err)
         die(parser)
 
+    if args.past_days < 0 or args.future_days < 0:
+        err = "ERROR: --past-days and --future-days must not be negative.\n"
+        logging.error(err)
+        die(parser)
+
+    if args.plan and not args.update:
+        err = "ERROR: --plan only works with --update.\n"
+        logging.error(err)
+        die(parser)
+
+    if args.daemon and (not args.update or args.plan):
+        err = "ERROR: --daemon only works with --update (and not with --plan).\n"
+        logging.error(err)
+        die(parser)
+
+    if (args.webhook_port is not None and not args.daemon) \
+            or (args.webhook_url is not None and args.webhook_port is None):
+        err = "ERROR: --webhook-port only works with --daemon, and --webhook-url needs --webhook-port.\n"
+        logging.error(err)
+        die(parser)
+
+    if args.interval < DAEMON_MIN_INTERVAL:
+        err = "ERROR: --interval must be at least %d seconds.\n"%(DAEMON_MIN_INTERVAL)
+        logging.error(err)
+        die(parser)
+
+    if args.ical_list is None:
+        err = "ERROR: The --ical-list argument is required.\n"
+        logging.error(err)
+        die(parser)
+
     if args.create and args.force_sync:
         warning = "WARNING: Ignoring --force flag used with --create flag. "
         warning += "--force only works with --update."
@@ -154,49 +314,187 @@ def create_calendar(args):
     from the iCal feeds.
     """
     # create the calendar and return the calendar id
-    calendar_id = create_gcal(args.name)
+    calendar_id = get_calendar_id(args)
 
-    # get all icals
-    icals = []
-    with open(args.ical_list,'r') as f:
-        icals = f.readlines()
+    # only sync events in the rolling window
+    window = get_sync_window(args.past_days, args.future_days)
 
     # get all vevents
-    components_map = {}
-    for ical_url in icals:
-        contents = get_calendar_contents(ical_url)
-        components_map = ics_components_map(contents, components_map)
+    components_map, complete = get_components_map(args, window)
+
+    # publish the integrated .ics feed (keep the files
+    # as they are if some feeds are missing)
+    if args.ics_output:
+        if complete:
+            publish_calendar_files(components_map, args.ics_output)
+        else:
+            logging.warning("Some feeds are missing, not publishing %s this run"%(args.ics_output))
 
     logging.info("Preparing to add %d events to the calendar."%len(components_map.keys()))
 
     # add each event to google calendar
-    populate_gcal_from_components_map(calendar_id, components_map)
+    populate_gcal_from_components_map(calendar_id, components_map, args.batch_size, args.api_workers, window)
 
 
 def update_calendar(args):
     """
     Update the Google Calendar with events from the iCal feeds.
     """
+    # a plan has a time budget
+    deadline = None
+    if args.plan:
+        deadline = time.time() + args.plan_timeout
+        logging.info("Planning with a time budget of %d seconds (see --plan-timeout)"%(args.plan_timeout))
+
     # return the calendar id
-    calendar_id = create_gcal(args.name)
+    calendar_id = get_calendar_id(args)
+
+    # finish the changes of a run that died partway through
+    if not args.plan and resume_gcal_journal(calendar_id, args.batch_size, args.api_workers):
+        logging.info("Finished the unfinished changes, the calendar will be compared again on the next run.")
+        return
 
     # to force or not to force
     force_sync = args.force_sync
 
-    # get all icals
-    icals = []
-    with open(args.ical_list,'r') as f:
-        icals = f.readlines()
+    # only sync events in the rolling window
+    window = get_sync_window(args.past_days, args.future_days)
 
     # get all vevents
-    components_map = {}
-    for ical_url in icals:
-        components_map = ics_components_map(get_calendar_contents(ical_url), components_map)
+    components_map, complete = get_components_map(args, window)
+    check_deadline(deadline, "fetching the feeds")
+
+    # publish the integrated .ics feed (keep the files
+    # as they are if some feeds are missing, and never
+    # when only planning)
+    if args.ics_output and not args.plan:
+        if complete:
+            publish_calendar_files(components_map, args.ics_output)
+        else:
+            logging.warning("Some feeds are missing, not publishing %s this run"%(args.ics_output))
 
     logging.info("Preparing to update %d events on the calendar."%len(components_map.keys()))
 
-    # add each event to google calendar
-    update_gcal_from_components_map(calendar_id, components_map, force_sync)
+    # compute the changes (no writes yet), and do not
+    # remove events if a feed could not be fetched
+    plan = plan_gcal_update(calendar_id, components_map, force_sync, window, allow_remove=complete, deadline=deadline)
+
+    if args.plan:
+        # only save the changes, to apply later
+        save_plan(plan, args.plan)
+        return
+
+    # push the changes to google calendar
+    apply_gcal_plan(plan, args.batch_size, args.api_workers)
+
+
+def run_daemon(args):
+    """
+    Keep the Google Calendar in sync with the iCal feeds
+    from this process, until stopped with SIGTERM.
+    """
+    calendar_id = get_calendar_id(args)
+
+    daemon = SyncDaemon(calendar_id,
+            read_ical_list(args.ical_list),
+            sync_interval=args.interval,
+            past_days=args.past_days,
+            future_days=args.future_days,
+            fetch_workers=args.fetch_workers,
+            batch_size=args.batch_size,
+            api_workers=args.api_workers,
+            webhook_url=args.webhook_url,
+            ics_output=args.ics_output)
+    install_signal_handlers(daemon)
+
+    server = None
+    if args.webhook_port is not None:
+        server = start_webhook_server(daemon, args.webhook_port)
+    try:
+        daemon.run()
+    finally:
+        if server is not None:
+            server.shutdown()
+
+
+def apply_plan(args):
+    """
+    Apply the changes in a plan file written by --plan.
+    """
+    plan = load_plan(args.apply)
+
+    if args.calendar_id is not None and args.calendar_id!=plan['calendar_id']:
+        err = "ERROR: Plan %s is for calendar id %s, not %s"%(args.apply, plan['calendar_id'], args.calendar_id)
+        logging.error(err)
+        raise Exception(err)
+
+    logging.info("Plan made at %s: %d events to add, %d to remove, %d to update"%(
+        plan['created'], len(plan['add']), len(plan['remove']), len(plan['update'])))
+
+    apply_gcal_plan(plan, args.batch_size, args.api_workers)
+
+
+def get_calendar_id(args):
+    """
+    Return the id of the Google Calendar to use:
+    the one given with --calendar-id (after checking
+    that it exists), or the one named --name (which
+    is created if it does not exist yet, except with
+    --plan, which never changes anything).
+    """
+    if args.calendar_id is None:
+        if not args.plan:
+            return create_gcal(args.name)
+        calendar_id = get_named_calendar_id(args.name)
+        if calendar_id is None:
+            err = "ERROR: Could not find a calendar named \"%s\" to plan for. "%(args.name)
+            err += "Create it first with --create, or run --update without --plan."
+            logging.error(err)
+            raise Exception(err)
+        logging.info("Using calendar id %s"%(calendar_id))
+        return calendar_id
+
+    if not does_calendar_exist(args.calendar_id):
+        err = "ERROR: Could not find a calendar with calendar id %s"%(args.calendar_id)
+        logging.error(err)
+        raise Exception(err)
+    logging.info("Using calendar id %s"%(args.calendar_id))
+    return args.calendar_id
+
+
+def get_components_map(args, window=None):
+    """
+    Fetch every .ics feed in the ical list concurrently,
+    then merge their VEVENTs into a single components map.
+    Feeds are merged in the order they appear in the list,
+    so the result does not depend on which feed finished first.
+    Only events in the sync window are kept.
+
+    Returns a tuple (components_map, complete): complete
+    is False if a feed could not be fetched (and had no
+    last good copy) or could not be parsed, so its events
+    are missing.
+    """
+    # get all icals
+    icals = [url for url, interval in read_ical_list(args.ical_list)]
+
+    all_contents = get_all_calendar_contents(icals, max_workers=args.fetch_workers)
+
+    components_map = {}
+    n_failed = 0
+    for url, contents in zip(icals, all_contents):
+        events = parse_calendar_contents(url, contents)
+        if events is None:
+            n_failed += 1
+            continue
+        for e in events:
+            if in_sync_window(e.start, e.end, window):
+                components_map[e.safe_id] = e
+
+    if n_failed>0:
+        logging.warning("%d of %d feeds could not be fetched or parsed, no events will be removed this run"%(
+            n_failed, len(all_contents)))
+    return components_map, n_failed==0
 
 
 if __name__=="__main__":
@@ -0,0 +1,113 @@
+import argparse
+import logging
+import time
+from util_fakegcal import *
+
+
+logging.basicConfig(level=logging.INFO)
+
+
+"""
+Fake Google Calendar API Server
+
+Run a local stand-in for the Google Calendar API
+(see util_fakegcal.py), to test and time the sync
+without Google credentials. Stop it with Ctrl-C
+(the request counters are printed on the way out).
+
+Start the server, with 50 ms of latency per request
+and 1% of operations failing with rate limit errors:
+
+    python fake_gcal_server.py --latency=0.05 --quota-error-rate=0.01
+
+Then point dcppc_calendar.py at it:
+
+    python dcppc_calendar.py --create \
+            --ical-list=ical_list.txt \
+            --api-endpoint=http://127.0.0.1:8902/
+
+(or set GCAL_API_ENDPOINT=http://127.0.0.1:8902/)
+"""
+
+
+def main():
+    args = parse_args()
+    server = start_fake_gcal_server(
+            port=args.port,
+            host=args.host,
+            latency=args.latency,
+            op_latency=args.op_latency,
+            quota_error_rate=args.quota_error_rate,
+            failure_rate=args.failure_rate,
+            max_rate=args.max_rate,
+            seed=args.seed
+    )
+    print("Fake Google Calendar API listening on %s"%(server.endpoint))
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        pass
+    server.shutdown()
+    server.api.log_counters()
+
+
+def parse_args():
+    """
+    Parse the user arguments
+    """
+    descr = "Run a local fake Google Calendar API server (calendars and events are kept in memory)."
+
+    parser = argparse.ArgumentParser(description=descr)
+    parser.add_argument(
+            '--host',
+            default=FAKE_GCAL_HOST,
+            help='(OPTIONAL) Address to listen on (%s by default)'%(FAKE_GCAL_HOST)
+    )
+    parser.add_argument(
+            '-p', '--port',
+            type=int,
+            default=FAKE_GCAL_PORT,
+            help='(OPTIONAL) Port to listen on (%d by default)'%(FAKE_GCAL_PORT)
+    )
+    parser.add_argument(
+            '-l', '--latency',
+            type=float,
+            default=0,
+            help='(OPTIONAL) Seconds added to every HTTP request (0 by default)'
+    )
+    parser.add_argument(
+            '--op-latency',
+            type=float,
+            default=0,
+            help='(OPTIONAL) Seconds added to every operation, including each request in a batch (0 by default)'
+    )
+    parser.add_argument(
+            '-q', '--quota-error-rate',
+            type=float,
+            default=0,
+            help='(OPTIONAL) Fraction of operations that fail with a rate limit error, 403 or 429 (0 by default)'
+    )
+    parser.add_argument(
+            '-e', '--failure-rate',
+            type=float,
+            default=0,
+            help='(OPTIONAL) Fraction of operations that fail with a server error, 503 (0 by default)'
+    )
+    parser.add_argument(
+            '-r', '--max-rate',
+            type=float,
+            default=None,
+            help='(OPTIONAL) Operations per second, operations over this rate fail with a rate limit error (no limit by default)'
+    )
+    parser.add_argument(
+            '--seed',
+            type=int,
+            default=None,
+            help='(OPTIONAL) Seed for the random errors'
+    )
+    return parser.parse_args()
+
+
+if __name__=="__main__":
+    main()
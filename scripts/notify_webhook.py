@@ -0,0 +1,97 @@
+import argparse
+import requests
+from util_state import *
+from util_webhook import WEBHOOK_HOST, WEBHOOK_PORT
+
+
+"""
+Webhook Notifier
+
+A local stand-in for the notifications the webhook
+server of dcppc_calendar.py --daemon receives, for
+testing (or for scripts that know a feed changed).
+
+Send a Google Calendar push notification (uses the
+channel id and token the daemon stored; the daemon
+only accepts it if it opened a channel, i.e. if it
+was started with --webhook-url):
+
+    python notify_webhook.py --gcal --calendar-id=<calendar id>
+
+Tell the daemon the feed of a subgroup changed:
+
+    python notify_webhook.py --subgroup=main
+"""
+
+
+def main():
+    args = parse_args()
+    base_url = 'http://%s:%d'%(args.host, args.port)
+
+    if args.gcal:
+        headers = {
+            'X-Goog-Resource-State' : args.state,
+            'X-Goog-Resource-ID' : 'local',
+            'X-Goog-Message-Number' : '1',
+        }
+        channel = None
+        if args.calendar_id is not None:
+            channel = load_state('gcal_channel', args.calendar_id)
+        if channel is not None:
+            headers['X-Goog-Channel-ID'] = channel['id']
+            headers['X-Goog-Channel-Token'] = channel['token']
+        r = requests.post(base_url+'/gcal', headers=headers)
+        print("Google Calendar notification: %s"%(r.status_code))
+
+    if args.subgroup is not None:
+        r = requests.post(base_url+'/feed/'+args.subgroup)
+        print("Feed notification for subgroup %s: %s"%(args.subgroup, r.status_code))
+
+
+def parse_args():
+    """
+    Parse the user arguments
+    """
+    descr = "Send a notification to the webhook server of dcppc_calendar.py --daemon. "
+    descr += "Use --gcal, --subgroup, or both."
+
+    parser = argparse.ArgumentParser(description=descr)
+    parser.add_argument(
+            '-g', '--gcal',
+            action='store_true',
+            help='(OPTIONAL) Send a Google Calendar push notification'
+    )
+    parser.add_argument(
+            '-C', '--calendar-id',
+            default=None,
+            help='(OPTIONAL, use with -g) Calendar id, to send the id and token of the push channel the daemon opened'
+    )
+    parser.add_argument(
+            '--state',
+            default='exists',
+            help='(OPTIONAL, use with -g) Value of the X-Goog-Resource-State header ("exists" by default)'
+    )
+    parser.add_argument(
+            '-s', '--subgroup',
+            default=None,
+            help='(OPTIONAL) Name of the Groups.io subgroup whose feed changed'
+    )
+    parser.add_argument(
+            '--host',
+            default=WEBHOOK_HOST,
+            help='(OPTIONAL) Host of the webhook server (%s by default)'%(WEBHOOK_HOST)
+    )
+    parser.add_argument(
+            '-p', '--port',
+            type=int,
+            default=WEBHOOK_PORT,
+            help='(OPTIONAL) Port of the webhook server (%d by default)'%(WEBHOOK_PORT)
+    )
+    args = parser.parse_args()
+    if not args.gcal and args.subgroup is None:
+        parser.error("use --gcal, --subgroup, or both")
+    return args
+
+
+if __name__=="__main__":
+    main()
@@ -2,16 +2,27 @@
 #
 # Add this script to your crontab at whatever frequency
 # you'd like the calendars to be updated...
+#
+# (Or, instead of cron, run dcppc_calendar.py with --daemon,
+# e.g. using dcppc_calendar.service, to keep everything warm
+# between updates.)
 
 CALENDARS_DIR="/home/ubuntu/calendars"
+# Served by nginx (see nginx/calendars.conf)
+HTDOCS_DIR="/www/calendars.nihdatacommons.us/htdocs"
 
 cd $CALENDARS_DIR
-virtualenv vp
+# Only set up the virtualenv the first time,
+# and only reinstall when requirements change
+if [ ! -d vp ]; then
+    virtualenv vp
+fi
 source vp/bin/activate
-pip install -r requirements.txt
+if [ requirements.txt -nt vp/.requirements_installed ]; then
+    pip install -r requirements.txt && touch vp/.requirements_installed
+fi
 cd scripts/
-python dcppc_calendar.py -u -i ics_links.txt
+python dcppc_calendar.py -u -i ics_links.txt -o ${HTDOCS_DIR}/integrated_calendar.ics
 
 DONE="`date +%Y%m%d_%H%M%S`"
 touch /tmp/calendars/_calendars_done_${DONE}
-
@@ -0,0 +1,345 @@
+import logging
+import hashlib
+import re
+import signal
+import threading
+import time
+from collections import OrderedDict
+from util_ical import *
+from util_gcal import *
+
+
+"""
+Daemon Utilities
+
+
+Description:
+
+    This file contains the scheduler used by
+    dcppc_calendar.py --daemon to keep the Google
+    Calendar in sync from a single long-running
+    process, instead of starting a cold process
+    (and a virtualenv) from cron every hour.
+
+    Everything that is expensive to set up stays
+    warm between cycles: the Google API service and
+    credentials, the pooled HTTP session, the parsed
+    events of each feed and the mirror of the calendar.
+
+
+Classes:
+
+    SyncDaemon - polls each .ics feed on its own interval and
+        syncs the Google Calendar when a feed changed (or at
+        least once every sync interval, to catch changes made
+        on Google Calendar). stop() ends the loop after the
+        current cycle. request_sync() and request_feed() start
+        a cycle right away (used by the webhook server, see
+        util_webhook.py).
+
+
+Daemon Methods:
+
+    install_signal_handlers() - stop a SyncDaemon gracefully on
+        SIGTERM and SIGINT
+
+    get_feed_subgroup() - given the URL of a Groups.io .ics feed,
+        return the name of its subgroup
+
+
+Constants:
+
+    DAEMON_INTERVAL - default number of seconds between syncs
+        (and between polls of feeds without their own interval)
+
+    DAEMON_MIN_INTERVAL - never poll a feed more often than this (seconds)
+
+    DAEMON_DEBOUNCE - after a notification, wait this long (seconds) for
+        more notifications before starting a cycle
+
+    CHANNEL_RENEW_BEFORE - open a new push channel when the current one
+        expires in less than this (seconds)
+"""
+
+
+DAEMON_INTERVAL = 60*60
+DAEMON_MIN_INTERVAL = 60
+DAEMON_DEBOUNCE = 5
+CHANNEL_RENEW_BEFORE = 24*60*60
+
+
+
+class SyncDaemon(object):
+    """
+    Keep the Google Calendar with id calendar_id in sync
+    with a list of feeds (tuples (url, interval) as returned
+    by read_ical_list(); feeds without an interval are polled
+    every sync_interval seconds).
+
+    run() loops until stop() is called. Each cycle fetches
+    the feeds that are due, and syncs the calendar if any
+    feed changed or if the last sync is older than
+    sync_interval. A cycle that is running when stop()
+    is called is allowed to finish.
+
+    If ics_output is given, the integrated calendar (and
+    its subgroup shards and event index) is published
+    there before each sync.
+
+    If webhook_url is given, a push channel is opened on
+    the calendar (and renewed before it expires) so that
+    Google notifies the webhook server of every change.
+    """
+    def __init__(self, calendar_id, feeds,
+            sync_interval=DAEMON_INTERVAL,
+            past_days=SYNC_PAST_DAYS,
+            future_days=SYNC_FUTURE_DAYS,
+            fetch_workers=FETCH_WORKERS,
+            batch_size=BATCH_SIZE,
+            api_workers=API_WORKERS,
+            webhook_url=None,
+            ics_output=None):
+        self.calendar_id = calendar_id
+        self.sync_interval = sync_interval
+        self.past_days = past_days
+        self.future_days = future_days
+        self.fetch_workers = fetch_workers
+        self.batch_size = batch_size
+        self.api_workers = api_workers
+        self.webhook_url = webhook_url
+        self.ics_output = ics_output
+        self.channel = None
+        self.last_sync = None
+        self.sync_requested = False
+        self.stopping = threading.Event()
+        self.wakeup = threading.Event()
+
+        # Per-feed state, in the order of the ical list
+        self.feeds = OrderedDict()
+        for url, interval in feeds:
+            if interval is None:
+                interval = sync_interval
+            self.feeds[url] = {
+                'interval' : max(DAEMON_MIN_INTERVAL, interval),
+                'next_poll' : 0,
+                'last_poll' : 0,
+                'digest' : None,
+                'events' : None,
+            }
+
+    def run(self):
+        """
+        Poll and sync until stop() is called
+        """
+        logging.info("Daemon started: %d feeds, syncing calendar %s at least every %d seconds"%(
+            len(self.feeds), self.calendar_id, self.sync_interval))
+        while not self.stopping.is_set():
+            try:
+                self.renew_channel()
+            except Exception:
+                # Push notifications are only a shortcut,
+                # polling still picks up every change
+                logging.exception("Could not open a push channel, polling only")
+            try:
+                changed = self.poll_feeds()
+                if changed or self.sync_requested or self.sync_due():
+                    self.sync_requested = False
+                    self.sync()
+            except Exception:
+                # Keep going, and try again soon: the next sync
+                # starts from the journal and the mirror as they are
+                logging.exception("Sync cycle failed, trying again in %d seconds"%(DAEMON_MIN_INTERVAL))
+                self.last_sync = time.time() - self.sync_interval + DAEMON_MIN_INTERVAL
+            if self.wakeup.wait(self.seconds_to_next_cycle()):
+                # Woken up by a notification, wait
+                # a little for more before going on
+                self.stopping.wait(DAEMON_DEBOUNCE)
+                self.wakeup.clear()
+        self.close_channel()
+        logging.info("Daemon stopped")
+
+    def stop(self):
+        """
+        Stop the loop once the current cycle is done
+        """
+        self.stopping.set()
+        self.wakeup.set()
+
+    def request_sync(self):
+        """
+        Sync the calendar right away (e.g. because
+        Google says an event changed)
+        """
+        self.sync_requested = True
+        self.wakeup.set()
+
+    def request_feed(self, subgroup):
+        """
+        Fetch the feeds of a Groups.io subgroup right away
+        (and sync if they changed), but never sooner than
+        DAEMON_MIN_INTERVAL after the last fetch of each feed.
+        Returns the number of feeds of that subgroup.
+        """
+        urls = [url for url in self.feeds if get_feed_subgroup(url)==subgroup]
+        for url in urls:
+            feed = self.feeds[url]
+            feed['next_poll'] = min(feed['next_poll'], feed['last_poll'] + DAEMON_MIN_INTERVAL)
+        if len(urls)>0:
+            self.wakeup.set()
+        return len(urls)
+
+    def renew_channel(self):
+        """
+        Open a push channel on the calendar if there is
+        none, or if the current one expires soon
+        """
+        if self.webhook_url is None:
+            return
+        if self.channel is not None:
+            expiration = int(self.channel.get('expiration', 0))/1000.0
+            if expiration - time.time() > CHANNEL_RENEW_BEFORE:
+                return
+        old_channel = self.channel
+        self.channel = watch_gcal_events(self.calendar_id, self.webhook_url)
+        save_state('gcal_channel', self.calendar_id, self.channel)
+        if old_channel is not None:
+            stop_gcal_channel(old_channel)
+
+    def close_channel(self):
+        """
+        Close the push channel, if there is one
+        """
+        if self.channel is None:
+            return
+        try:
+            stop_gcal_channel(self.channel)
+        except Exception:
+            logging.exception("Could not close push channel %s"%(self.channel['id']))
+        self.channel = None
+        clear_state('gcal_channel', self.calendar_id)
+
+    def sync_due(self):
+        return self.last_sync is None or time.time()-self.last_sync >= self.sync_interval
+
+    def seconds_to_next_cycle(self):
+        """
+        Number of seconds until a feed is due
+        or the next sync is due
+        """
+        now = time.time()
+        next_cycle = min(f['next_poll'] for f in self.feeds.values()) if self.feeds else now
+        if self.last_sync is not None:
+            next_cycle = min(next_cycle, self.last_sync + self.sync_interval)
+        return max(1, next_cycle - now)
+
+    def poll_feeds(self):
+        """
+        Fetch the feeds that are due. Returns True if
+        the contents of any feed changed.
+
+        A feed that could not be fetched keeps the events
+        from its last successful fetch, so one failed
+        download does not remove its events from the calendar.
+        A feed that has never been fetched has no events
+        yet, and no events are removed until it has been
+        (see sync()). A feed that can not be parsed is
+        treated the same way as one that can not be
+        fetched, and the other feeds are still processed.
+        """
+        now = time.time()
+        due = [url for url, f in self.feeds.items() if f['next_poll'] <= now]
+        if len(due)==0:
+            return False
+
+        all_contents = get_all_calendar_contents(due, max_workers=self.fetch_workers)
+
+        changed = False
+        for url, contents in zip(due, all_contents):
+            feed = self.feeds[url]
+            feed['last_poll'] = now
+            feed['next_poll'] = now + feed['interval']
+            if contents is None:
+                continue
+            digest = hashlib.sha1(contents.encode('utf-8')).hexdigest()
+            if digest==feed['digest']:
+                continue
+            events = parse_calendar_contents(url, contents)
+            if events is None:
+                # Keep the events from the last good copy
+                continue
+            logging.info("Feed changed: %s"%(url))
+            feed['events'] = events
+            feed['digest'] = digest
+            changed = True
+        return changed
+
+    def components_map(self, window):
+        """
+        Merge the events of every feed (in order) into
+        a components map, keeping only events in the window
+        """
+        components_map = {}
+        for url, feed in self.feeds.items():
+            if feed['events'] is None:
+                logging.warning("Skipping a feed that could not be fetched or parsed: %s"%(url))
+                continue
+            for e in feed['events']:
+                if in_sync_window(e.start, e.end, window):
+                    components_map[e.safe_id] = e
+        return components_map
+
+    def sync(self):
+        """
+        Bring the Google Calendar up to date with the feeds.
+        Events are only removed (and the integrated calendar
+        is only published) once every feed has been fetched
+        at least once, so the events of a feed that is down
+        when the daemon starts are not deleted.
+
+        If a previous run died partway through, its journal
+        is finished first, then the calendar is compared
+        with the feeds in the same cycle (so feed changes
+        do not wait for the next sync interval).
+        """
+        start_time = time.time()
+        rate_limiter.reset_counters()
+        if resume_gcal_journal(self.calendar_id, self.batch_size, self.api_workers):
+            logging.info("Finished the unfinished changes, comparing the calendar again")
+        window = get_sync_window(self.past_days, self.future_days)
+        components_map = self.components_map(window)
+        all_loaded = all(f['events'] is not None for f in self.feeds.values())
+        if self.ics_output:
+            if all_loaded:
+                publish_calendar_files(components_map, self.ics_output)
+            else:
+                logging.warning("Some feeds have not been fetched yet, not publishing %s"%(self.ics_output))
+        plan = plan_gcal_update(self.calendar_id, components_map, False, window, allow_remove=all_loaded)
+        apply_gcal_plan(plan, self.batch_size, self.api_workers)
+        self.last_sync = time.time()
+        logging.info("Sync cycle done in %0.2f seconds"%(self.last_sync-start_time))
+
+
+
+def install_signal_handlers(daemon):
+    """
+    Stop the daemon gracefully (after the current
+    cycle) on SIGTERM and SIGINT
+    """
+    def handler(signum, frame):
+        logging.info("Got signal %d, stopping after the current cycle"%(signum))
+        daemon.stop()
+    signal.signal(signal.SIGTERM, handler)
+    signal.signal(signal.SIGINT, handler)
+
+
+
+def get_feed_subgroup(url):
+    """
+    Given the URL of a Groups.io .ics feed, e.g.
+    https://dcppc.groups.io/g/main/ics/2242649/1234987694/feed.ics
+    return the name of its subgroup (e.g. main), or None
+    """
+    m = re.search(r'/g/([^/]+)/ics/', url)
+    if m is None:
+        return None
+    return m.group(1)
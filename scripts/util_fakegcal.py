@@ -0,0 +1,826 @@
+import logging
+import json
+import random
+import threading
+import time
+import uuid
+import datetime
+import pytz
+from collections import OrderedDict
+from calendar import timegm
+from dateutil.parser import parse
+from email.parser import Parser
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs, unquote
+from urllib.request import Request, urlopen
+
+
+"""
+Fake Google Calendar API Utilities
+
+
+Description:
+
+    This file contains a local stand-in for the parts of
+    the Google Calendar API (v3) used by util_gcal.py, so
+    the sync code can be run (and timed) without Google
+    credentials and without touching a real calendar.
+
+    Calendars and events are kept in memory. The server
+    follows the behavior of the real API that the sync
+    code depends on:
+
+    - calendarList.list, calendars.insert/get/delete
+    - events.list (paging, timeMin/timeMax, showDeleted,
+        and incremental sync with syncToken: changed and
+        deleted events, 410 Gone once a token has expired)
+    - events.insert (409 for an id that was already used,
+        even by a deleted event), get, update, patch (objects
+        are merged, as in the real API) and delete (410 for
+        an event that was already deleted)
+    - etags on every event, and If-Match (412 if the event
+        changed since the etag was issued)
+    - batch requests (multipart/mixed, each sub-request is
+        an operation of its own, and can fail on its own)
+    - events.watch and channels.stop (notifications are
+        POSTed to the address of the channel, at most once
+        per FAKE_NOTIFY_DELAY seconds)
+
+    Partial responses (the fields parameter) are not
+    supported: full resources are always returned.
+
+    The server can slow down every HTTP request and every
+    operation, and can fail operations at random with rate
+    limit errors (403 rateLimitExceeded and 429) or server
+    errors (503 backendError), or with rate limit errors
+    whenever they come in faster than a given rate.
+
+    Point get_service() at the server with set_api_endpoint()
+    (or the GCAL_API_ENDPOINT environment variable), see
+    fake_gcal_server.py and bench_gcal_sync.py.
+
+
+Classes:
+
+    FakeCalendarApi - the calendars and events (in memory),
+        the API operations on them, and the error injection
+
+    FakeApiError - an API error (status, reason and message)
+
+    FakeGcalServer - threaded HTTP server
+
+    FakeGcalHandler - handles API and batch requests (one per request)
+
+
+Fake Server Methods:
+
+    start_fake_gcal_server() - start the fake server in a background
+        thread (port 0 picks a free port), returns the server (the API
+        root URL is server.endpoint, and the FakeCalendarApi is server.api)
+
+    fake_event_time() - convert the start/end of an event (JSON)
+        to UTC epoch seconds
+
+    fake_rfc3339() - convert epoch seconds to an RFC 3339 time
+
+
+Constants:
+
+    FAKE_GCAL_HOST - address the fake server listens on
+
+    FAKE_GCAL_PORT - default port the fake server listens on
+
+    SERVICE_PATH - path of the API (calendar/v3 in the discovery document)
+
+    BATCH_PATH - path of batch requests
+
+    BATCH_MAX_REQUESTS - max number of sub-requests in one batch request
+
+    FAKE_PAGE_SIZE - default number of events (and calendars) per page
+
+    FAKE_MAX_RESULTS - max number of events per page
+
+    FAKE_NOTIFY_DELAY - collect changes for this long (seconds) before
+        sending a push notification
+"""
+
+
+FAKE_GCAL_HOST = '127.0.0.1'
+FAKE_GCAL_PORT = 8902
+SERVICE_PATH = '/calendar/v3/'
+BATCH_PATH = '/batch/calendar/v3'
+BATCH_MAX_REQUESTS = 1000
+FAKE_PAGE_SIZE = 250
+FAKE_MAX_RESULTS = 2500
+FAKE_NOTIFY_DELAY = 1.0
+
+
+
+class FakeApiError(Exception):
+    """
+    An error returned by the fake API, with the
+    HTTP status and the reason (e.g. 'notFound')
+    """
+    def __init__(self, status, reason, message):
+        super(FakeApiError, self).__init__(message)
+        self.status = status
+        self.reason = reason
+        self.message = message
+
+
+
+class FakeCalendarApi(object):
+    """
+    In-memory calendars and events, and the Google
+    Calendar API operations on them.
+
+    call() runs one operation (method, path, query,
+    headers and body of an HTTP request) and batch()
+    runs a batch request. Both return a tuple (status,
+    headers, content) for the HTTP response.
+
+    Error injection:
+
+    latency - seconds added to every HTTP request
+    op_latency - seconds added to every operation
+        (so batch requests get slower with their size)
+    quota_error_rate - fraction of operations that fail
+        with a rate limit error (403 or 429)
+    failure_rate - fraction of operations that fail with
+        a server error (503)
+    max_rate - operations per second (None for no limit),
+        operations over the limit fail with 403
+        rateLimitExceeded
+    seed - seed of the random error injection
+
+    counters holds the number of HTTP requests, batch
+    requests, operations (one per sub-request), injected
+    errors and successful requests by API method (e.g.
+    events.insert).
+    """
+    def __init__(self, latency=0, op_latency=0,
+            quota_error_rate=0, failure_rate=0,
+            max_rate=None, seed=None):
+        self.latency = latency
+        self.op_latency = op_latency
+        self.quota_error_rate = quota_error_rate
+        self.failure_rate = failure_rate
+        self.max_rate = max_rate
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+
+        # Calendar id -> {'calendar' : JSON, 'events' : OrderedDict
+        # of event id -> (seq, event JSON), in the order they changed,
+        # 'min_sync_seq' : sync tokens older than this have expired}
+        self.calendars = OrderedDict()
+        self.channels = OrderedDict()
+        # Every change gets the next seq, used
+        # for etags, sync tokens and page tokens
+        self.seq = 0
+
+        self.tokens = max_rate
+        self.last = time.time()
+        self.counters = OrderedDict([
+            ('http_requests', 0),
+            ('batch_requests', 0),
+            ('operations', 0),
+            ('quota_errors', 0),
+            ('failures', 0),
+        ])
+        self.methods = {}
+
+    # ----------------------------
+    # Requests
+
+    def call(self, method, path, query, headers, body):
+        """
+        Run one API operation. Returns (status, headers, content).
+        """
+        if self.op_latency:
+            time.sleep(self.op_latency)
+        try:
+            with self.lock:
+                self.counters['operations'] += 1
+                self.inject_error()
+                if body:
+                    try:
+                        body = json.loads(body.decode('utf-8'))
+                    except ValueError:
+                        raise FakeApiError(400, 'parseError', 'Parse Error')
+                else:
+                    body = None
+                name, status, result = self.route(method, path, parse_qs(query), headers, body)
+                self.methods[name] = self.methods.get(name, 0) + 1
+        except FakeApiError as e:
+            return self.error_response(e)
+
+        response_headers = OrderedDict([('Content-Type', 'application/json; charset=UTF-8')])
+        if result is None:
+            return status, response_headers, b''
+        if 'etag' in result:
+            response_headers['ETag'] = result['etag']
+        return status, response_headers, json.dumps(result).encode('utf-8')
+
+    def batch(self, content_type, body):
+        """
+        Run a batch request (multipart/mixed, one application/http
+        part per sub-request). Returns (status, headers, content).
+        """
+        with self.lock:
+            self.counters['batch_requests'] += 1
+        message = Parser().parsestr('Content-Type: %s\r\n\r\n'%(content_type) + body.decode('utf-8'))
+        if not message.is_multipart():
+            return self.error_response(FakeApiError(400, 'badRequest', 'Batch request is not multipart/mixed'))
+        parts = message.get_payload()
+        if len(parts)>BATCH_MAX_REQUESTS:
+            return self.error_response(FakeApiError(400, 'badRequest',
+                'A batch request can not hold more than %d requests'%(BATCH_MAX_REQUESTS)))
+
+        boundary = 'batch_%s'%(uuid.uuid4().hex)
+        lines = []
+        for part in parts:
+            status, headers, content = self.call_http(part.get_payload())
+            lines.append('--'+boundary)
+            lines.append('Content-Type: application/http')
+            content_id = ' '.join((part.get('Content-ID') or '').split())
+            if content_id:
+                lines.append('Content-ID: <response-%s>'%(content_id[1:-1]))
+            lines.append('')
+            lines.append('HTTP/1.1 %d %s'%(status, HTTPStatus(status).phrase))
+            for k, v in headers.items():
+                lines.append('%s: %s'%(k, v))
+            lines.append('Content-Length: %d'%(len(content)))
+            lines.append('')
+            lines.append(content.decode('utf-8'))
+        lines.append('--'+boundary+'--')
+        lines.append('')
+
+        headers = {'Content-Type' : 'multipart/mixed; boundary=%s'%(boundary)}
+        return 200, headers, '\r\n'.join(lines).encode('utf-8')
+
+    def call_http(self, request):
+        """
+        Run one sub-request of a batch request (a string
+        holding an HTTP request: request line, headers, body)
+        """
+        request_line, rest = request.split('\n', 1)
+        method, uri = request_line.split()[:2]
+        message = Parser().parsestr(rest)
+        url = urlparse(uri)
+        return self.call(method, url.path, url.query, message,
+                (message.get_payload() or '').encode('utf-8'))
+
+    def route(self, method, path, query, headers, body):
+        """
+        Find the operation for this method and path, and run it.
+        Returns (name of the API method, status, result JSON or None).
+        """
+        if not path.startswith(SERVICE_PATH):
+            raise FakeApiError(404, 'notFound', 'Not Found')
+        parts = [unquote(p) for p in path[len(SERVICE_PATH):].strip('/').split('/')]
+        n = len(parts)
+
+        if parts==['users', 'me', 'calendarList'] and method=='GET':
+            return 'calendarList.list', 200, self.list_calendars(query)
+        if parts==['channels', 'stop'] and method=='POST':
+            return 'channels.stop', 204, self.stop_channel(body)
+
+        if parts[0]=='calendars':
+            if n==1 and method=='POST':
+                return 'calendars.insert', 200, self.insert_calendar(body)
+            if n==2 and method=='GET':
+                return 'calendars.get', 200, self.get_calendar(parts[1])
+            if n==2 and method=='DELETE':
+                return 'calendars.delete', 204, self.delete_calendar(parts[1])
+            if n==3 and parts[2]=='events' and method=='GET':
+                return 'events.list', 200, self.list_events(parts[1], query)
+            if n==3 and parts[2]=='events' and method=='POST':
+                return 'events.insert', 200, self.insert_event(parts[1], body)
+            if n==4 and parts[2]=='events' and parts[3]=='watch' and method=='POST':
+                return 'events.watch', 200, self.watch_events(parts[1], body)
+            if n==4 and parts[2]=='events':
+                if method=='GET':
+                    return 'events.get', 200, self.get_event(parts[1], parts[3])
+                if method=='PUT':
+                    return 'events.update', 200, self.update_event(parts[1], parts[3], headers, body)
+                if method=='PATCH':
+                    return 'events.patch', 200, self.patch_event(parts[1], parts[3], headers, body)
+                if method=='DELETE':
+                    return 'events.delete', 204, self.delete_event(parts[1], parts[3], headers)
+
+        raise FakeApiError(404, 'notFound', 'Not Found')
+
+    # ----------------------------
+    # Calendars
+
+    def list_calendars(self, query):
+        max_results = int(get_query(query, 'maxResults', 100))
+        offset = int(get_query(query, 'pageToken', 0))
+        entries = list(self.calendars.values())[offset:offset+max_results]
+        result = {
+            'kind' : 'calendar#calendarList',
+            'etag' : '"%d"'%(self.seq),
+            'items' : [dict(c['calendar'], kind='calendar#calendarListEntry', accessRole='owner')
+                for c in entries],
+        }
+        if offset+max_results < len(self.calendars):
+            result['nextPageToken'] = str(offset+max_results)
+        return result
+
+    def insert_calendar(self, body):
+        if not body or not body.get('summary'):
+            raise FakeApiError(400, 'required', 'Missing title.')
+        calendar_id = '%s@group.calendar.google.com'%(uuid.uuid4().hex)
+        calendar = {
+            'kind' : 'calendar#calendar',
+            'etag' : '"%d"'%(self.next_seq()),
+            'id' : calendar_id,
+            'summary' : body['summary'],
+            'timeZone' : body.get('timeZone', 'UTC'),
+        }
+        self.calendars[calendar_id] = {
+            'calendar' : calendar,
+            'events' : OrderedDict(),
+            'min_sync_seq' : 0,
+        }
+        return calendar
+
+    def get_calendar(self, calendar_id):
+        return self.get_calendar_entry(calendar_id)['calendar']
+
+    def delete_calendar(self, calendar_id):
+        self.get_calendar_entry(calendar_id)
+        del self.calendars[calendar_id]
+        return None
+
+    def get_calendar_entry(self, calendar_id):
+        entry = self.calendars.get(calendar_id)
+        if entry is None:
+            raise FakeApiError(404, 'notFound', 'Not Found')
+        return entry
+
+    # ----------------------------
+    # Events
+
+    def list_events(self, calendar_id, query):
+        """
+        List the events on a calendar, in the order they
+        last changed. Without a sync token, deleted events
+        are only listed with showDeleted=true. With a sync
+        token, every event changed since the token was
+        issued is listed (deleted events too).
+
+        A page token holds the seq of the last event listed
+        and the seq at the start of the listing. Events that
+        change during the listing are left out, they are
+        listed with the nextSyncToken.
+        """
+        entry = self.get_calendar_entry(calendar_id)
+        max_results = max(1, min(FAKE_MAX_RESULTS, int(get_query(query, 'maxResults', FAKE_PAGE_SIZE))))
+        sync_token = get_query(query, 'syncToken')
+        page_token = get_query(query, 'pageToken')
+        time_min = get_query(query, 'timeMin')
+        time_max = get_query(query, 'timeMax')
+        show_deleted = get_query(query, 'showDeleted')=='true'
+
+        if sync_token is not None:
+            if time_min is not None or time_max is not None:
+                raise FakeApiError(400, 'invalid', 'Sync token can not be used with timeMin or timeMax.')
+            since = parse_token(sync_token, 'sync')
+            if since < entry['min_sync_seq']:
+                raise FakeApiError(410, 'fullSyncRequired',
+                        'Sync token is no longer valid, a full sync is required.')
+            show_deleted = True
+        else:
+            since = 0
+
+        if page_token is not None:
+            after, list_seq = [int(x) for x in parse_token(page_token, 'page', 2)]
+        else:
+            after, list_seq = since, self.seq
+
+        if time_min is not None:
+            time_min = fake_event_time({'dateTime' : time_min})
+        if time_max is not None:
+            time_max = fake_event_time({'dateTime' : time_max})
+
+        # Events are stored in the order they changed (see save_event()),
+        # so a page ends at the seq of its last event
+        items = []
+        next_page_token = None
+        last_seq = after
+        for seq, event in entry['events'].values():
+            if seq <= after or seq > list_seq:
+                continue
+            if event['status']=='cancelled' and not show_deleted:
+                continue
+            if time_min is not None and fake_event_time(event['end']) <= time_min:
+                continue
+            if time_max is not None and fake_event_time(event['start']) >= time_max:
+                continue
+            if len(items)==max_results:
+                next_page_token = 'page-%d-%d'%(last_seq, list_seq)
+                break
+            items.append(event)
+            last_seq = seq
+
+        result = {
+            'kind' : 'calendar#events',
+            'etag' : '"%d"'%(list_seq),
+            'summary' : entry['calendar']['summary'],
+            'timeZone' : entry['calendar']['timeZone'],
+            'accessRole' : 'owner',
+            'items' : items,
+        }
+        if next_page_token is not None:
+            result['nextPageToken'] = next_page_token
+        else:
+            result['nextSyncToken'] = 'sync-%d'%(list_seq)
+        return result
+
+    def insert_event(self, calendar_id, body):
+        entry = self.get_calendar_entry(calendar_id)
+        event = dict(body or {})
+        event_id = event.get('id') or uuid.uuid4().hex
+        if event_id in entry['events']:
+            # Ids of deleted events can not be used again
+            raise FakeApiError(409, 'duplicate', 'The requested identifier already exists.')
+        now = fake_rfc3339(time.time())
+        event.update({
+            'kind' : 'calendar#event',
+            'id' : event_id,
+            'status' : event.get('status', 'confirmed'),
+            'created' : now,
+            'iCalUID' : event.get('iCalUID', '%s@google.com'%(event_id)),
+            'sequence' : event.get('sequence', 0),
+        })
+        return self.save_event(calendar_id, entry, event)
+
+    def get_event(self, calendar_id, event_id):
+        entry = self.get_calendar_entry(calendar_id)
+        return self.get_event_entry(entry, event_id)
+
+    def update_event(self, calendar_id, event_id, headers, body):
+        entry = self.get_calendar_entry(calendar_id)
+        old_event = self.get_event_entry(entry, event_id)
+        self.check_etag(headers, old_event)
+        event = dict(body or {})
+        for k in ['kind', 'id', 'created', 'iCalUID']:
+            event[k] = old_event[k]
+        event['status'] = event.get('status', 'confirmed')
+        return self.save_event(calendar_id, entry, event)
+
+    def patch_event(self, calendar_id, event_id, headers, body):
+        entry = self.get_calendar_entry(calendar_id)
+        old_event = self.get_event_entry(entry, event_id)
+        self.check_etag(headers, old_event)
+        event = merge_patch(old_event, body or {})
+        for k in ['kind', 'id', 'created', 'iCalUID']:
+            event[k] = old_event[k]
+        return self.save_event(calendar_id, entry, event)
+
+    def delete_event(self, calendar_id, event_id, headers):
+        entry = self.get_calendar_entry(calendar_id)
+        old_event = self.get_event_entry(entry, event_id)
+        if old_event['status']=='cancelled':
+            raise FakeApiError(410, 'deleted', 'Resource has been deleted')
+        self.check_etag(headers, old_event)
+        self.save_event(calendar_id, entry, dict(old_event, status='cancelled'))
+        return None
+
+    def get_event_entry(self, entry, event_id):
+        if event_id not in entry['events']:
+            raise FakeApiError(404, 'notFound', 'Not Found')
+        seq, event = entry['events'][event_id]
+        return event
+
+    def check_etag(self, headers, event):
+        etag = headers.get('If-Match')
+        if etag is not None and etag!='*' and etag!=event['etag']:
+            raise FakeApiError(412, 'conditionNotMet', 'Precondition Failed')
+
+    def save_event(self, calendar_id, entry, event):
+        """
+        Check the times of an event, give it a new etag,
+        and store it (last, as the most recently changed)
+        """
+        if event['status']!='cancelled':
+            for k in ['start', 'end']:
+                if k not in event:
+                    raise FakeApiError(400, 'required', 'Missing %s time.'%(k))
+                if fake_event_time(event[k]) is None:
+                    raise FakeApiError(400, 'invalid', 'Invalid %s time.'%(k))
+            if fake_event_time(event['end']) < fake_event_time(event['start']):
+                raise FakeApiError(400, 'timeRangeEmpty', 'The specified time range is empty.')
+
+        seq = self.next_seq()
+        event['etag'] = '"%d"'%(seq)
+        event['updated'] = fake_rfc3339(time.time())
+        entry['events'].pop(event['id'], None)
+        entry['events'][event['id']] = (seq, event)
+        self.changed(calendar_id)
+        return event
+
+    def expire_sync_tokens(self, calendar_id):
+        """
+        Expire every sync token issued so far for a
+        calendar (the next incremental sync gets 410 Gone)
+        """
+        with self.lock:
+            entry = self.get_calendar_entry(calendar_id)
+            entry['min_sync_seq'] = self.next_seq()
+
+    def next_seq(self):
+        self.seq += 1
+        return self.seq
+
+    # ----------------------------
+    # Push channels
+
+    def watch_events(self, calendar_id, body):
+        self.get_calendar_entry(calendar_id)
+        if not body or not body.get('id') or not body.get('address'):
+            raise FakeApiError(400, 'required', 'Missing channel id or address.')
+        if body['id'] in self.channels:
+            raise FakeApiError(400, 'channelIdNotUnique', 'Channel id not unique.')
+        ttl = int((body.get('params') or {}).get('ttl', 7*24*60*60))
+        channel = {
+            'kind' : 'api#channel',
+            'id' : body['id'],
+            'resourceId' : uuid.uuid4().hex,
+            'resourceUri' : 'https://www.googleapis.com/calendar/v3/calendars/%s/events'%(calendar_id),
+            'token' : body.get('token'),
+            'expiration' : str(int((time.time()+ttl)*1000)),
+        }
+        self.channels[channel['id']] = dict(channel,
+                calendar_id=calendar_id,
+                address=body['address'],
+                message_number=0,
+                timer=None)
+        self.notify(channel['id'], 'sync')
+        return channel
+
+    def stop_channel(self, body):
+        channel = self.channels.get((body or {}).get('id'))
+        if channel is None or channel['resourceId']!=body.get('resourceId'):
+            raise FakeApiError(404, 'notFound', 'Channel not found')
+        if channel['timer'] is not None:
+            channel['timer'].cancel()
+        del self.channels[channel['id']]
+        return None
+
+    def changed(self, calendar_id):
+        """
+        An event on the calendar changed: notify every
+        channel on the calendar, once the changes made in
+        the next FAKE_NOTIFY_DELAY seconds are in
+        """
+        for channel_id, channel in self.channels.items():
+            if channel['calendar_id']==calendar_id and channel['timer'] is None:
+                channel['timer'] = threading.Timer(FAKE_NOTIFY_DELAY, self.notify, (channel_id, 'exists'))
+                channel['timer'].daemon = True
+                channel['timer'].start()
+
+    def notify(self, channel_id, state):
+        """
+        POST a push notification to the address of a channel
+        (in a background thread)
+        """
+        with self.lock:
+            channel = self.channels.get(channel_id)
+            if channel is None:
+                return
+            channel['timer'] = None
+            headers = {
+                'X-Goog-Channel-ID' : channel['id'],
+                'X-Goog-Channel-Expiration' : channel['expiration'],
+                'X-Goog-Resource-ID' : channel['resourceId'],
+                'X-Goog-Resource-URI' : channel['resourceUri'],
+                'X-Goog-Resource-State' : state,
+                'X-Goog-Message-Number' : str(channel['message_number']),
+            }
+            if channel['token']:
+                headers['X-Goog-Channel-Token'] = channel['token']
+            channel['message_number'] += 1
+            address = channel['address']
+
+        def send():
+            try:
+                urlopen(Request(address, data=b'', headers=headers), timeout=10).close()
+            except Exception as e:
+                logging.warning("Fake API: could not notify %s: %s"%(address, e))
+        thread = threading.Thread(target=send, name='fake-gcal-notify')
+        thread.daemon = True
+        thread.start()
+
+    # ----------------------------
+    # Errors
+
+    def inject_error(self):
+        """
+        Fail this operation with a rate limit error if it
+        is over max_rate, or at random (quota_error_rate
+        and failure_rate)
+        """
+        if self.max_rate is not None:
+            now = time.time()
+            self.tokens = min(self.max_rate, self.tokens + (now-self.last)*self.max_rate)
+            self.last = now
+            if self.tokens < 1:
+                self.counters['quota_errors'] += 1
+                raise FakeApiError(403, 'rateLimitExceeded', 'Rate Limit Exceeded')
+            self.tokens -= 1
+
+        r = self.random.random()
+        if r < self.quota_error_rate:
+            self.counters['quota_errors'] += 1
+            raise FakeApiError(self.random.choice([403, 429]), 'rateLimitExceeded', 'Rate Limit Exceeded')
+        if r < self.quota_error_rate + self.failure_rate:
+            self.counters['failures'] += 1
+            raise FakeApiError(503, 'backendError', 'Backend Error')
+
+    def error_response(self, e):
+        """
+        The HTTP response for a FakeApiError, with the
+        JSON error body Google sends
+        """
+        domain = 'usageLimits' if e.reason=='rateLimitExceeded' else 'global'
+        body = {
+            'error' : {
+                'errors' : [{'domain' : domain, 'reason' : e.reason, 'message' : e.message}],
+                'code' : e.status,
+                'message' : e.message,
+            }
+        }
+        headers = OrderedDict([('Content-Type', 'application/json; charset=UTF-8')])
+        return e.status, headers, json.dumps(body).encode('utf-8')
+
+    # ----------------------------
+    # Counters
+
+    def count_http_request(self):
+        with self.lock:
+            self.counters['http_requests'] += 1
+
+    def get_counters(self):
+        """
+        Return a copy of the counters, with the
+        number of requests for each API method
+        """
+        with self.lock:
+            counters = OrderedDict(self.counters)
+            for name in sorted(self.methods):
+                counters[name] = self.methods[name]
+            return counters
+
+    def log_counters(self):
+        logging.info("Fake API: %s"%(", ".join("%s %d"%(k, v) for k, v in self.get_counters().items())))
+
+
+
+class FakeGcalServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+
+class FakeGcalHandler(BaseHTTPRequestHandler):
+    """
+    Handle one HTTP request to the fake API.
+    The FakeCalendarApi is self.server.api.
+    """
+    # Keep connections open, like Google does
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.handle_api('GET')
+
+    def do_POST(self):
+        self.handle_api('POST')
+
+    def do_PUT(self):
+        self.handle_api('PUT')
+
+    def do_PATCH(self):
+        self.handle_api('PATCH')
+
+    def do_DELETE(self):
+        self.handle_api('DELETE')
+
+    def handle_api(self, method):
+        api = self.server.api
+        api.count_http_request()
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length>0 else b''
+        if api.latency:
+            time.sleep(api.latency)
+
+        url = urlparse(self.path)
+        if url.path==BATCH_PATH and method=='POST':
+            status, headers, content = api.batch(self.headers.get('Content-Type', ''), body)
+        else:
+            status, headers, content = api.call(method, url.path, url.query, self.headers, body)
+
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        logging.debug("Fake API: "+format%args)
+
+
+
+def start_fake_gcal_server(port=FAKE_GCAL_PORT, host=FAKE_GCAL_HOST, **options):
+    """
+    Start the fake API server on host:port in a background
+    thread (port 0 picks a free port). options are passed
+    to FakeCalendarApi (latency, error rates, ...).
+
+    Returns the server (call shutdown() to stop it).
+    The root URL to pass to set_api_endpoint() is
+    server.endpoint, and the FakeCalendarApi (with
+    the calendars, events and counters) is server.api.
+    """
+    server = FakeGcalServer((host, port), FakeGcalHandler)
+    server.api = FakeCalendarApi(**options)
+    server.endpoint = 'http://%s:%d/'%(host, server.server_address[1])
+    thread = threading.Thread(target=server.serve_forever, name='fake-gcal')
+    thread.daemon = True
+    thread.start()
+    logging.info("Fake Google Calendar API listening on %s"%(server.endpoint))
+    return server
+
+
+
+def get_query(query, name, default=None):
+    """
+    Get one parameter from a query parsed by parse_qs()
+    """
+    values = query.get(name)
+    if not values:
+        return default
+    return values[0]
+
+
+
+def parse_token(token, kind, n=1):
+    """
+    Parse a page token (page-<seq>-<seq>) or
+    a sync token (sync-<seq>) issued by list_events()
+    """
+    try:
+        prefix, rest = token.split('-', 1)
+        values = [int(x) for x in rest.split('-')]
+        if prefix!=kind or len(values)!=n:
+            raise ValueError(token)
+    except ValueError:
+        raise FakeApiError(400, 'invalid', 'Invalid %s token.'%(kind))
+    return values[0] if n==1 else values
+
+
+
+def merge_patch(old, patch):
+    """
+    Apply a patch to a resource the way the API does:
+    objects are merged (recursively), anything else
+    (including lists) is replaced
+    """
+    merged = dict(old)
+    for k, v in patch.items():
+        if isinstance(v, dict) and isinstance(merged.get(k), dict):
+            merged[k] = merge_patch(merged[k], v)
+        else:
+            merged[k] = v
+    return merged
+
+
+
+def fake_event_time(event_time):
+    """
+    Convert the start/end of an event ({'dateTime' : ...,
+    'timeZone' : ...} or {'date' : ...}) to UTC epoch
+    seconds, or None if it can not be parsed
+    """
+    try:
+        if event_time.get('dateTime'):
+            d = parse(event_time['dateTime'])
+            if d.tzinfo is None:
+                d = pytz.timezone(event_time.get('timeZone') or 'UTC').localize(d)
+            return timegm(d.utctimetuple())
+        if event_time.get('date'):
+            return timegm(parse(event_time['date']).timetuple())
+    except (ValueError, OverflowError, pytz.UnknownTimeZoneError):
+        pass
+    return None
+
+
+
+def fake_rfc3339(epoch):
+    """
+    Convert epoch seconds to an RFC 3339 time in UTC
+    """
+    return datetime.datetime.fromtimestamp(epoch, pytz.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z')
@@ -1,18 +1,27 @@
 import logging
 import apiclient
-from apiclient.discovery import build
+from apiclient.discovery import build_from_document
 from httplib2 import Http
 from oauth2client import file, client, tools
 
 from dateutil.parser import parse
 from collections import OrderedDict
 from util_ical import *
+from util_state import *
+from util_ratelimit import *
 
 import traceback
-from pprint import pprint
-import sys, os, re
+import os
 import datetime
+import random
+import time
+import json
+import hashlib
+import threading
+import uuid
 import pytz
+from concurrent.futures import ThreadPoolExecutor
+from calendar import timegm
 
 
 """
@@ -28,15 +37,40 @@ Description:
 Utility Methods:
 
     get_named_calendar_id() - return the calendar id for the
-        calendar with the given name
+        calendar with the given name (cached locally, and checked
+        with a single calendars.get request)
+
+    get_calendar() - given a calendar id, get the calendar (JSON),
+        or None if it does not exist
 
     does_calendar_exist() - given a calendar id, check if that
         calendar actually exists
 
     does_event_exist() - given a calendar id and an event id, check
-        if the event exists
+        if the event exists and was not deleted (using the in-memory
+        index of events seen during this run, or a single events.get)
+
+    index_gcal_events() - add event ids to the in-memory index of events
+
+    unindex_gcal_events() - remove event ids from the in-memory index of events
 
     get_service() - get a Google Calendar API service object
+        (cached per thread, built from a cached discovery document)
+
+    save_calendar_id() - store the calendar id of a named calendar locally
+
+    get_credentials() - get the OAuth credentials (cached per process)
+
+    get_discovery_document() - get the Google Calendar API discovery
+        document (cached on disk)
+
+    clear_service_cache() - forget cached credentials and service objects
+
+    set_api_endpoint() - send API requests to another server (e.g. the
+        fake server in util_fakegcal.py) instead of Google
+
+    get_endpoint_discovery_document() - get the discovery document, with
+        its URLs pointing to the API endpoint set by set_api_endpoint()
 
 
 Update Methods:
@@ -44,20 +78,67 @@ Update Methods:
     update_gcal_from_components_map() - given a map of iCalendar 
         events, use them to update the events on a Google Calendar.
 
+    plan_gcal_update() - given a map of iCalendar events, compute the
+        adds, removes and updates needed on a Google Calendar, without
+        writing anything (returns a JSON-serializable plan), optionally
+        within a deadline
+
+    check_deadline() - raise an exception if a deadline has passed
+
+    apply_gcal_plan() - given a plan, push its changes to Google Calendar
+        (recording them in a journal as they are done)
+
+    resume_gcal_journal() - send the changes left in the journal by a
+        run that died partway through
+
+    save_plan() - save a plan to a JSON file
+
+    load_plan() - load a plan from a JSON file
+
 
 Calendar Update Methods:
 
-    add_event() - given a Google Calendar event (JSON), add the event
-        to a calendar with the given calendar id. Push changes to Google
-        Calendar via API.
+    compare_events() - given a Google Calendar event (JSON) and an IcsEvent
+        record, compare their hashes (and, if they differ, their fields)
+        and return a minimal patch (or None if nothing changed).
+
+
+Batch Update Methods:
+
+    add_events() - given a list of Google Calendar events (JSON), add them
+        to a calendar using batch requests. Returns the failures.
+
+    rm_events() - given a list of Google Calendar events (JSON), remove them
+        from a calendar using batch requests. Returns the failures.
+
+    patch_events() - given a list of patches from compare_events(), send
+        minimal events.patch requests (with If-Match) using batch requests.
+        Returns the failures.
+
+    patch_request() - given a patch from compare_events(), build an
+        events.patch request with an If-Match header
+
+    execute_batch() - send a list of API requests to Google in batches,
+        using a pool of worker threads, retrying only the sub-requests
+        that failed with retryable errors.
+
+    execute_batch_chunk() - send one batch request (run by each worker)
+
+    get_api_executor() - get the pool of worker threads that send batch
+        requests (created once, and reused by every execute_batch() call)
+
+    execute_request() - execute a single API request through the shared
+        rate limiter, retrying rate limit and server errors with backoff
+
+    rate_limiter - AdaptiveRateLimiter shared by all threads, to keep
+        API requests within quota (see util_ratelimit.py)
+
+    is_retryable_error() - is this HttpError a rate limit or server error?
 
-    rm_event() - given a Google Calendar event id, remove the event
-        from the calendar with the given calendar id. Push changes
-        to Google Calendar via API.
+    is_rate_limit_error() - is this HttpError a rate limit error (403/429)?
 
-    sync_events() - (MOST COMPLICATED) given a Google Calendar event (JSON) 
-        and an iCalendar event (JSON), determine which fields are different
-        and update those fields on Google Calendar using the API.
+    get_http_error_reason() - get the reason (e.g. 'rateLimitExceeded')
+        from an HttpError
 
 
 Create Methods:
@@ -66,27 +147,151 @@ Create Methods:
         given label. If the calendar already exists, return its calendar
         id. If a new calendar is created, return its calendar id.
 
-    delete_gcal() - (NOT IMPLEMENTED)
+    destroy_gcal() - given a calendar id, delete the calendar and forget
+        what is stored locally about it
 
     populate_gcal_from_components_map() - iterate through every item in
         an iCalendar components map and add each ical event to the Google
         Calendar.
 
-    gcal_components_map() - given a calendar id, add each event's JSON
-        to a components map (key is event id, value is event JSON)
+    gcal_components_generator() - yields JSON for events in a calendar,
+        fetching one page at a time (optionally only the events in the
+        sync window)
 
-    gcal_components_generator() - yields JSON for events in a calendar
+    gcal_window_map() - given a components map of Google Calendar events,
+        return only the events in the sync window
 
-    ics2gcal_event() - (SUPER IMPORTANT) this converts events from 
+    watch_gcal_events() - given a calendar id and the address of a webhook,
+        open a push channel (events.watch) so Google notifies the webhook
+        whenever an event on the calendar changes
+
+    stop_gcal_channel() - close a push channel opened by watch_gcal_events()
+
+    gcal_mirror_map() - given a calendar id, return a components map
+        of events on the calendar, kept up to date with incremental sync
+        (only events changed since the last run are listed, and events
+        that ended before the sync window are not kept)
+
+    gcal_pages_generator() - given a calendar id and an optional sync token,
+        yield each page of events on the calendar (or of events changed
+        since the sync token), following page tokens
+
+    ics2gcal_event() - (SUPER IMPORTANT) this converts IcsEvent records
+        to Google Calendar events (JSON)
+
+    canonical_gcal_event() - given a Google Calendar event (JSON), return
+        its canonical form (used for hashing and comparing events)
+
+    gcal_time_to_epoch() - convert the start/end of a Google Calendar event
+        to UTC epoch seconds
+
+    epoch_to_gcal_time() - convert UTC epoch seconds to an RFC 3339 time
+        (as used by timeMin/timeMax)
+
+    gcal_event_hash() - given a Google Calendar event (JSON), return a
+        versioned hash of its canonical form
+
+    get_stored_hash() - get the hash stored in a Google Calendar event's
+        private extended properties
+
+    ics_event_hash() - given an IcsEvent record, return the hash of the
+        Google Calendar event (JSON) it converts to
+
+    make_fingerprint() - given an IcsEvent record and the Google Calendar
+        event written for it, return the fingerprint to store locally
 
 
 Constants:
 
-    FUTURE - max time to use when fetching events on a calendar
+    MAX_RESULTS - max number of events per page when listing events
+
+    EVENT_FIELDS - fields of each event returned when listing events
+        (only what the diff uses)
+
+    EVENT_LIST_FIELDS - fields of each page returned when listing events
+
+    BATCH_SIZE - max number of requests in one batch request
+
+    BATCH_RETRIES - max number of times to retry failed requests in a batch
+
+    BATCH_BACKOFF - base delay (seconds) for exponential backoff between retries
+
+    BATCH_BACKOFF_MAX - max delay (seconds) between retries
+
+    API_WORKERS - number of worker threads sending batch requests
+
+    API_RATE - starting number of API requests per second (all workers)
+
+    API_MIN_RATE, API_MAX_RATE - bounds for the adaptive request rate
+
+    API_BURST - max number of API requests sent at once (all workers)
+
+    RATE_LIMIT_REASONS - 403 error reasons that mean we are over quota
+
+    DISCOVERY_URL - where to download the API discovery document from
+
+    DISCOVERY_CACHE_FILE - where to cache the API discovery document
+
+    DISCOVERY_MAX_AGE - download the discovery document again after this long (seconds)
+
+    API_ENDPOINT_VARIABLE - environment variable that can hold an API endpoint
+        to use instead of Google (see set_api_endpoint())
+
+    HASH_VERSION - version of the canonical event form. Bump this whenever
+        the way ical events are converted to Google Calendar events changes,
+        and every event will be updated on the next run (no --force-sync needed).
+
+    HASH_PROPERTY - name of the private extended property holding the hash
+
+    CANONICAL_FIELDS - fields of a Google Calendar event that are hashed/compared
+
+    PLAN_VERSION - version of the plan format written by save_plan()
+
+    PLAN_TIMEOUT - default time budget (seconds) for planning an update
+        with dcppc_calendar.py --plan (fetching the feeds included)
+
+    CHANNEL_TTL - requested lifetime (seconds) of push channels
 """
 
 
-FUTURE = '2018-11-01T00:00:00Z'
+MAX_RESULTS = 2500
+EVENT_FIELDS = 'id,etag,status,summary,description,location,start,end,sequence,extendedProperties/private'
+EVENT_LIST_FIELDS = 'nextPageToken,nextSyncToken,items(%s)'%(EVENT_FIELDS)
+BATCH_SIZE = 50
+BATCH_RETRIES = 4
+BATCH_BACKOFF = 1.0
+BATCH_BACKOFF_MAX = 32.0
+API_WORKERS = 4
+API_RATE = 5.0
+API_MIN_RATE = 0.5
+API_MAX_RATE = 10.0
+API_BURST = 100
+RATE_LIMIT_REASONS = ['rateLimitExceeded', 'userRateLimitExceeded']
+DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/calendar/v3/rest'
+DISCOVERY_CACHE_FILE = '/tmp/calendars/calendar_v3_discovery.json'
+DISCOVERY_MAX_AGE = 7*24*60*60
+API_ENDPOINT_VARIABLE = 'GCAL_API_ENDPOINT'
+
+HASH_VERSION = 1
+HASH_PROPERTY = 'dcppcHash'
+CANONICAL_FIELDS = ['summary', 'start', 'end', 'sequence', 'location', 'description']
+
+PLAN_VERSION = 1
+PLAN_TIMEOUT = 120
+
+CHANNEL_TTL = 7*24*60*60
+
+_credentials = None
+_credentials_lock = threading.RLock()
+_discovery_document = None
+_service_local = threading.local()
+_api_executor = None
+_api_executor_workers = None
+_api_executor_lock = threading.Lock()
+_api_endpoint = os.environ.get(API_ENDPOINT_VARIABLE) or None
+
+_event_index = {}
+_mirror_cache = {}
 
 
 
@@ -95,60 +300,119 @@ def get_named_calendar_id(calendar_name):
     If a calendar with name calendar_name exists,
     this returns the calendar_id for that calendar.
     Otherwise, it returns None.
+
+    The calendar id found on the last run is stored
+    locally, and checked with a single calendars.get
+    request. The calendar list is only searched if
+    there is no stored id, or if it is out of date.
     """
+    cached = load_state('calendar_id', calendar_name)
+    if cached is not None and cached.get('calendar_id'):
+        calendar = get_calendar(cached['calendar_id'])
+        if calendar is not None and calendar.get('summary')==calendar_name:
+            return calendar['id']
+        logging.info("Stored calendar id for \"%s\" is out of date"%(calendar_name))
+        clear_state('calendar_id', calendar_name)
+
     service = get_service()
     page_token = None
     while True:
-        calendar_list = service.calendarList().list(
+        calendar_list = execute_request(service.calendarList().list(
             pageToken=page_token
-        ).execute()
+        ))
         for calendar_list_entry in calendar_list['items']:
             if calendar_list_entry['summary']==calendar_name:
+                save_calendar_id(calendar_name, calendar_list_entry['id'])
                 return calendar_list_entry['id']
         page_token = calendar_list.get('nextPageToken')
         if not page_token:
             return None
 
 
+def save_calendar_id(calendar_name, calendar_id):
+    """
+    Store the calendar id of the calendar
+    with name calendar_name locally
+    """
+    try:
+        save_state('calendar_id', calendar_name, {
+            'name' : calendar_name,
+            'calendar_id' : calendar_id,
+        })
+    except (IOError, OSError):
+        logging.exception("Could not save calendar id for \"%s\""%(calendar_name))
+
+
+def get_calendar(calendar_id):
+    """
+    Get the calendar with id calendar_id (JSON,
+    with its id and summary) using a single
+    calendars.get request. Returns None if
+    the calendar does not exist.
+    """
+    service = get_service()
+    try:
+        return execute_request(service.calendars().get(
+                calendarId=calendar_id,
+                fields='id,summary'
+        ))
+    except apiclient.errors.HttpError as e:
+        if e.resp.status in [404, 410]:
+            return None
+        raise
+
+
 def does_calendar_exist(calendar_id):
     """
     Boolean: does this calendar_id exist?
     """
-    service = get_service()
-    page_token = None
-    while True:
-        calendar_list = service.calendarList().list(
-            pageToken=page_token
-        ).execute()
-        for calendar_list_entry in calendar_list['items']:
-            if calendar_list_entry['id']==calendar_id:
-                return True
-        page_token = calendar_list.get('nextPageToken')
-        if not page_token:
-            return False
+    return get_calendar(calendar_id) is not None
 
 
 def does_event_exist(calendar_id, event_id):
     """
-    Boolean: does the event with id event_id
-    exist on calendar with id calendar_id?
+    Boolean: does the event with id event_id exist
+    (and was not deleted) on calendar with id calendar_id?
+
+    Events already seen during this run are looked up
+    in an in-memory index. Otherwise, a single events.get
+    request is made (never a listing of the calendar).
     """
+    if event_id in _event_index.get(calendar_id, ()):
+        return True
+
     service = get_service()
-    page_token = None
-    while True:
-        events_list = service.events().list(
-                calendarId=calendar_id, 
-                pageToken = page_token,
-                timeMax=FUTURE
-        ).execute()
+    try:
+        event = execute_request(service.events().get(
+                calendarId=calendar_id,
+                eventId=event_id,
+                fields='id,status'
+        ))
+    except apiclient.errors.HttpError as e:
+        if e.resp.status in [404, 410]:
+            return False
+        raise
 
-        for events_list_entry in events_list['items']:
-            if events_list_entry['id']==event_id:
-                return True
+    if event.get('status')=='cancelled':
+        return False
+    index_gcal_events(calendar_id, [event_id])
+    return True
 
-        page_token = events_list.get('nextPageToken')
-        if not page_token:
-            return False
+
+def index_gcal_events(calendar_id, event_ids):
+    """
+    Add event ids to the in-memory index of events
+    known to exist on the calendar
+    """
+    _event_index.setdefault(calendar_id, set()).update(event_ids)
+
+
+def unindex_gcal_events(calendar_id, event_ids):
+    """
+    Remove event ids from the in-memory index of events
+    known to exist on the calendar
+    """
+    _event_index.setdefault(calendar_id, set()).difference_update(event_ids)
 
 
 def get_service():
@@ -156,29 +420,174 @@ def get_service():
     Get a service object, which provides an API interface.
     See pydocs here: 
     https://developers.google.com/resources/api-libraries/documentation/calendar/v3/python/latest/
-    """
-    if not os.path.exists('credentials.json'):
-        logging.error("Could not find OAuth credentials in credentials.json.")
-        if not os.path.exists('client_secrets.json'):
-            logging.error("Could not find API credentials in client_secrets.json")
 
-            err = "Error: no API credentials for Google Calendar!\n"
-            err += "Download client_secrets.json or credentials.json from the "
-            err += "Google Cloud console."
-            logging.error(err)
-            raise Exception(err)
+    The service object is built once per thread (httplib2
+    is not thread-safe, so each thread gets its own authorized
+    Http object) from a discovery document cached on disk.
+    The OAuth credentials are loaded once per process and
+    refreshed only when the access token has expired.
 
-    SCOPES = 'https://www.googleapis.com/auth/calendar'
-    store = file.Storage('credentials.json')
-    creds = store.get()
-    if not creds or creds.invalid:
-        flow = client.flow_from_clientsecrets('client_secrets.json', SCOPES)
-        creds = tools.run_flow(flow, store)
-    service = build('calendar', 'v3', http=creds.authorize(Http()))
+    If an API endpoint was set with set_api_endpoint() (or in
+    the GCAL_API_ENDPOINT environment variable), requests go
+    to that server instead, without OAuth credentials.
+    """
+    if _api_endpoint is not None:
+        service = getattr(_service_local, 'service', None)
+        if service is None:
+            service = build_from_document(get_endpoint_discovery_document(), http=Http())
+            _service_local.service = service
+        return service
+
+    creds = get_credentials()
+
+    if creds.access_token_expired:
+        with _credentials_lock:
+            if creds.access_token_expired:
+                logging.info("Refreshing OAuth access token")
+                creds.refresh(Http())
+
+    service = getattr(_service_local, 'service', None)
+    if service is None:
+        service = build_from_document(get_discovery_document(), http=creds.authorize(Http()))
+        _service_local.service = service
     return service
 
 
-def update_gcal_from_components_map(cal_id, components_map, force_sync=False):
+
+def get_credentials():
+    """
+    Load the OAuth credentials from credentials.json
+    (running the OAuth flow with client_secrets.json
+    if there are no valid credentials). The credentials
+    are loaded once per process and shared by all threads.
+    """
+    global _credentials
+    with _credentials_lock:
+        if _credentials is not None:
+            return _credentials
+
+        if not os.path.exists('credentials.json'):
+            logging.error("Could not find OAuth credentials in credentials.json.")
+            if not os.path.exists('client_secrets.json'):
+                logging.error("Could not find API credentials in client_secrets.json")
+
+                err = "Error: no API credentials for Google Calendar!\n"
+                err += "Download client_secrets.json or credentials.json from the "
+                err += "Google Cloud console."
+                logging.error(err)
+                raise Exception(err)
+
+        SCOPES = 'https://www.googleapis.com/auth/calendar'
+        store = file.Storage('credentials.json')
+        creds = store.get()
+        if not creds or creds.invalid:
+            flow = client.flow_from_clientsecrets('client_secrets.json', SCOPES)
+            creds = tools.run_flow(flow, store)
+        _credentials = creds
+        return _credentials
+
+
+
+def get_discovery_document():
+    """
+    Get the Google Calendar API discovery document
+    (as a string). The document is cached on disk and
+    only loaded again once it is DISCOVERY_MAX_AGE
+    seconds old.
+    """
+    global _discovery_document
+    with _credentials_lock:
+        if _discovery_document is not None:
+            return _discovery_document
+
+        try:
+            if time.time() - os.path.getmtime(DISCOVERY_CACHE_FILE) < DISCOVERY_MAX_AGE:
+                with open(DISCOVERY_CACHE_FILE,'r') as f:
+                    _discovery_document = f.read()
+                return _discovery_document
+        except (IOError, OSError):
+            pass
+
+        try:
+            # Newer versions of google-api-python-client
+            # ship a copy of the discovery document
+            from googleapiclient.discovery_cache import get_static_doc
+            _discovery_document = get_static_doc('calendar', 'v3')
+        except ImportError:
+            _discovery_document = None
+
+        if _discovery_document is None:
+            logging.info("Downloading Google Calendar API discovery document")
+            resp, content = Http().request(DISCOVERY_URL)
+            if resp.status!=200:
+                err = "ERROR: Could not download the Google Calendar API discovery document "
+                err += "(status %s)"%(resp.status)
+                logging.error(err)
+                raise Exception(err)
+            _discovery_document = content.decode('utf-8')
+
+        try:
+            os.makedirs(os.path.dirname(DISCOVERY_CACHE_FILE), exist_ok=True)
+            with open(DISCOVERY_CACHE_FILE+'.tmp','w') as f:
+                f.write(_discovery_document)
+            os.rename(DISCOVERY_CACHE_FILE+'.tmp', DISCOVERY_CACHE_FILE)
+        except (IOError, OSError):
+            logging.exception("Could not save the discovery document to %s"%(DISCOVERY_CACHE_FILE))
+
+        return _discovery_document
+
+
+
+def clear_service_cache():
+    """
+    Forget the cached credentials and service objects,
+    so the next call to get_service() builds them again
+    (e.g. after credentials.json has been replaced)
+    """
+    global _credentials, _discovery_document
+    global _service_local
+    with _credentials_lock:
+        _credentials = None
+        _discovery_document = None
+        _service_local = threading.local()
+
+
+
+def set_api_endpoint(endpoint):
+    """
+    Send every API request to endpoint (the root URL
+    of a server with the same interface as the Google
+    Calendar API, e.g. http://127.0.0.1:8902/ for the
+    fake server in util_fakegcal.py) instead of Google,
+    without OAuth credentials. Pass None to go back
+    to Google.
+    """
+    global _api_endpoint
+    with _credentials_lock:
+        _api_endpoint = endpoint
+    clear_service_cache()
+    if endpoint is not None:
+        logging.info("Sending Google Calendar API requests to %s"%(endpoint))
+
+
+
+def get_endpoint_discovery_document():
+    """
+    Get the Google Calendar API discovery document
+    (as a string), with its root URL (used for single
+    and batch requests) pointing to the API endpoint
+    set by set_api_endpoint()
+    """
+    endpoint = _api_endpoint.rstrip('/')+'/'
+    doc = json.loads(get_discovery_document())
+    doc['rootUrl'] = endpoint
+    doc['mtlsRootUrl'] = endpoint
+    doc['baseUrl'] = endpoint + doc['servicePath']
+    return json.dumps(doc)
+
+
+
+def update_gcal_from_components_map(cal_id, components_map, force_sync=False, batch_size=BATCH_SIZE, workers=API_WORKERS, window=None, allow_remove=True):
     """
     Iterate through every event in components map
     and check if this event exists on the Google Calendar.
@@ -188,20 +597,81 @@ def update_gcal_from_components_map(cal_id, components_map, force_sync=False):
     If the event does exist, compare the component event
     and the Google Calendar event to see if Google Calendar
     needs to be updated.
+
+    Changes are pushed to Google in batches of batch_size,
+    sent concurrently by a pool of workers threads.
+
+    If window is a (start, end) tuple (see get_sync_window()),
+    only Google Calendar events in the window are compared,
+    and events outside the window are left alone. The
+    components map should be filtered with the same window.
+
+    If allow_remove is False (e.g. because a feed could not
+    be fetched, so its events are missing from components map),
+    no events are removed from the Google Calendar.
+
+    This is plan_gcal_update() followed by apply_gcal_plan().
+    If a previous run died partway through, only the rest
+    of its changes are sent (see resume_gcal_journal()),
+    and the calendar is compared again on the next run.
+    """
+    if resume_gcal_journal(cal_id, batch_size, workers):
+        return
+    plan = plan_gcal_update(cal_id, components_map, force_sync, window, allow_remove)
+    apply_gcal_plan(plan, batch_size, workers)
+
+
+
+def plan_gcal_update(cal_id, components_map, force_sync=False, window=None, allow_remove=True, deadline=None):
+    """
+    Compute the changes needed to bring the Google Calendar
+    up to date with the events in components map, without
+    writing anything to Google Calendar (only the event
+    listing is requested).
+
+    Returns a plan (a JSON-serializable dict) with:
+    - add: the Google Calendar events (JSON) to create
+    - remove: the events to delete (id, etag, summary)
+    - update: the patches to send (see compare_events()),
+      with the old and new value of each changed field
+    - unchanged, stale: fingerprints to save and event ids
+      whose fingerprints to forget once the plan is applied
+    The plan can be saved with save_plan() and applied
+    later with apply_gcal_plan().
+
+    If allow_remove is False (some feeds could not be
+    fetched, so their events are missing from components
+    map), the plan removes nothing.
+
+    If deadline (epoch seconds) is given, planning stops
+    with an exception once it has passed (checked between
+    pages of the event listing and between events).
     """
     if cal_id is None:
-        err = "ERROR: You passed a null cal_id to populate_gcal_from_components_map()"
+        err = "ERROR: You passed a null cal_id to plan_gcal_update()"
         logging.error(err)
         raise Exception(err)
 
-    # Get API
-    service = get_service()
+    start_time = time.time()
 
-    logging.info("Updating Google Calendar with events from components_map...")
+    logging.info("Planning update of Google Calendar with events from components_map...")
     logging.info("Calendar id: %s"%(cal_id))
 
-    gcal_events = gcal_components_map(cal_id)
+    # Bring the local mirror of the calendar up to date.
+    # Only changes since the last run are listed, unless
+    # we are forcing a sync (then list everything).
+    # (A listing with a sync token can not be bounded by
+    # timeMin/timeMax, so the window is applied locally.)
+    gcal_mirror = gcal_mirror_map(cal_id, full_sync=force_sync, window=window, deadline=deadline)
+    gcal_events = gcal_window_map(gcal_mirror, window)
     ical_events = components_map
+    list_time = time.time()
+
+    # Fingerprints of every event as of our last write,
+    # so unchanged events can be skipped without comparing
+    state_db = open_state_db()
+    fingerprints = load_fingerprints(state_db, cal_id)
+    state_db.close()
 
     gcal_event_ids = sorted(list(gcal_events.keys()))
     ical_event_ids = sorted(list(components_map.keys()))
@@ -210,18 +680,28 @@ def update_gcal_from_components_map(cal_id, components_map, force_sync=False):
     rm_ids     = set(gcal_event_ids) - set(ical_event_ids)
     sync_ids   = set(gcal_event_ids) & set(ical_event_ids)
 
-    logging.info("-"*40)
-    logging.info("Summary:")
-    logging.info("  ADD:    %d Google Calendar events to add"%len(add_ids))
-    logging.info("  REMOVE: %d Google Calendar events to remove"%len(rm_ids))
-    logging.info("  SYNC:   %d Google Calendar events to sync"%len(sync_ids))
+    if not allow_remove and len(rm_ids)>0:
+        logging.warning("Some feeds could not be fetched, not removing %d events this run"%(len(rm_ids)))
+        rm_ids = set()
+
+    plan = {
+        'plan_version' : PLAN_VERSION,
+        'calendar_id' : cal_id,
+        'created' : datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'force_sync' : force_sync,
+        'window' : list(window) if window is not None else None,
+        'add' : [],
+        'remove' : [],
+        'update' : [],
+        'unchanged' : [],
+        'stale' : [],
+    }
 
     # ----------------------------
     # Adding
 
-    logging.info("Adding %d events..."%len(add_ids))
-    add_failures = []
-    for eid in add_ids:
+    for eid in sorted(add_ids):
+        check_deadline(deadline, "planning the events to add")
         try:
             ical_event = ics2gcal_event(ical_events[eid])
         except:
@@ -229,15 +709,149 @@ def update_gcal_from_components_map(cal_id, components_map, force_sync=False):
             traceback.print_exc()
             logging.error("Life goes on. Continuing...")
             continue
+        logging.info("Adding event %s (%s)"%(eid, ical_event['summary']))
+        plan['add'].append({
+            'event' : ical_event,
+            'fingerprint' : make_fingerprint(ical_events[eid], {}),
+        })
+
+    # ----------------------------
+    # Removing
+
+    for eid in sorted(rm_ids):
+        gcal_event = gcal_events[eid]
+        logging.info("Removing event %s (%s)"%(eid, gcal_event.get('summary')))
+        plan['remove'].append({
+            'id' : eid,
+            'etag' : gcal_event.get('etag'),
+            'summary' : gcal_event.get('summary'),
+        })
+
+    # ----------------------------
+    # Sync
+
+    n_skipped = 0
+    for eid in sorted(sync_ids):
+        check_deadline(deadline, "comparing events")
+        gcal_event = gcal_events[eid]
+        ical_event = ical_events[eid]
+
+        # If neither the ical event nor the Google Calendar
+        # event changed since our last write, skip it
+        fp = fingerprints.get(eid)
+        if not force_sync and fp is not None \
+                and fp['content_hash']==ics_event_hash(ical_event) \
+                and fp['etag']==gcal_event.get('etag'):
+            n_skipped += 1
+            continue
+
         logging.info("-"*40)
-        logging.info("Adding event %s"%(eid))
-        logging.info("Title: %s"%(ical_event['summary']))
-        failure = add_event(ical_event,cal_id)
-        if failure is None:
+        logging.info("Syncing event %s"%(eid))
+        logging.info("Title: %s"%(ical_event.summary))
+        # If the Google Calendar event was edited since
+        # our last write, do not trust the hash stored on it
+        verify_fields = fp is not None and fp['etag']!=gcal_event.get('etag')
+        try:
+            patch = compare_events(gcal_event,ical_event,force_sync,verify_fields)
+        except:
+            logging.exception("XXX Failed to convert ics to google calendar event")
+            logging.error("Life goes on. Continuing...")
             continue
+        if patch is not None:
+            changes = {}
+            for field in patch['body']:
+                if field!='extendedProperties':
+                    changes[field] = {'gcal' : gcal_event.get(field), 'ical' : patch['body'][field]}
+            plan['update'].append({
+                'patch' : patch,
+                'changes' : changes,
+                'fingerprint' : make_fingerprint(ical_event, {}),
+            })
         else:
-            add_failures.append(failure)
-    logging.info("Done adding %d events."%len(add_ids))
+            plan['unchanged'].append(make_fingerprint(ical_event, gcal_event))
+
+    # Forget fingerprints of events that are no longer on the calendar
+    plan['stale'] = sorted(set(fingerprints.keys()) - set(gcal_mirror.keys()) - add_ids)
+
+    logging.info("-"*40)
+    logging.info("Summary:")
+    logging.info("  ADD:    %d Google Calendar events to add"%len(plan['add']))
+    logging.info("  REMOVE: %d Google Calendar events to remove"%len(plan['remove']))
+    logging.info("  SYNC:   %d Google Calendar events to update (%d checked, %d skipped with unchanged fingerprints)"%(
+        len(plan['update']), len(sync_ids), n_skipped))
+    logging.info("Planned in %0.2f seconds (%0.2f listing events, %0.2f comparing)"%(
+        time.time()-start_time, list_time-start_time, time.time()-list_time))
+
+    return plan
+
+
+
+def check_deadline(deadline, what):
+    """
+    Raise an exception if deadline (epoch seconds,
+    or None for no deadline) has passed. what says
+    what was being done, for the error message.
+    """
+    if deadline is not None and time.time() > deadline:
+        err = "ERROR: Ran out of time while %s"%(what)
+        logging.error(err)
+        raise Exception(err)
+
+
+
+def apply_gcal_plan(plan, batch_size=BATCH_SIZE, workers=API_WORKERS):
+    """
+    Apply a plan computed by plan_gcal_update(): add,
+    remove and patch events on Google Calendar (in batches
+    of batch_size, sent by a pool of workers threads),
+    then record the fingerprints of the events written.
+
+    Patches carry the etag the event had when the plan
+    was made, so an event that changed on Google Calendar
+    since then is not overwritten (it fails with 412, and
+    is picked up again by the next run).
+
+    Every operation in the plan is written to a journal
+    before anything is sent, and marked as done after each
+    step of batch_size*workers operations. If the process
+    dies, resume_gcal_journal() sends only the operations
+    that were not done.
+    """
+    cal_id = plan['calendar_id']
+    state_db = open_state_db()
+
+    logging.info("Applying plan to Google Calendar...")
+    logging.info("Calendar id: %s"%(cal_id))
+
+    # Write ahead: record every operation before sending any
+    ops = [('add', a['event']['id'], a) for a in plan['add']] \
+        + [('remove', r['id'], r) for r in plan['remove']] \
+        + [('update', u['patch']['id'], u) for u in plan['update']]
+    start_journal(state_db, cal_id, ops)
+
+    # Local changes only, safe to do right away
+    save_fingerprints(state_db, cal_id, plan['unchanged'])
+    delete_fingerprints(state_db, cal_id, plan['stale'])
+
+    step = max(1, batch_size*workers)
+    n_add = len(plan['add'])
+    n_rm = len(plan['remove'])
+
+    # ----------------------------
+    # Adding
+
+    logging.info("Adding %d events..."%n_add)
+    add_failures = []
+    for i in range(0, n_add, step):
+        adds = plan['add'][i:i+step]
+        add_fingerprints = dict((a['event']['id'], a['fingerprint']) for a in adds)
+        add_responses = {}
+        add_failures += add_events([a['event'] for a in adds], cal_id, batch_size, add_responses, workers)
+        save_fingerprints(state_db, cal_id, [
+            dict(add_fingerprints[eid], etag=r.get('etag')) for eid, r in add_responses.items()
+        ])
+        finish_journal_ops(state_db, cal_id, range(i, i+len(adds)))
+    logging.info("Done adding %d events."%n_add)
     logging.info("Encountered %d failures:"%len(add_failures))
     for failure in add_failures:
         eid = failure['id']
@@ -247,283 +861,527 @@ def update_gcal_from_components_map(cal_id, components_map, force_sync=False):
     # ----------------------------
     # Removing
 
-    logging.info("Removing %d events..."%len(rm_ids))
+    logging.info("Removing %d events..."%n_rm)
     rm_failures = []
-    for eid in rm_ids:
-        gcal_event = gcal_events[eid]
-        logging.info("-"*40)
-        logging.info("Removing event %s"%(eid))
-        logging.info("Title: %s"%(gcal_event['summary']))
-        failure = rm_event(gcal_event,cal_id)
-        if failure is None:
-            continue
-        else:
-            rm_failures.append(failure)
-    logging.info("Done removing %d events."%len(rm_ids))
+    for i in range(0, n_rm, step):
+        rm_gcals = plan['remove'][i:i+step]
+        failures = rm_events(rm_gcals, cal_id, batch_size, workers)
+        rm_failed_ids = set(failure['id'] for failure in failures)
+        delete_fingerprints(state_db, cal_id, [e['id'] for e in rm_gcals if e['id'] not in rm_failed_ids])
+        finish_journal_ops(state_db, cal_id, range(n_add+i, n_add+i+len(rm_gcals)))
+        rm_failures += failures
+    logging.info("Done removing %d events."%n_rm)
     logging.info("Encountered %d failures:"%len(rm_failures))
     for failure in rm_failures:
         eid = failure['id']
-        summary = failure['summary']
+        summary = failure.get('summary')
         logging.info("    Event id (title): %s (%s)"%(eid, summary))
 
     # ----------------------------
     # Sync
 
-    logging.info("Syncing %d events..."%len(sync_ids))
-    n_events_changed = 0
-    for eid in sync_ids:
-        gcal_event = gcal_events[eid]
-        try:
-            ical_event = ics2gcal_event(ical_events[eid])
-        except:
-            logging.exception("XXX Failed to convert ics to google calendar event")
-            logging.error("Life goes on. Continuing...")
-            continue
-        logging.info("-"*40)
-        logging.info("Syncing event %s"%(eid))
-        logging.info("Title: %s"%(ical_event['summary']))
-        was_changed = sync_events(gcal_event,ical_event,cal_id,force_sync)
-        if was_changed:
-            n_events_changed += 1
-    logging.info("Done syncing %d events, %d updated."%(len(sync_ids),n_events_changed))
+    logging.info("Syncing %d events..."%len(plan['update']))
+    sync_failures = []
+    for i in range(0, len(plan['update']), step):
+        updates = plan['update'][i:i+step]
+        sync_fingerprints = dict((u['patch']['id'], u['fingerprint']) for u in updates)
+        sync_responses = {}
+        sync_failures += patch_events([u['patch'] for u in updates], cal_id, batch_size, sync_responses, workers)
+        save_fingerprints(state_db, cal_id, [
+            dict(sync_fingerprints[eid], etag=r.get('etag')) for eid, r in sync_responses.items()
+        ])
+        finish_journal_ops(state_db, cal_id, range(n_add+n_rm+i, n_add+n_rm+i+len(updates)))
+    n_events_changed = len(plan['update']) - len(sync_failures)
+    logging.info("Done syncing %d events, %d updated."%(len(plan['update']),n_events_changed))
+
+    # Every operation was sent (failures are picked
+    # up again by the next run), the journal is done
+    clear_journal(state_db, cal_id)
+    state_db.close()
 
+    rate_limiter.log_counters()
 
 
-def add_event(ical2gcal,cal_id):
+
+def resume_gcal_journal(cal_id, batch_size=BATCH_SIZE, workers=API_WORKERS):
     """
-    This takes a JSON object (gcal) representing the
-    google calendar event, and a calendar id.
-    It adds the given event to the given calendar.
+    If a previous run died while applying a plan to
+    the calendar with id cal_id, send the operations
+    in its journal that were not done yet.
+
+    Returns True if there was a journal to resume.
     """
-    service = get_service()
-    try:
-        created_event = service.events().insert(calendarId=cal_id, body=ical2gcal).execute()
-        logging.info("Successfully created event!")
-        logging.info("Calendar id: %s"%(cal_id))
-        logging.info("Event id: %s"%(created_event['id']))
-        logging.info("Title: %s"%(created_event['summary']))
-
-    except apiclient.errors.HttpError:
-        if does_event_exist(cal_id, ical2gcal['id']):
-            err = "ERROR: Could not create event with event id: %s\n"%(ical2gcal['id'])
-            err += "This event already exists!\n"
-            err += "Calendar id: %s\n"%(cal_id)
-            err += "Event id: %s\n"%(ical2gcal['id'])
-            err += "Title: %s\n"%(ical2gcal['summary'])
-            #raise Exception(err)
-            logging.error(err)
-            logging.error("Continuing...\n")
-            # Not a "failure", per se
+    state_db = open_state_db()
+    pending = load_journal(state_db, cal_id)
+    state_db.close()
+    if len(pending)==0:
+        return False
+
+    logging.info("Resuming %d unfinished operations from the journal"%(len(pending)))
+    plan = {
+        'plan_version' : PLAN_VERSION,
+        'calendar_id' : cal_id,
+        'add' : [payload for seq, op, eid, payload in pending if op=='add'],
+        'remove' : [payload for seq, op, eid, payload in pending if op=='remove'],
+        'update' : [payload for seq, op, eid, payload in pending if op=='update'],
+        'unchanged' : [],
+        'stale' : [],
+    }
+    apply_gcal_plan(plan, batch_size, workers)
+    return True
+
+
+
+def save_plan(plan, plan_file):
+    """
+    Save a plan computed by plan_gcal_update()
+    to plan_file as JSON (atomically)
+    """
+    with open(plan_file+'.tmp','w') as f:
+        json.dump(plan, f, indent=2, sort_keys=True)
+    os.rename(plan_file+'.tmp', plan_file)
+    logging.info("Saved plan to %s"%(plan_file))
+
+
+
+def load_plan(plan_file):
+    """
+    Load a plan saved by save_plan()
+    """
+    with open(plan_file,'r') as f:
+        plan = json.load(f)
+    if plan.get('plan_version')!=PLAN_VERSION:
+        err = "ERROR: Plan %s has version %s, expected version %s. "%(plan_file, plan.get('plan_version'), PLAN_VERSION)
+        err += "Make a new plan with --plan."
+        logging.error(err)
+        raise Exception(err)
+    return plan
+
+
+
+def compare_events(gcal, event, force_sync=False, verify_fields=False):
+    """
+    For two given events (one Google Calendar, one IcsEvent record),
+    determine which fields of the Google Calendar event are out of 
+    date with the details of the ical event.
+
+    Every event we write carries a hash of its canonical form in
+    its private extended properties. If the hash on the Google
+    Calendar event matches the hash of the ical event, nothing
+    changed, and that is the only comparison we make (unless
+    verify_fields is True, e.g. because the event was edited on
+    Google Calendar since we wrote it and the stored hash can no
+    longer be trusted).
+
+    If the Google Calendar event needs to be updated, returns a
+    patch: a dict with the event 'id', its current 'etag', its
+    'summary' (for logging) and a minimal 'body' for events.patch
+    that holds only the fields that changed. Otherwise, returns None.
+    The Google Calendar event itself is not modified.
+    """
+    ical = ics2gcal_event(event)
+    ical_hash = get_stored_hash(ical)
+
+    if not force_sync and not verify_fields and get_stored_hash(gcal)==ical_hash:
+        return None
+
+    logging.info("Comparing ical and Google Calendar for event %s:"%(gcal.get('description')))
+
+    # Hashes differ (or the Google Calendar event has no hash yet),
+    # so compare the canonical forms field by field to find out
+    # which fields changed.
+    ical_canonical = canonical_gcal_event(ical)
+    gcal_canonical = canonical_gcal_event(gcal)
+
+    if force_sync:
+        # In case we want to force two events to sync,
+        # overwrite every field (except the organizer)
+        what_changed = list(CANONICAL_FIELDS)
+    else:
+        what_changed = [k for k in CANONICAL_FIELDS if ical_canonical[k]!=gcal_canonical[k]]
+
+    if len(what_changed)==0:
+        if get_stored_hash(gcal)==ical_hash:
+            logging.info("Nothing to be updated.")
             return None
+        logging.info("No fields changed, storing the event hash.")
+    else:
+        logging.info("Need to update event:")
+        logging.info("    id: %s"%(gcal['id']))
+        logging.info("    title: %s"%(gcal.get('summary')))
+        logging.info("    fields changed: %s"%(", ".join(what_changed)))
+    body = {}
+    for field in what_changed:
+        logging.info("        key: %s"%(field))
+        logging.info("            gcal: %s"%(gcal.get(field)))
+        logging.info("            ical: %s"%(ical[field]))
+        body[field] = ical[field]
+
+    # Always store the new hash
+    body['extendedProperties'] = ical['extendedProperties']
+
+    return {
+        'id' : gcal['id'],
+        'etag' : gcal.get('etag'),
+        'summary' : ical['summary'],
+        'body' : body,
+    }
+
+
+
+def patch_request(service, cal_id, patch):
+    """
+    Given a service object, a calendar id and a patch
+    (as returned by compare_events()), return an
+    events.patch request with a minimal body. If we
+    know the etag of the event, send it in If-Match,
+    so the patch fails (412) instead of overwriting
+    an edit made on Google Calendar in the meantime.
+    """
+    request = service.events().patch(calendarId=cal_id, eventId=patch['id'], body=patch['body'])
+    if patch.get('etag'):
+        request.headers['If-Match'] = patch['etag']
+    return request
+
+
+
+def execute_batch(api_requests, batch_size=BATCH_SIZE, retries=BATCH_RETRIES, workers=API_WORKERS):
+    """
+    Given a list of (request_id, make_request) tuples, where
+    make_request is a function that takes a service object and
+    returns an API request that has not been executed yet
+    (e.g. service.events().insert(...)), send the requests
+    to Google in batches of batch_size.
+
+    Batches are sent concurrently by a pool of workers threads.
+    Each worker builds its requests with its own service object
+    (and its own authorized Http object, since httplib2 is not
+    thread-safe). All workers share one rate limiter. The pool
+    is kept for the whole process (see get_api_executor()), so
+    each worker builds its service object only once.
+
+    Sub-requests that fail with a retryable error (rate limits
+    and server errors) are retried in new batches, up to retries
+    times, with jittered exponential backoff between rounds.
+    Sub-requests that succeeded are never sent again.
+
+    Returns a tuple (responses, errors): dicts mapping each
+    request id to its response (JSON) or its HttpError.
+    """
+    responses = OrderedDict()
+    errors = OrderedDict()
+    lock = threading.Lock()
+
+    pending = list(api_requests)
+    attempt = 0
+    while len(pending)>0:
+        retry = []
+        chunks = [OrderedDict(pending[i:i+batch_size]) for i in range(0, len(pending), batch_size)]
+
+        def run_chunk(chunk):
+            execute_batch_chunk(chunk, responses, errors, retry, lock,
+                    can_retry=(attempt<retries))
+
+        if workers>1 and len(chunks)>1:
+            # list() re-raises any exception from the workers
+            list(get_api_executor(workers).map(run_chunk, chunks))
         else:
-            err = "ERROR: Could not create event with event id: %s\n"%(ical2gcal['id'])
-            err += "There may be a problem with the calendar/event id.\n"
-            err += "Calendar id: %s\n"%(cal_id)
-            err += "Event id: %s\n"%(ical2gcal['id'])
-            err += "Title: %s\n"%(ical2gcal['summary'])
-            #raise Exception(err)
-            logging.error(err)
-            logging.error("Continuing...\n")
-            # Return this event as failed
-            return ical2gcal
+            for chunk in chunks:
+                run_chunk(chunk)
 
-    return None
+        if len(retry)==0:
+            break
+
+        delay = random.uniform(0, min(BATCH_BACKOFF_MAX, BATCH_BACKOFF*(2**attempt)))
+        attempt += 1
+        logging.info("Retrying %d failed requests in %0.1f seconds (retry %d of %d)"%(
+            len(retry), delay, attempt, retries))
+        rate_limiter.count('retried', len(retry))
+        time.sleep(delay)
+        pending = retry
+
+    # Requests that were worth retrying, but ran out of retries
+    rate_limiter.count('dropped', len([e for e in errors.values() if is_retryable_error(e)]))
+
+    return responses, errors
 
 
-def rm_event(ical2gcal,cal_id):
+
+def get_api_executor(workers):
+    """
+    Get the pool of workers threads that send batch
+    requests. The pool is created once and reused by
+    every call to execute_batch() (and every retry round),
+    so the service object cached by each worker thread
+    is reused too. It is only created again if the number
+    of workers changes.
+    """
+    global _api_executor, _api_executor_workers
+    with _api_executor_lock:
+        if _api_executor is None or _api_executor_workers!=workers:
+            if _api_executor is not None:
+                _api_executor.shutdown(wait=False)
+            _api_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='gcal-api')
+            _api_executor_workers = workers
+        return _api_executor
+
+
+
+def execute_request(request, retries=BATCH_RETRIES):
+    """
+    Execute a single API request (e.g. service.events().get(...))
+    through the shared rate limiter. Rate limit errors (403/429)
+    and server errors are retried up to retries times, with
+    jittered exponential backoff. Any other error (or the last
+    error, once we run out of retries) is raised.
+
+    Returns the response (JSON).
+    """
+    attempt = 0
+    while True:
+        rate_limiter.acquire()
+        try:
+            response = request.execute()
+            rate_limiter.success()
+            return response
+        except apiclient.errors.HttpError as e:
+            if is_rate_limit_error(e):
+                rate_limiter.throttled()
+            if not is_retryable_error(e):
+                raise
+            if attempt>=retries:
+                rate_limiter.count('dropped')
+                raise
+
+        delay = random.uniform(0, min(BATCH_BACKOFF_MAX, BATCH_BACKOFF*(2**attempt)))
+        attempt += 1
+        logging.info("Retrying request in %0.1f seconds (retry %d of %d)"%(delay, attempt, retries))
+        rate_limiter.count('retried')
+        time.sleep(delay)
+
+
+
+def execute_batch_chunk(chunk, responses, errors, retry, lock, can_retry=True):
     """
-    This takes a JSON object (gcal) representing the
-    google calendar event, and a calendar id.
-    It removes the given event from the given calendar.
+    Send one batch request holding every request in chunk
+    (an OrderedDict of request ids to make_request functions),
+    using this thread's service object. Results are added to
+    responses and errors, and requests worth retrying are added
+    to retry (all three are shared between threads, so they
+    are only touched while holding lock).
     """
     service = get_service()
+
+    def callback(request_id, response, exception):
+        if exception is None:
+            rate_limiter.success()
+        elif is_rate_limit_error(exception):
+            rate_limiter.throttled()
+        with lock:
+            if exception is None:
+                responses[request_id] = response
+                errors.pop(request_id, None)
+            else:
+                errors[request_id] = exception
+                if can_retry and is_retryable_error(exception):
+                    retry.append((request_id, chunk[request_id]))
+
+    batch = service.new_batch_http_request(callback=callback)
+    for request_id, make_request in chunk.items():
+        batch.add(make_request(service), request_id=request_id)
+
+    # Each sub-request counts against the API quota
+    rate_limiter.acquire(len(chunk))
+    try:
+        batch.execute()
+    except apiclient.errors.HttpError as e:
+        # The whole batch failed
+        for request_id in chunk.keys():
+            callback(request_id, None, e)
+
+
+
+rate_limiter = AdaptiveRateLimiter(API_RATE, API_BURST, API_MIN_RATE, API_MAX_RATE)
+
+
+
+def is_retryable_error(exception):
+    """
+    Boolean: is this HttpError worth retrying?
+    (rate limits and server errors)
+    """
+    if not isinstance(exception, apiclient.errors.HttpError):
+        return False
+    if exception.resp.status>=500:
+        return True
+    return is_rate_limit_error(exception)
+
+
+
+def is_rate_limit_error(exception):
+    """
+    Boolean: is this HttpError Google telling us
+    to slow down? (429, or 403 with a rate limit reason)
+    """
+    if not isinstance(exception, apiclient.errors.HttpError):
+        return False
+    status = exception.resp.status
+    if status==429:
+        return True
+    if status==403:
+        return get_http_error_reason(exception) in RATE_LIMIT_REASONS
+    return False
+
+
+
+def get_http_error_reason(exception):
+    """
+    Given an HttpError, return the reason given
+    by the API (e.g. 'rateLimitExceeded'), or None
+    """
     try:
-        service.events().delete(calendarId=cal_id, eventId=ical2gcal['id'], sendNotifications=False)
-        logging.info("Successfully deleted event!")
-        logging.info("Calendar id: %s"%(cal_id))
-        logging.info("Event id: %s"%(ical2gcal['id']))
+        content = json.loads(exception.content.decode('utf-8'))
+        return content['error']['errors'][0]['reason']
+    except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+        return None
+
+
 
-    except apiclient.errors.HttpError:
-        err = "ERROR: Could not delete event with event id: %s\n"%(ical2gcal['id'])
+def add_events(ical2gcals, cal_id, batch_size=BATCH_SIZE, responses=None, workers=API_WORKERS):
+    """
+    This takes a list of JSON objects representing
+    google calendar events, and a calendar id.
+    It adds the given events to the given calendar,
+    using batch requests.
+
+    If responses is a dict, it is filled in with the
+    created event (JSON) for each event id that was added.
+
+    An insert fails with 409 if the id is already used,
+    which is also the case for an event that was deleted
+    (Google keeps deleted events, and their ids can not be
+    used again). Each such event is checked with
+    does_event_exist(), and deleted events are restored
+    with events.update instead.
+
+    Returns the list of events that could not be added.
+    """
+    events = OrderedDict((e['id'], e) for e in ical2gcals)
+    api_requests = [(eid, lambda service, e=e: service.events().insert(calendarId=cal_id, body=e))
+                for eid, e in events.items()]
+    results, errors = execute_batch(api_requests, batch_size, workers=workers)
+
+    # Restore the deleted events that have the same ids
+    deleted = [eid for eid, exception in errors.items()
+            if exception.resp.status==409 and not does_event_exist(cal_id, eid)]
+    if len(deleted)>0:
+        logging.info("Restoring %d deleted events"%(len(deleted)))
+        api_requests = [(eid, lambda service, e=events[eid]: service.events().update(
+                    calendarId=cal_id, eventId=e['id'], body=dict(e, status='confirmed')))
+                for eid in deleted]
+        restored, restore_errors = execute_batch(api_requests, batch_size, workers=workers)
+        results.update(restored)
+        for eid in deleted:
+            errors.pop(eid)
+        errors.update(restore_errors)
+
+    if responses is not None:
+        responses.update(results)
+
+    for eid in results:
+        logging.info("Successfully created event %s (%s)"%(eid, events[eid]['summary']))
+    index_gcal_events(cal_id, results.keys())
+
+    failures = []
+    for eid, exception in errors.items():
+        if exception.resp.status==409:
+            logging.error("Could not create event %s, this event already exists!"%(eid))
+            # Not a "failure", per se
+            continue
+        err = "ERROR: Could not create event with event id: %s\n"%(eid)
         err += "There may be a problem with the calendar/event id.\n"
         err += "Calendar id: %s\n"%(cal_id)
-        err += "Event id: %s\n"%(ical2gcal['id'])
-        err += "Title: %s\n"%(gcal['summary'])
-        #raise Exception(err)
+        err += "Event id: %s\n"%(eid)
+        err += "Title: %s\n"%(events[eid]['summary'])
+        err += "Status: %s\n"%(exception.resp.status)
         logging.error(err)
-        logging.error("Continuing...\n")
-        # Return this event as failed
-        return ical2gcal
-
-    return None
+        failures.append(events[eid])
+    return failures
 
 
 
-def sync_events(gcal, ical, cal_id, force_sync=False):
+def rm_events(gcals, cal_id, batch_size=BATCH_SIZE, workers=API_WORKERS):
     """
-    For two given events (one Google Calendar, one ical VEVENT),
-    bring the Google Calendar event up to date with the 
-    details of the ical event.
+    This takes a list of JSON objects representing
+    google calendar events, and a calendar id.
+    It removes the given events from the given calendar,
+    using batch requests.
 
-    Not sure what we are returning.
+    Returns the list of events that could not be removed.
     """
-    logging.info("Comparing ical and Google Calendar for event %s:"%(gcal['description']))
+    events = OrderedDict((e['id'], e) for e in gcals)
+    api_requests = [(eid, lambda service, eid=eid: service.events().delete(calendarId=cal_id, eventId=eid, sendNotifications=False))
+                for eid in events.keys()]
+    responses, errors = execute_batch(api_requests, batch_size, workers=workers)
+
+    for eid in responses:
+        logging.info("Successfully deleted event %s (%s)"%(eid, events[eid].get('summary')))
+    unindex_gcal_events(cal_id, events.keys())
+
+    failures = []
+    for eid, exception in errors.items():
+        if exception.resp.status in [404, 410]:
+            # Already gone
+            continue
+        err = "ERROR: Could not delete event with event id: %s\n"%(eid)
+        err += "There may be a problem with the calendar/event id.\n"
+        err += "Calendar id: %s\n"%(cal_id)
+        err += "Event id: %s\n"%(eid)
+        err += "Title: %s\n"%(events[eid].get('summary'))
+        err += "Status: %s\n"%(exception.resp.status)
+        logging.error(err)
+        failures.append(events[eid])
+    return failures
 
-    service = get_service()
 
-    # This entire function is run once on each individual event
-
-    # Boolean: do we need to update the gcal event?
-    # Assume no.
-    update_gcal = False
-
-    was_event_changed = False
-
-    what_changed = []
-
-    # Iterate over each key in the given event
-    for ik in ical.keys():
-
-        # ical event keys are a subset of google cal event keys,
-        # so only check keys that exist in ical
-        if ik in gcal.keys():
-
-            # If the values of these matching keys
-            # do not match, we need to update the
-            # Google Calendar event
-            if ical[ik]!=gcal[ik]:
-
-                # UNLESS.........
-                # It is a start or end time, in which case,
-                # we need to make sure we are comparing the 
-                # timestamps correctly.
-                if ik=='start' or ik=='end':
-
-                    # Example output:
-                    # 
-                    #(Pdb) ical[ik]
-                    #{'timeZone': 'UTC', 'dateTime': '2018-10-04T17:00:00+00:00'}
-                    #(Pdb) gcal[ik]
-                    #{'dateTime': '2018-10-04T13:00:00-04:00', 'timeZone': 'UTC'}
-
-                    # Get the datetime strings
-                    if 'dateTime' not in ical[ik].keys():
-                        # Yikes...
-                        continue
-
-                    if 'dateTime' not in gcal[ik].keys():
-                        # We shouldn't be here.
-                        continue
-
-                    # Now for the tricky part.
-                    # Parse the datetime stamps
-                    idt = parse(ical[ik]['dateTime'])
-                    gdt = parse(gcal[ik]['dateTime'])
-
-                    # ASSUMPTION:
-                    # We assume that Groups.io .ics calendars
-                    # are ALWAYS given in the UTC timeZone.
-                    # If we update our Google Calendar event
-                    # and use a timestamp in the UTC timezone,
-                    # Google Calendar will automatically add
-                    # the time zone information for this calendar
-                    # to the given event.
-                    # 
-                    # (Calendars are EASTERN TIME by default.)
-                    # 
-                    # Okay, on with the show.
-                    # Convert gcal event datetime to UTC
-                    # so we can compare to ical datetime.
-                    gdt = gdt.astimezone(pytz.timezone('UTC'))
-
-                    if gdt != idt:
-                        # The start/end time has changed
-                        what_changed.append(ik)
-                        update_gcal = True
-                        # Keep going so we have a complete
-                        # list of keys that changed with
-                        # this particular event.
-
-                elif ik=='sequence':
-                    # Sequence may be an integer
-                    # or a string... :-/
-                    if str(gcal[ik])!=str(ical[ik]):
-                        what_changed.append(ik)
-                        update_gcal = True
-
-                elif ik=='organizer':
-                    # The organizer automatically gets reset to 
-                    # the owner of the calendar, so there's no
-                    # need to worry about it.
-                    pass
-
-                else:
-
-                    # Neither a start nor an end,
-                    # and the keys are unequal.
-                    # No further questions.
-                    what_changed.append(ik)
-                    update_gcal = True
-
-    # In case we want to force two events to sync
-    if was_event_changed is False and force_sync is True:
-        was_event_changed = True
-
-    # We got here because we either:
-    # 1. Found two keys that are different
-    # 2. Looped over every key and found no differences
-
-    if update_gcal:
-        # Found at least two keys that are different
-        # 
-        # Update the gcal object, then call the
-        # API with it. (Do we have the calendar id?)
-        logging.info("Need to update event:")
-        logging.info("    id: %s"%(gcal['id']))
-        logging.info("    title: %s"%(gcal['summary']))
-        logging.info("    fields changed: %s"%(", ".join(what_changed)))
-        for field in what_changed:
-            logging.info("        key: %s"%(field))
-            logging.info("            gcal: %s"%(gcal[field]))
-            logging.info("            ical: %s"%(ical[field]))
-            gcal[field] = ical[field]
 
-        try:
-            # https://developers.google.com/resources/api-libraries/documentation/calendar/v3/python/latest/calendar_v3.events.html#update
-            service.events().update(calendarId=cal_id, eventId=gcal['id'], body=gcal).execute()
-            logging.info("Successfully updated event!")
-            logging.info("Calendar id: %s"%(cal_id))
-            logging.info("Event id: %s"%(gcal['id']))
-            logging.info("Title: %s"%(gcal['summary']))
-            return True
-
-        except apiclient.errors.HttpError:
-            if does_event_exist(cal_id, gcal['id']):
-                err = "ERROR: Could not create event with event id: %s\n"%(gcal['id'])
-                err += "This event already exists!\n"
-                err += "Calendar id: %s\n"%(cal_id)
-                err += "Event id: %s\n"%(gcal['id'])
-                err += "Title: %s\n"%(gcal['summary'])
-                #raise Exception(err)
-                logging.error(err)
-                logging.error("Continuing...\n")
-                return False
-            else:
-                err = "ERROR: Could not create event with event id: %s\n"%(gcal['id'])
-                err += "There may be a problem with the calendar/event id.\n"
-                err += "Calendar id: %s\n"%(cal_id)
-                err += "Event id: %s\n"%(gcal['id'])
-                err += "Title: %s\n"%(gcal['summary'])
-                #raise Exception(err)
-                logging.error(err)
-                logging.error("Continuing...\n")
-                return False
+def patch_events(patches, cal_id, batch_size=BATCH_SIZE, responses=None, workers=API_WORKERS):
+    """
+    This takes a list of patches (as returned by
+    compare_events()), and a calendar id. It patches
+    the given events on the given calendar, sending only
+    the fields that changed, using batch requests.
 
-        logging.info("\n")
+    If responses is a dict, it is filled in with the
+    updated event (JSON) for each event id that was patched.
 
-    else:
-        logging.info("Nothing to be updated.")
-        return False
+    Returns the list of patches that could not be applied.
+    """
+    patches = OrderedDict((p['id'], p) for p in patches)
+    api_requests = [(eid, lambda service, p=p: patch_request(service, cal_id, p))
+                for eid, p in patches.items()]
+    results, errors = execute_batch(api_requests, batch_size, workers=workers)
+    if responses is not None:
+        responses.update(results)
+
+    for eid in results:
+        logging.info("Successfully updated event %s (%s)"%(eid, patches[eid]['summary']))
+
+    failures = []
+    for eid, exception in errors.items():
+        if exception.resp.status==412:
+            err = "ERROR: Event %s was changed on Google Calendar "%(eid)
+            err += "while we were updating it, it will be synced on the next run.\n"
+        else:
+            err = "ERROR: Could not update event with event id: %s\n"%(eid)
+            err += "There may be a problem with the calendar/event id.\n"
+        err += "Calendar id: %s\n"%(cal_id)
+        err += "Event id: %s\n"%(eid)
+        err += "Title: %s\n"%(patches[eid]['summary'])
+        err += "Status: %s\n"%(exception.resp.status)
+        logging.error(err)
+        failures.append(patches[eid])
+    return failures
 
 
 
@@ -560,8 +1418,9 @@ def create_gcal(summary,timeZone="America/New_York"):
                 'summary': summary,
                 'timeZone': timeZone,
             }
-            created_calendar = service.calendars().insert(body=calendar).execute()
+            created_calendar = execute_request(service.calendars().insert(body=calendar))
             calendar_id = created_calendar['id']
+            save_calendar_id(summary, calendar_id)
             logging.info("Finished creating a calendar \"%s\" with id %s"%(created_calendar['summary'],created_calendar['id']))
             return calendar_id
 
@@ -577,100 +1436,411 @@ def create_gcal(summary,timeZone="America/New_York"):
 
 
 def destroy_gcal(calendar_id):
-    """TODO: fill this one in"""
-    pass
+    """
+    Delete the calendar with id calendar_id (and all
+    of its events) from Google Calendar, and forget
+    the local mirror and fingerprints of its events.
+    """
+    service = get_service()
+    execute_request(service.calendars().delete(calendarId=calendar_id))
+    logging.info("Deleted calendar %s"%(calendar_id))
+
+    _mirror_cache.pop(calendar_id, None)
+    _event_index.pop(calendar_id, None)
+    clear_state('gcal_mirror', calendar_id)
+    state_db = open_state_db()
+    delete_fingerprints(state_db, calendar_id, list(load_fingerprints(state_db, calendar_id).keys()))
+    clear_journal(state_db, calendar_id)
+    state_db.close()
 
 
 
 
-def populate_gcal_from_components_map(calendar_id, components_map):
+def populate_gcal_from_components_map(calendar_id, components_map, batch_size=BATCH_SIZE, workers=API_WORKERS, window=None):
     """
     Iterate through every event in components map
     and add it as a new event to the Google Calendar
+    (in batches of batch_size, sent by workers threads).
+    window is the sync window used to filter the
+    components map, if any.
+
+    Events are added through a journaled plan (see
+    apply_gcal_plan()), so if a previous run died
+    partway through, only the rest of it is sent.
     """
     if calendar_id is None:
         err = "ERROR: You passed a null calendar_id to populate_gcal_from_components_map()"
         logging.error(err)
         raise Exception(err)
 
-    # Get API
-    service = get_service()
-
     logging.info("Populating Google Calendar with events from components_map...")
     logging.info("Calendar id: %s"%(calendar_id))
-    for k in components_map.keys():
-        logging.info("-"*40)
-        logging.info("Processing event %s"%k)
-        e = components_map[k]
-        try:
-            gce = ics2gcal_event(e)
-            add_event(gce,calendar_id)
-        except:
-            logging.error("XXX Failed to convert event to JSON")
-            traceback.print_exc()
-            logging.error("Life goes on. Continuing...")
-            continue
 
-    gcm = gcal_components_map(calendar_id)
+    if not resume_gcal_journal(calendar_id, batch_size, workers):
+        plan = {
+            'plan_version' : PLAN_VERSION,
+            'calendar_id' : calendar_id,
+            'add' : [],
+            'remove' : [],
+            'update' : [],
+            'unchanged' : [],
+            'stale' : [],
+        }
+        for k in components_map.keys():
+            logging.info("Processing event %s"%k)
+            e = components_map[k]
+            try:
+                plan['add'].append({
+                    'event' : ics2gcal_event(e),
+                    'fingerprint' : make_fingerprint(e, {}),
+                })
+            except:
+                logging.error("XXX Failed to convert event to JSON")
+                traceback.print_exc()
+                logging.error("Life goes on. Continuing...")
+                continue
+        apply_gcal_plan(plan, batch_size, workers)
+
+    gcal_ids = [e['id'] for e in gcal_components_generator(calendar_id, window)]
     logging.info("Done populating Google Calendar:")
     logging.info("Started with %d events, added %d of them"%(
         len(components_map.keys()), 
-        len(gcm.keys())
+        len(gcal_ids)
     ))
 
 
 
-def gcal_components_map(calendar_id, components_map={}):
-    for e in gcal_components_generator(calendar_id):
-        components_map[e['id']] = e
-    return components_map
-
-
-
-def gcal_components_generator(calendar_id):
+def gcal_components_generator(calendar_id, window=None):
     """
     Given a calendar id as a string,
     get the calendar and iterate through
     each event (component), yielding
-    the JSON for the object as we go
+    the JSON for the object as we go.
+
+    Pages are fetched one at a time, as the
+    events are consumed, and only the fields
+    in EVENT_FIELDS are returned for each event.
+
+    If window is a (start, end) tuple (see get_sync_window()),
+    only events that overlap the window are listed.
+    """
+    for page in gcal_pages_generator(calendar_id, window=window):
+        for events_list_entry in page.get('items', []):
+            if events_list_entry.get('status')=='cancelled':
+                continue
+            yield events_list_entry
+
+
+
+def gcal_pages_generator(calendar_id, sync_token=None, window=None, deadline=None):
+    """
+    Given a calendar id, list the events on the calendar,
+    yielding each page of results (the JSON response of
+    events.list) as it arrives. Follows nextPageToken until
+    the last page, which carries the nextSyncToken.
+
+    If sync_token is given, only the events changed since
+    the sync token was issued are listed (deleted events
+    show up with status 'cancelled'), and an HttpError with
+    status 410 is raised if the sync token has expired.
+    A sync token can not be combined with a window.
+
+    If deadline (epoch seconds) is given, an exception is
+    raised if it passes before the last page is requested.
     """
-    # Get API
     service = get_service()
 
+    kwargs = dict(
+            calendarId=calendar_id,
+            maxResults=MAX_RESULTS,
+            fields=EVENT_LIST_FIELDS
+    )
+    if sync_token is not None:
+        kwargs['syncToken'] = sync_token
+    if window is not None:
+        window_start, window_end = window
+        if window_start is not None:
+            kwargs['timeMin'] = epoch_to_gcal_time(window_start)
+        if window_end is not None:
+            kwargs['timeMax'] = epoch_to_gcal_time(window_end)
+
     while True:
-        events_list = service.events().list(calendarId=calendar_id, timeMax=FUTURE).execute()
-        for events_list_entry in events_list['items']:
-            yield events_list_entry
-        page_token = events_list.get('nextPageToken')
+        check_deadline(deadline, "listing the events on calendar %s"%(calendar_id))
+        page = execute_request(service.events().list(**kwargs))
+        yield page
+        page_token = page.get('nextPageToken')
         if not page_token:
             break
+        kwargs['pageToken'] = page_token
+
+
+
+def gcal_window_map(events, window):
+    """
+    Given a components map of Google Calendar events
+    (key is event id, value is event JSON) and a sync
+    window, return a components map of the events
+    that overlap the window
+    """
+    if window is None:
+        return events
+    windowed = {}
+    for eid, e in events.items():
+        start = gcal_time_to_epoch(e.get('start', {}))
+        end = gcal_time_to_epoch(e.get('end', {}))
+        if in_sync_window(start, end, window):
+            windowed[eid] = e
+    return windowed
+
+
+
+def watch_gcal_events(calendar_id, address, ttl=CHANNEL_TTL):
+    """
+    Open a push channel on the calendar with id calendar_id:
+    Google will POST a notification to address (an HTTPS URL)
+    whenever an event on the calendar changes.
+
+    Returns the channel (JSON, with its 'id', 'resourceId',
+    'token' and 'expiration' in milliseconds). Notifications
+    carry the channel id and token in their X-Goog-Channel-ID
+    and X-Goog-Channel-Token headers.
+    """
+    service = get_service()
+    body = {
+        'id' : uuid.uuid4().hex,
+        'type' : 'web_hook',
+        'address' : address,
+        'token' : uuid.uuid4().hex,
+        'params' : {'ttl' : str(ttl)},
+    }
+    channel = execute_request(service.events().watch(calendarId=calendar_id, body=body))
+    channel['token'] = body['token']
+    logging.info("Opened push channel %s on calendar %s (expires %s)"%(
+        channel['id'], calendar_id, channel.get('expiration')))
+    return channel
+
+
+
+def stop_gcal_channel(channel):
+    """
+    Close a push channel opened by watch_gcal_events()
+    """
+    service = get_service()
+    try:
+        execute_request(service.channels().stop(body={
+            'id' : channel['id'],
+            'resourceId' : channel['resourceId'],
+        }))
+        logging.info("Closed push channel %s"%(channel['id']))
+    except apiclient.errors.HttpError as e:
+        if e.resp.status!=404:
+            raise
+
+
+
+def gcal_mirror_map(calendar_id, full_sync=False, window=None, deadline=None):
+    """
+    Given a calendar id, return a components map
+    (key is event id, value is event JSON) that
+    mirrors the events on the Google Calendar.
+
+    The mirror and the sync token from the last
+    listing are stored locally (and kept in memory),
+    so only the events that changed since the last
+    run are listed.
+    A full listing is done if there is no local
+    mirror, if full_sync is True, or if Google
+    says the sync token has expired (410 Gone).
+
+    A listing with a sync token can not be bounded
+    by timeMin/timeMax, so the window is applied
+    locally: if window is given, events that ended
+    before the window starts are dropped from the
+    mirror before it is stored. The window only moves
+    forward, so they are never needed again; events
+    after the end of the window are kept, since they
+    come into the window without changing. If the
+    window starts before the point the mirror was
+    pruned at, a full listing is done.
+
+    If deadline (epoch seconds) is given, the listing
+    stops with an exception once it has passed.
+    """
+    keep_after = window[0] if window is not None else None
+
+    mirror = None
+    if not full_sync:
+        # Use the copy kept in memory by a long-running
+        # process (e.g. --daemon), if there is one
+        mirror = _mirror_cache.get(calendar_id)
+        if mirror is None:
+            mirror = load_state('gcal_mirror', calendar_id)
+
+    if mirror is not None and mirror.get('pruned_before') is not None \
+            and (keep_after is None or keep_after < mirror['pruned_before']):
+        logging.info("Local mirror does not cover the sync window, doing a full sync")
+        mirror = None
+
+    if mirror is not None and mirror.get('sync_token'):
+        try:
+            events = mirror['events']
+            n_changed = 0
+            for page in gcal_pages_generator(calendar_id, sync_token=mirror['sync_token'], deadline=deadline):
+                for e in page.get('items', []):
+                    n_changed += 1
+                    if e.get('status')=='cancelled':
+                        events.pop(e['id'], None)
+                    else:
+                        events[e['id']] = e
+                sync_token = page.get('nextSyncToken')
+            logging.info("Incremental sync: %d events changed on Google Calendar"%(n_changed))
+        except apiclient.errors.HttpError as e:
+            if e.resp.status!=410:
+                raise
+            logging.info("Sync token expired, doing a full sync")
+            mirror = None
+
+    if mirror is None or not mirror.get('sync_token'):
+        events = {}
+        for page in gcal_pages_generator(calendar_id, deadline=deadline):
+            for e in page.get('items', []):
+                if e.get('status')!='cancelled':
+                    events[e['id']] = e
+            sync_token = page.get('nextSyncToken')
+        logging.info("Full sync: %d events on Google Calendar"%(len(events)))
+
+    if keep_after is not None:
+        events = gcal_window_map(events, (keep_after, None))
+
+    # Every event in the mirror exists, which saves an
+    # events.get when an insert fails with 409
+    _event_index[calendar_id] = set(events.keys())
+
+    mirror = {
+        'calendar_id' : calendar_id,
+        'sync_token' : sync_token,
+        'pruned_before' : keep_after,
+        'events' : events,
+    }
+    _mirror_cache[calendar_id] = mirror
+    try:
+        save_state('gcal_mirror', calendar_id, mirror)
+    except (IOError, OSError):
+        logging.exception("Could not save local mirror of calendar %s"%(calendar_id))
+
+    return events
+
+
+
+def canonical_gcal_event(gcal_event):
+    """
+    Given a Google Calendar event (JSON), either converted
+    from an ical event or fetched from the API, return its
+    canonical form: a dict with the fields in CANONICAL_FIELDS,
+    start/end as UTC epoch seconds and sequence as a string.
+    """
+    canonical = {}
+    for k in CANONICAL_FIELDS:
+        if k in ['start', 'end']:
+            canonical[k] = gcal_time_to_epoch(gcal_event.get(k, {}))
+        else:
+            canonical[k] = str(gcal_event.get(k, ''))
+    return canonical
+
+
+
+def gcal_time_to_epoch(gcal_time):
+    """
+    Given the start or end of a Google Calendar event
+    (e.g. {'dateTime': '2018-10-04T13:00:00-04:00'}),
+    return UTC epoch seconds (or None)
+    """
+    if 'dateTime' in gcal_time:
+        return timegm(parse(gcal_time['dateTime']).utctimetuple())
+    if 'date' in gcal_time:
+        return timegm(parse(gcal_time['date']).timetuple())
+    return None
+
+
+
+def epoch_to_gcal_time(epoch):
+    """
+    Given UTC epoch seconds, return an RFC 3339
+    time (e.g. '2018-10-04T17:00:00Z') as used by
+    the timeMin/timeMax parameters of events.list
+    """
+    return datetime.datetime.utcfromtimestamp(epoch).strftime('%Y-%m-%dT%H:%M:%SZ')
 
 
 
-def ics2gcal_event(vevent):
+def gcal_event_hash(gcal_event):
+    """
+    Given a Google Calendar event (JSON), return a
+    versioned hash of its canonical form
+    """
+    canonical = json.dumps(canonical_gcal_event(gcal_event), sort_keys=True)
+    digest = hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+    return 'v%d-%s'%(HASH_VERSION, digest)
+
+
+
+def get_stored_hash(gcal_event):
+    """
+    Given a Google Calendar event (JSON), return the
+    hash stored in its private extended properties
+    (or None if it does not have one)
+    """
+    props = gcal_event.get('extendedProperties', {}).get('private', {})
+    return props.get(HASH_PROPERTY)
+
+
+
+def ics_event_hash(event):
+    """
+    Given an IcsEvent record, return the hash of the
+    Google Calendar event (JSON) it converts to
+    """
+    return get_stored_hash(ics2gcal_event(event))
+
+
 
-    if 'UID' not in vevent.keys():
-        err = "ERROR: Passed a vevent to ics2gcal_event() that has no UID!\n"
-        err += vevent.to_ical().decode('utf-8')
+def make_fingerprint(event, gcal_event):
+    """
+    Given an IcsEvent record and the Google Calendar
+    event (JSON) returned by the API after writing it,
+    return the fingerprint to store for this event
+    """
+    return {
+        'event_id' : event.safe_id,
+        'uid' : event.uid,
+        'sequence' : event.sequence,
+        'content_hash' : ics_event_hash(event),
+        'etag' : gcal_event.get('etag'),
+    }
+
+
+
+def ics2gcal_event(event):
+    """
+    Given an IcsEvent record, convert it to
+    a Google Calendar event (JSON)
+    """
+    if not event.uid:
+        err = "ERROR: Passed an event to ics2gcal_event() that has no UID!\n"
+        err += repr(event)
         logging.error(err)
         raise Exception(err)
 
     timezone = 'UTC'
     utc = pytz.utc
 
-    startdt = utc.localize(datetime.datetime.strptime(vevent_decode(vevent['DTSTART']), "%Y%m%dT%H%M%SZ"))
-    enddt =   utc.localize(datetime.datetime.strptime(vevent_decode(vevent['DTEND']),   "%Y%m%dT%H%M%SZ"))
-
-    event_id = get_safe_event_id(vevent_decode(vevent['UID']))
-    description = htmlify_event_url(vevent)
+    startdt = datetime.datetime.fromtimestamp(event.start, utc)
+    enddt =   datetime.datetime.fromtimestamp(event.end,   utc)
 
-    keys = ['SUMMARY','SEQUENCE','LOCATION','ORGANIZER']
-    for key in keys:
-        if key not in vevent:
-            vevent[key] = b''
+    description = htmlify_event_url(event)
 
     gcal_event = {
-            "summary" : vevent_decode(vevent['SUMMARY']),
+            "summary" : event.summary,
             "start" : {
                 "timeZone" : timezone,
                 "dateTime" : startdt.isoformat("T"),
@@ -679,14 +1849,19 @@ def ics2gcal_event(vevent):
                 "timeZone" : timezone,
                 "dateTime" : enddt.isoformat("T"),
             },
-            "id" :          event_id,
-            "sequence" :    vevent_decode(vevent['SEQUENCE']),
-            "location" :    vevent_decode(vevent['LOCATION']),
+            "id" :          event.safe_id,
+            "sequence" :    event.sequence,
+            "location" :    event.location,
             "description" : description,
             "organizer" : {
-                "displayName" : vevent_decode(vevent['ORGANIZER']),
+                "displayName" : event.organizer,
             }
     }
 
-    return gcal_event
+    gcal_event["extendedProperties"] = {
+            "private" : {
+                HASH_PROPERTY : gcal_event_hash(gcal_event),
+            }
+    }
 
+    return gcal_event
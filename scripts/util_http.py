@@ -0,0 +1,307 @@
+import logging
+import requests
+import urllib3
+import socket
+import hashlib
+import random
+import threading
+import json
+import time
+import os
+
+
+"""
+HTTP Utilities
+
+
+Description:
+
+    This file contains utility methods for downloading
+    .ics feeds over HTTP.
+
+
+Session Methods:
+
+    get_session() - get the shared, pooled requests.Session object
+        used for all feed downloads (keep-alive, gzip)
+
+    get_with_retry() - do a GET request with the shared session,
+        retrying connection errors and 5xx responses with jittered
+        exponential backoff (all within an optional deadline)
+
+    get_remaining_time() - read timeout for the next try, given the deadline
+
+    read_body() - read the body of a streamed response, within the deadline
+
+
+Cache Methods:
+
+    conditional_get() - given a URL, do a conditional GET using the
+        ETag/Last-Modified validators stored in the on-disk cache.
+        Returns the body as bytes (from the network, or from the
+        cache if the server says 304 Not Modified).
+
+    load_cache_entry() - given a URL, load its cache entry
+        (validators and last body) from disk
+
+    save_cache_entry() - given a URL, its validators and its body,
+        save a cache entry to disk
+
+    get_cache_key() - given a URL, return the file name (minus
+        extension) of its cache entry
+
+
+Constants:
+
+    HTTP_CACHE_DIR - directory where cached feeds are stored
+
+    HTTP_POOL_SIZE - max number of pooled connections per host
+
+    HTTP_CONNECT_TIMEOUT - timeout (seconds) for opening a connection
+
+    HTTP_READ_TIMEOUT - default timeout (seconds) for reading a response
+
+    HTTP_RETRIES - max number of retries for a failed request
+
+    HTTP_BACKOFF - base delay (seconds) for exponential backoff
+
+    HTTP_BACKOFF_MAX - max delay (seconds) between retries
+
+    HTTP_CHUNK_SIZE - size (bytes) of the chunks a response body is read in
+"""
+
+
+HTTP_CACHE_DIR = '/tmp/calendars/http_cache'
+HTTP_POOL_SIZE = 16
+HTTP_CONNECT_TIMEOUT = 10
+HTTP_READ_TIMEOUT = 30
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 1.0
+HTTP_BACKOFF_MAX = 30.0
+HTTP_CHUNK_SIZE = 64*1024
+
+_session = None
+_session_lock = threading.Lock()
+
+
+
+def get_session():
+    """
+    Get the shared requests.Session object.
+    The session is created once per process and
+    keeps connections to dcppc.groups.io alive
+    between requests (and between threads).
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=HTTP_POOL_SIZE,
+                    pool_maxsize=HTTP_POOL_SIZE
+            )
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers.update({
+                'Accept-Encoding' : 'gzip, deflate',
+            })
+            _session = session
+    return _session
+
+
+
+def get_with_retry(url, headers={}, timeout=None, retries=HTTP_RETRIES, deadline=None):
+    """
+    Do a GET request for url using the shared session.
+    Connection errors, timeouts and 5xx responses are
+    retried up to retries times, waiting a random time
+    between 0 and HTTP_BACKOFF * 2^attempt seconds
+    (capped at HTTP_BACKOFF_MAX) between tries.
+
+    If deadline (epoch seconds) is given, the whole
+    request, retries and backoff included, must be done
+    by then: the body is read in chunks, and a server
+    that is still sending (or a feed that keeps failing)
+    when the deadline passes is given up on.
+
+    Returns the last response. Raises a
+    requests.exceptions.RequestException if the
+    last try could not connect at all, or if the
+    deadline passed.
+    """
+    if timeout is None:
+        timeout = HTTP_READ_TIMEOUT
+    session = get_session()
+
+    attempt = 0
+    while True:
+        try:
+            r = session.get(url, headers=headers, stream=True,
+                    timeout=(HTTP_CONNECT_TIMEOUT, get_remaining_time(url, timeout, deadline)))
+            read_body(url, r, deadline)
+            if r.status_code < 500 or attempt >= retries:
+                return r
+            logging.info(" [-] Got status code %s from %s"%(r.status_code, url))
+        except requests.exceptions.RequestException:
+            if attempt >= retries or (deadline is not None and time.time() >= deadline):
+                raise
+            logging.info(" [-] Could not connect to %s"%(url))
+
+        delay = random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF*(2**attempt)))
+        if deadline is not None and time.time() + delay >= deadline:
+            err = "Out of time for %s, not retrying"%(url)
+            logging.info(" [-] "+err)
+            raise requests.exceptions.Timeout(err)
+        attempt += 1
+        logging.info("     Retrying in %0.1f seconds (retry %d of %d)"%(delay, attempt, retries))
+        time.sleep(delay)
+
+
+
+def get_remaining_time(url, timeout, deadline):
+    """
+    Return the read timeout for the next try:
+    timeout, or less if the deadline is closer.
+    Raises requests.exceptions.Timeout if the
+    deadline has passed.
+    """
+    if deadline is None:
+        return timeout
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise requests.exceptions.Timeout("Out of time for %s"%(url))
+    return min(timeout, remaining)
+
+
+
+def read_body(url, r, deadline):
+    """
+    Read the body of a streamed response in chunks,
+    giving up (and closing the connection) if the
+    deadline passes before the body is complete
+    """
+    if hasattr(r.raw, 'read1'):
+        # urllib3 2: return whatever has arrived, so
+        # a slow server can not hold us past the deadline
+        read_chunk = lambda: r.raw.read1(HTTP_CHUNK_SIZE, decode_content=True)
+    else:
+        read_chunk = lambda: r.raw.read(HTTP_CHUNK_SIZE, decode_content=True)
+    chunks = []
+    try:
+        while True:
+            chunk = read_chunk()
+            if not chunk:
+                break
+            chunks.append(chunk)
+            if deadline is not None and time.time() >= deadline:
+                raise requests.exceptions.Timeout("Out of time reading %s"%(url))
+    except (urllib3.exceptions.HTTPError, socket.error) as e:
+        raise requests.exceptions.ConnectionError(e)
+    finally:
+        r.close()
+    # The body is available as r.content, as without stream=True
+    r._content = b''.join(chunks)
+    r._content_consumed = True
+
+
+
+def get_cache_key(url):
+    """
+    Given a URL, return a key that is safe
+    to use as a file name for its cache entry
+    """
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+
+
+def load_cache_entry(url):
+    """
+    Given a URL, load its cache entry from disk.
+    Returns a dict with 'etag', 'last_modified'
+    and 'body' (bytes), or None if there is no
+    usable cache entry.
+    """
+    key = get_cache_key(url)
+    meta_file = os.path.join(HTTP_CACHE_DIR, key+'.json')
+    body_file = os.path.join(HTTP_CACHE_DIR, key+'.body')
+    try:
+        with open(meta_file,'r') as f:
+            entry = json.load(f)
+        with open(body_file,'rb') as f:
+            entry['body'] = f.read()
+    except (IOError, OSError, ValueError):
+        return None
+    if entry.get('url')!=url:
+        return None
+    return entry
+
+
+
+def save_cache_entry(url, etag, last_modified, body):
+    """
+    Given a URL, the validators returned by the server
+    and the body of the response, save a cache entry.
+    Files are written to a temporary name and renamed
+    into place so a crash never leaves a torn entry.
+
+    The entry is saved even without validators, as the
+    last good copy of the feed (see get_last_good_contents()).
+    """
+    os.makedirs(HTTP_CACHE_DIR, exist_ok=True)
+
+    key = get_cache_key(url)
+    meta_file = os.path.join(HTTP_CACHE_DIR, key+'.json')
+    body_file = os.path.join(HTTP_CACHE_DIR, key+'.body')
+
+    meta = {
+        'url' : url,
+        'etag' : etag,
+        'last_modified' : last_modified,
+    }
+    # Write the body first, so the metadata
+    # never points at a body we do not have
+    with open(body_file+'.tmp','wb') as f:
+        f.write(body)
+    os.rename(body_file+'.tmp', body_file)
+    with open(meta_file+'.tmp','w') as f:
+        json.dump(meta, f)
+    os.rename(meta_file+'.tmp', meta_file)
+
+
+
+def conditional_get(url, timeout=None, deadline=None):
+    """
+    Do a GET request for url, sending If-None-Match and
+    If-Modified-Since headers if we have a cached copy
+    (giving up once deadline passes, see get_with_retry()).
+
+    Returns a tuple (status_code, body):
+    - (200, body) if the server sent a new body,
+    - (304, body) if the cached body is still current,
+    - (status_code, body) for any other response.
+    """
+    entry = load_cache_entry(url)
+
+    headers = {}
+    if entry is not None:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+    r = get_with_retry(url, headers=headers, timeout=timeout, deadline=deadline)
+
+    if r.status_code==304 and entry is not None:
+        logging.info(" [+] Not modified, using cached copy")
+        return 304, entry['body']
+
+    if r.status_code==200:
+        try:
+            save_cache_entry(url,
+                    r.headers.get('ETag'),
+                    r.headers.get('Last-Modified'),
+                    r.content)
+        except (IOError, OSError):
+            logging.exception("Could not save cache entry for %s"%(url))
+
+    return r.status_code, r.content
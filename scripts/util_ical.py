@@ -1,7 +1,16 @@
 import logging
-from icalendar import Calendar, Event
+from icalendar import Calendar
 import re, os
 import requests
+import hashlib
+import time
+import datetime
+import json
+from collections import OrderedDict
+from calendar import timegm
+from concurrent.futures import ThreadPoolExecutor
+from util_http import *
+from util_publish import *
 
 
 """
@@ -17,32 +26,188 @@ Calendar Methods:
 
     export_ical_file() - export a Calendar() object to an .ics file
 
-    new_calendar_from_components_map() - use a map of component IDs to
-        calendar VEVENTS to create a new calendar
+    new_calendar_from_components_map() - use a map of safe event ids to
+        IcsEvent records to create a new Calendar() object
+
+    write_ics_file() - given a map of safe event ids to IcsEvent records,
+        stream them to an .ics file (written to a temporary file and
+        published with precompressed siblings if its contents changed)
+
+    publish_calendar_files() - given a map of safe event ids to IcsEvent
+        records, publish the integrated .ics file, the per-subgroup .ics
+        files and the month-by-month event index
+
+    write_ics_shards() - given a map of safe event ids to IcsEvent records,
+        write one .ics file per Groups.io subgroup
+
+    write_event_index() - given a map of safe event ids to IcsEvent records,
+        write an index of the events bucketed by month (JSON/NDJSON)
+
+    event_index_entry() - given an IcsEvent record, return its compact
+        entry in the event index
+
+    unescape_ics_text() - given an escaped .ics TEXT value, return the
+        plain text
+
+    remove_old_published_files() - remove published files that are
+        no longer needed
+
+    ics_lines_generator() - given a map of safe event ids to IcsEvent
+        records, generate the (folded) lines of an .ics file
+
+    ics_event_lines() - given an IcsEvent record, generate the
+        content lines of its VEVENT
+
+    fold_ics_line() - fold a content line to 75 octets per line
+
+    epoch_to_ics_utc() - convert epoch seconds to an .ics UTC date-time string
 
     ics_components_map() - given the contents of an .ics file as a string,
-        convert to a map of UIDs to VEVENT component objects
+        convert to a map of safe event ids to IcsEvent records
+        (optionally keeping only the events in the sync window)
+
+    ics_components_list() - given the contents of an .ics file as
+        a string, return a list of IcsEvent records
+        (cached on disk by content hash, as JSON)
+
+    load_parsed_events() - load a list of IcsEvent records from
+        the parsed event cache (None if there is no usable entry)
+
+    prune_parsed_cache() - remove old entries from the parsed event cache
 
     ics_components_generator() - given the contents of an .ics file as
-        a astring, generate/yield VEVENT component objects
+        a astring, generate/yield IcsEvent records
+        (using the fast parser, falling back to icalendar)
+
+    icalendar_components_generator() - given the contents of an .ics file
+        as a string, generate/yield IcsEvent records using icalendar
+
+    fast_components_generator() - given the contents of a Groups.io .ics
+        file as a string, stream its VEVENT blocks into IcsEvent records
+
+    unfold_ics_lines() - given the contents of an .ics file as a string,
+        generate unfolded content lines
+
+    parse_ics_line() - split an unfolded content line into its
+        name, parameters and value
 
     get_event_url() - given a VEVENT from Groups.io, extract the subgroup
         name and event ID and use them to assemble the Groups.io peramlink
 
+    make_event_url() - same as get_event_url(), but given the ORGANIZER
+        and UID of the event as strings (None if the ORGANIZER is not
+        a Groups.io subgroup)
+
+    get_event_subgroup() - given the ORGANIZER of a Groups.io event,
+        return the name of its subgroup (None if it is not a valid name)
+
+    htmlify_event_url() - given an IcsEvent record, return an HTML link
+        to the event on Groups.io
+
+    get_sync_window() - return the (start, end) of the rolling sync window
+        as epoch seconds, given how many days to look back and ahead
+
+    in_sync_window() - given the start and end of an event (epoch seconds),
+        check if the event overlaps the sync window
+
+    ics_utc_to_epoch() - convert an .ics UTC date-time string to epoch seconds
+
+    ical_dt_to_epoch() - convert an icalendar date/datetime to epoch seconds
+
     get_ical_contents() - given an ical file, load the contents as a string
 
+    read_ical_list() - given an ical list file, return its .ics URLs along
+        with their polling interval (if given)
+
     get_calendar_contents() - given a URL for an .ics file, return
         the contents of the .ics file as a string
 
+    get_last_good_contents() - given a URL for an .ics file, return
+        the last copy downloaded successfully (from the HTTP cache)
+
+    decode_calendar_contents() - decode the contents of an .ics file
+
+    get_all_calendar_contents() - given a list of URLs for .ics files,
+        download them all concurrently and return their contents
+        as a list of strings, in the same order as the URLs
+
+    parse_calendar_contents() - given the URL and contents of an .ics
+        feed, return a list of IcsEvent records (None if the feed
+        could not be fetched or parsed)
+
     get_safe_event_id() - Groups.io uses email addresses for their Event IDs,
         but Google calendar is more strict. This strips non-alphanumeric characters
         from Groups.io event IDs to make them safe for Google Calendar.
 
     vevent_decode() - Given a VEVENT component, convert it to ical format and decode
         the resulting binary string to unicode.
+
+
+Event Records:
+
+    IcsEvent - compact, immutable record of one calendar event
+        (uid, safe id, start/end as epoch seconds, summary, location,
+        sequence, organizer and Groups.io URL)
+
+
+Constants:
+
+    FETCH_WORKERS - max number of .ics feeds to download at once
+
+    FETCH_TIMEOUT - time budget (seconds) for downloading each .ics feed,
+        retries and backoff included
+
+    PARSED_CACHE_DIR - directory where parsed events are cached
+
+    PARSED_CACHE_MAX_AGE - remove parsed events unused for this long (seconds)
+
+    PARSED_CACHE_VERSION - version of the parsed event cache format, bump this
+        when IcsEvent (or which events are kept) changes, to ignore old caches
+
+    FAST_REQUIRED_KEYS - properties every VEVENT must have for the fast parser
+
+    SYNC_PAST_DAYS - the sync window starts this many days ago
+
+    SYNC_FUTURE_DAYS - the sync window ends this many days from now
+
+    ICS_PRODID - product identifier written to the integrated .ics file
+
+    SHARD_DIR - directory (next to the integrated .ics file) holding
+        the per-subgroup .ics files
+
+    SUBGROUP_ORGANIZER - pattern of the ORGANIZER of a Groups.io event
+
+    SUBGROUP_NAME - pattern of a valid subgroup name (also used as a file name)
+
+    INDEX_DIR - directory (next to the integrated .ics file) holding
+        the month-by-month event index
 """
 
 
+FETCH_WORKERS = 8
+FETCH_TIMEOUT = 2*HTTP_READ_TIMEOUT
+PARSED_CACHE_DIR = '/tmp/calendars/parsed_cache'
+PARSED_CACHE_MAX_AGE = 7*24*60*60
+
+PARSED_CACHE_VERSION = 4
+
+FAST_REQUIRED_KEYS = ['UID', 'DTSTART', 'DTEND', 'ORGANIZER']
+FAST_UTC_DATETIME = re.compile(r'^\d{8}T\d{6}Z$')
+FAST_NAME = re.compile(r'^[A-Z0-9-]+$')
+FAST_PARAM = re.compile(r';([A-Za-z0-9-]+)=("[^"]*"|[^";:]*)')
+
+ICS_PRODID = '//DCPPC//Google Calendar 70.9054//EN'
+SHARD_DIR = 'subgroups'
+SUBGROUP_ORGANIZER = re.compile(r'mailto:([^@]+)@dcppc\.groups\.io')
+SUBGROUP_NAME = re.compile(r'[A-Za-z0-9_-]+')
+ICS_TEXT_ESCAPES = {'n' : '\n', 'N' : '\n'}
+ICS_TEXT_ESCAPE = re.compile(r'\\(.)')
+INDEX_DIR = 'events'
+
+SYNC_PAST_DAYS = 30
+SYNC_FUTURE_DAYS = 365
+
+
 def export_ical_file(calendar,icsfile):
     """
     Given a Calendar() object,
@@ -56,64 +221,605 @@ def export_ical_file(calendar,icsfile):
 
 def new_calendar_from_components_map(short_description,components_map):
     """
-    Given a components map (UID -> VEVENT object),
+    Given a components map (safe event id -> IcsEvent),
     create a new Calendar() object populated with
-    all of the events in the components_map
+    all of the events in the components_map.
+
+    (To write the events to an .ics file, use
+    write_ics_file(), which does not need to hold
+    the whole Calendar() object in memory.)
+    """
+    prodid = '//%s//Google Calendar 70.9054//EN'%(short_description)
+    return Calendar.from_ical(''.join(ics_lines_generator(components_map, prodid)))
+
+
+
+def write_ics_file(components_map, ics_file, prodid=ICS_PRODID):
+    """
+    Given a components map (safe event id -> IcsEvent),
+    write the events to an .ics file at ics_file, one
+    VEVENT at a time. The file is written to a temporary
+    name and published with publish_file(): it is renamed
+    into place (so clients never see a partial file) along
+    with .gz/.br siblings, but only if its contents changed
+    (so its ETag and Last-Modified stay the same).
+    """
+    start = time.time()
+    write_published_file(ics_file, ics_lines_generator(components_map, prodid))
+    logging.info("Wrote %d events to %s in %0.3f seconds"%(
+        len(components_map), ics_file, time.time()-start))
+
+
+
+def publish_calendar_files(components_map, ics_file):
+    """
+    Publish the integrated calendar and everything
+    derived from it, next to ics_file:
+    - ics_file itself (see write_ics_file())
+    - one .ics file per subgroup, in subgroups/
+      (see write_ics_shards())
+    - an index of events bucketed by month, in events/
+      (see write_event_index())
+    """
+    publish_dir = os.path.dirname(os.path.abspath(ics_file))
+    write_ics_file(components_map, ics_file)
+    write_ics_shards(components_map, os.path.join(publish_dir, SHARD_DIR))
+    write_event_index(components_map, os.path.join(publish_dir, INDEX_DIR))
+
+
+
+def write_ics_shards(components_map, shard_dir):
+    """
+    Given a components map (safe event id -> IcsEvent),
+    write one .ics file per Groups.io subgroup to
+    shard_dir (e.g. subgroups/FSWG.ics), holding only
+    the events of that subgroup. Shards of subgroups
+    that no longer have events are removed.
+    """
+    shards = {}
+    for k, e in components_map.items():
+        subgroup = get_event_subgroup(e.organizer)
+        if subgroup is None:
+            continue
+        shards.setdefault(subgroup, {})[k] = e
+
+    for subgroup, shard in shards.items():
+        write_published_file(
+                os.path.join(shard_dir, '%s.ics'%(subgroup)),
+                ics_lines_generator(shard, '//DCPPC//%s//EN'%(subgroup))
+        )
+    remove_old_published_files(shard_dir, '.ics', ['%s.ics'%(s) for s in shards])
+    logging.info("Wrote %d subgroup .ics files to %s"%(len(shards), shard_dir))
+
+
+
+def write_event_index(components_map, index_dir):
+    """
+    Given a components map (safe event id -> IcsEvent),
+    write a compact index of the events for the web
+    front end to index_dir:
+
+    - one NDJSON file per month (e.g. 2018-10.ndjson),
+      holding one JSON object per line for each event
+      starting that month (UTC), sorted by start time
+    - index.json, listing the months (with their file,
+      number of events and content hash) and subgroups
+
+    Each file only changes when its own events change,
+    so each month can be cached on its own. Months that
+    no longer have events are removed.
+    """
+    buckets = {}
+    for e in components_map.values():
+        month = time.strftime('%Y-%m', time.gmtime(e.start))
+        buckets.setdefault(month, []).append(e)
+
+    months = OrderedDict()
+    for month in sorted(buckets.keys()):
+        events = sorted(buckets[month], key=lambda e: (e.start, e.safe_id))
+        bucket_file = os.path.join(index_dir, '%s.ndjson'%(month))
+        write_published_file(bucket_file, (
+            json.dumps(event_index_entry(e), sort_keys=True, separators=(',',':'))+'\n'
+            for e in events
+        ))
+        months[month] = {
+            'file' : '%s.ndjson'%(month),
+            'count' : len(events),
+            'sha1' : get_file_hash(bucket_file),
+        }
+    remove_old_published_files(index_dir, '.ndjson', [m['file'] for m in months.values()])
+
+    subgroups = sorted(set(get_event_subgroup(e.organizer) for e in components_map.values()) - set([None]))
+    index = {
+        'months' : months,
+        'subgroups' : OrderedDict((s, '%s/%s.ics'%(SHARD_DIR, s)) for s in subgroups),
+    }
+    write_published_file(os.path.join(index_dir, 'index.json'),
+            [json.dumps(index, separators=(',',':'))+'\n'])
+    logging.info("Wrote index of %d months to %s"%(len(months), index_dir))
+
+
+
+def event_index_entry(event):
     """
-    # Make a new calendar that compiles all events
-    newcal = Calendar()
-    newcal.add('prodid', '//%s//Google Calendar 70.9054//EN'%(short_description))
-    newcal.add('version', '2.0')
-    newcal.add('method','PUBLISH')
-    newcal.add('calscale','GREGORIAN')
+    Given an IcsEvent record, return the compact
+    JSON object (dict) describing it in the index
+    """
+    return {
+        'id' : event.safe_id,
+        'start' : event.start,
+        'end' : event.end,
+        'summary' : unescape_ics_text(event.summary),
+        'location' : unescape_ics_text(event.location),
+        'subgroup' : get_event_subgroup(event.organizer),
+        'url' : event.url,
+    }
 
-    for event in components_map:
-        e = Event()
-        
-        for k in component.keys():
-            v = component[k]
-            e.add(k,v)
-        newcal.add_component(e)
 
-    return newcal
 
+def unescape_ics_text(value):
+    """
+    Given an escaped .ics TEXT value (as kept in
+    IcsEvent records), return the plain text
+    """
+    return ICS_TEXT_ESCAPE.sub(lambda m: ICS_TEXT_ESCAPES.get(m.group(1), m.group(1)), value)
 
 
-def ics_components_map(ics, components_map={}):
+
+def remove_old_published_files(publish_dir, extension, keep):
+    """
+    Remove the published files (and their compressed
+    siblings) in publish_dir ending in extension,
+    except the ones named in keep
+    """
+    try:
+        names = os.listdir(publish_dir)
+    except (IOError, OSError):
+        return
+    keep = set(keep)
+    for name in names:
+        if name.endswith(extension) and name not in keep:
+            remove_published_file(os.path.join(publish_dir, name))
+
+
+
+def ics_lines_generator(components_map, prodid=ICS_PRODID):
+    """
+    Given a components map (safe event id -> IcsEvent),
+    generate the lines (folded, ending in CRLF) of an
+    .ics file holding all of the events.
+
+    Events are sorted by start time (then id), and the
+    DTSTAMP of each event is its DTSTART, so the output
+    only changes when the events change.
+    """
+    header = [
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        'PRODID:%s'%(prodid),
+        'CALSCALE:GREGORIAN',
+        'METHOD:PUBLISH',
+    ]
+    for line in header:
+        yield line+'\r\n'
+
+    event_ids = sorted(components_map.keys(),
+            key=lambda k: (components_map[k].start or 0, k))
+    for k in event_ids:
+        for line in ics_event_lines(components_map[k]):
+            yield fold_ics_line(line)+'\r\n'
+
+    yield 'END:VCALENDAR\r\n'
+
+
+
+def ics_event_lines(event):
+    """
+    Given an IcsEvent record, generate the content
+    lines (unfolded) of its VEVENT. Text values are
+    kept escaped in IcsEvent records, so they are
+    written as they are.
+    """
+    yield 'BEGIN:VEVENT'
+    yield 'UID:%s'%(event.uid)
+    yield 'DTSTAMP:%s'%(epoch_to_ics_utc(event.start))
+    yield 'DTSTART:%s'%(epoch_to_ics_utc(event.start))
+    yield 'DTEND:%s'%(epoch_to_ics_utc(event.end))
+    yield 'SEQUENCE:%d'%(event.sequence)
+    yield 'SUMMARY:%s'%(event.summary)
+    if event.location:
+        yield 'LOCATION:%s'%(event.location)
+    if event.organizer:
+        yield 'ORGANIZER:%s'%(event.organizer)
+    if event.url:
+        yield 'URL:%s'%(event.url)
+        yield 'DESCRIPTION:%s'%(event.url)
+    yield 'END:VEVENT'
+
+
+
+def fold_ics_line(line):
+    """
+    Fold a content line so that no line is longer
+    than 75 octets (continuation lines start with
+    a space), without splitting UTF-8 characters
+    """
+    if len(line.encode('utf-8'))<=75:
+        return line
+    folded = []
+    current = ''
+    current_len = 0
+    limit = 75
+    for c in line:
+        n = len(c.encode('utf-8'))
+        if current_len+n > limit:
+            folded.append(current)
+            current = ' '
+            current_len = 1
+        current += c
+        current_len += n
+    folded.append(current)
+    return '\r\n'.join(folded)
+
+
+
+def epoch_to_ics_utc(epoch):
+    """
+    Given UTC epoch seconds, return an .ics
+    UTC date-time string (e.g. 20180918T150000Z)
+    """
+    return time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(epoch))
+
+
+
+def ics_components_map(ics, components_map={}, window=None):
     """
     This function takes an input string containing
     the contents of an .ics file and converts it
-    into a map of uid to filtered Event() objects
-    (VEVENT components).
+    into a map of safe event ids to IcsEvent records.
+
+    If window is a (start, end) tuple (see get_sync_window()),
+    only events that overlap the window are kept.
     """
-    for e in ics_components_generator(ics):
-        components_map[get_safe_event_id(e['UID'])] = e
+    if ics is None:
+        # This feed could not be fetched, skip it
+        logging.warning("Skipping a feed that could not be fetched.")
+        return components_map
+    for e in ics_components_list(ics):
+        if in_sync_window(e.start, e.end, window):
+            components_map[e.safe_id] = e
     return components_map
 
 
 
+def ics_components_list(ics):
+    """
+    This function takes an input string containing
+    the contents of an .ics file and returns a list
+    of IcsEvent records.
+
+    Parsed events are cached on disk, keyed by a hash
+    of the .ics contents, so a feed that has not changed
+    since the last run (e.g., a 304 Not Modified) is
+    not parsed again.
+    """
+    digest = hashlib.sha1(ics.encode('utf-8')).hexdigest()
+    digest += '.v%d'%(PARSED_CACHE_VERSION)
+    parsed_file = os.path.join(PARSED_CACHE_DIR, digest+'.json')
+
+    events = load_parsed_events(parsed_file)
+    if events is not None:
+        # Mark this entry as recently used
+        try:
+            os.utime(parsed_file, None)
+        except (IOError, OSError):
+            pass
+        return events
+
+    events = list(ics_components_generator(ics))
+
+    try:
+        os.makedirs(PARSED_CACHE_DIR, mode=0o700, exist_ok=True)
+        with open(parsed_file+'.tmp','w') as f:
+            json.dump({
+                'version' : PARSED_CACHE_VERSION,
+                'events' : [e.astuple() for e in events],
+            }, f)
+        os.rename(parsed_file+'.tmp', parsed_file)
+        prune_parsed_cache()
+    except (IOError, OSError):
+        logging.exception("Could not save parsed events to cache")
+
+    return events
+
+
+
+def load_parsed_events(parsed_file):
+    """
+    Load a list of IcsEvent records cached by
+    ics_components_list() (JSON: the version of
+    the cache format, and a list of field tuples).
+    Returns None if there is no usable cache file.
+    """
+    try:
+        with open(parsed_file,'r') as f:
+            cached = json.load(f)
+        if cached.get('version')!=PARSED_CACHE_VERSION:
+            return None
+        events = []
+        for fields in cached['events']:
+            if len(fields)!=len(IcsEvent.__slots__):
+                return None
+            for k, v in zip(IcsEvent.__slots__, fields):
+                expected = int if k in ['start', 'end', 'sequence'] else str
+                if not (isinstance(v, expected) or (v is None and expected is str)):
+                    return None
+            events.append(IcsEvent(*fields))
+        return events
+    except (IOError, OSError, ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+
+
+def prune_parsed_cache(max_age=PARSED_CACHE_MAX_AGE):
+    """
+    Remove parsed event caches that have not been
+    used in the last max_age seconds
+    """
+    cutoff = time.time() - max_age
+    for fname in os.listdir(PARSED_CACHE_DIR):
+        path = os.path.join(PARSED_CACHE_DIR, fname)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except (IOError, OSError):
+            pass
+
+
+
 def ics_components_generator(ics):
     """
     This function takes an input string 
     containing an .ics file and converts it
-    into a stream of filtered Event() objects
-    (VEVENT components).
+    into a stream of IcsEvent records.
+
+    Groups.io feeds are handled by the fast parser
+    (fast_components_generator). If the feed contains
+    anything the fast parser does not expect, the
+    whole feed is parsed with icalendar instead.
+    """
+    try:
+        events = list(fast_components_generator(ics))
+    except FastParseException as e:
+        logging.info("Fast parser could not handle feed (%s), using icalendar"%(e))
+        events = icalendar_components_generator(ics)
+    for e in events:
+        yield e
+
+
+
+def icalendar_components_generator(ics):
+    """
+    This function takes an input string 
+    containing an .ics file and converts it
+    into a stream of IcsEvent records, using
+    icalendar. This handles time zones, all-day
+    events and durations.
     """
     cal = Calendar.from_ical(ics)
     for component in cal.walk():
         if component.name=='VEVENT':
-            # Custom processing (extraction):
-            event_url = get_event_url(component)
+            start = ical_dt_to_epoch(component['DTSTART'].dt)
+            if 'DTEND' in component:
+                end = ical_dt_to_epoch(component['DTEND'].dt)
+            elif 'DURATION' in component:
+                end = start + int(component['DURATION'].dt.total_seconds())
+            else:
+                end = start
+
+            def get(k):
+                if k in component:
+                    return vevent_decode(component[k])
+                return ''
+
+            uid = get('UID')
+            organizer = get('ORGANIZER')
+            url = make_event_url(organizer, uid)
+            if url is None:
+                logging.warning("Skipping event %s, its organizer is not a Groups.io subgroup: %s"%(uid, organizer))
+                continue
+            yield IcsEvent(
+                    uid,
+                    get_safe_event_id(uid),
+                    start,
+                    end,
+                    get('SUMMARY'),
+                    get('LOCATION'),
+                    int(get('SEQUENCE') or 0),
+                    organizer,
+                    url
+            )
+
 
-            e = Event()
-            for k in component.keys():
-                if k=='DESCRIPTION':
-                    v = event_url
-                else:
-                    v = component[k]
-                e.add(k,v)
 
-            yield e
+def fast_components_generator(ics):
+    """
+    This function takes an input string containing
+    an .ics file from Groups.io and streams its
+    VEVENT blocks straight into IcsEvent records,
+    without building an icalendar Calendar() object.
+
+    Lines are unfolded and property parameters are
+    parsed. Only VEVENT blocks are inspected; any
+    content line inside a VEVENT that does not fit
+    the simple shape of a Groups.io event raises
+    a FastParseException.
+    """
+    props = None
+    for line in unfold_ics_lines(ics):
+        if props is None:
+            if line=='BEGIN:VEVENT':
+                props = {}
+            continue
+
+        if line=='END:VEVENT':
+            for key in FAST_REQUIRED_KEYS:
+                if key not in props:
+                    raise FastParseException("VEVENT is missing %s"%(key))
+            uid = props['UID']
+            organizer = props['ORGANIZER']
+            url = make_event_url(organizer, uid)
+            if url is None:
+                logging.warning("Skipping event %s, its organizer is not a Groups.io subgroup: %s"%(uid, organizer))
+                props = None
+                continue
+            try:
+                sequence = int(props.get('SEQUENCE') or 0)
+            except ValueError:
+                raise FastParseException("Bad SEQUENCE %s"%(props['SEQUENCE']))
+            yield IcsEvent(
+                    uid,
+                    get_safe_event_id(uid),
+                    ics_utc_to_epoch(props['DTSTART']),
+                    ics_utc_to_epoch(props['DTEND']),
+                    props.get('SUMMARY',''),
+                    props.get('LOCATION',''),
+                    sequence,
+                    organizer,
+                    url
+            )
+            props = None
+            continue
+
+        # Property values are kept raw (unfolded, still escaped),
+        # which is the same text vevent_decode() returns for the
+        # icalendar version of the event. Parameters (e.g. the CN
+        # of the ORGANIZER) are parsed and checked, but not kept.
+        name, params, value = parse_ics_line(line)
+        if name in ['BEGIN', 'END']:
+            raise FastParseException("Unexpected %s:%s in VEVENT"%(name, value))
+        if name in props:
+            raise FastParseException("Repeated property %s in VEVENT"%(name))
+        if name in ['DTSTART', 'DTEND']:
+            if params or not FAST_UTC_DATETIME.match(value):
+                raise FastParseException("Unexpected %s format %s"%(name, line))
+        props[name] = value
+
+    if props is not None:
+        raise FastParseException("VEVENT was never closed")
+
+
+
+def unfold_ics_lines(ics):
+    """
+    Given the contents of an .ics file as a string,
+    generate its content lines, joining folded lines
+    (lines that start with a space or a tab continue
+    the previous line).
+    """
+    current = None
+    for line in ics.lstrip('\ufeff').splitlines():
+        if line[:1] in [' ', '\t']:
+            if current is None:
+                raise FastParseException("Folded line with nothing to unfold")
+            current += line[1:]
+        else:
+            if current:
+                yield current
+            current = line
+    if current:
+        yield current
+
+
+
+def parse_ics_line(line):
+    """
+    Given an unfolded content line, return a tuple
+    (name, params, value), where params is a dict
+    of parameter names to parameter values.
+    Quoted parameter values may contain ; : and ,
+    """
+    if '"' in line:
+        in_quotes = False
+        for i, c in enumerate(line):
+            if c=='"':
+                in_quotes = not in_quotes
+            elif c==':' and not in_quotes:
+                break
+        else:
+            raise FastParseException("No value in line %s"%(line))
+        head, value = line[:i], line[i+1:]
+    else:
+        head, sep, value = line.partition(':')
+        if sep=='':
+            raise FastParseException("No value in line %s"%(line))
+
+    name, sep, rest = head.partition(';')
+    name = name.upper()
+    if not FAST_NAME.match(name):
+        raise FastParseException("Bad property name in line %s"%(line))
+
+    params = {}
+    if sep:
+        matched = 0
+        for m in FAST_PARAM.finditer(';'+rest):
+            params[m.group(1).upper()] = m.group(2).strip('"')
+            matched += len(m.group(0))
+        if matched!=len(rest)+1:
+            raise FastParseException("Bad parameters in line %s"%(line))
+
+    return name, params, value
+
+
+
+class FastParseException(Exception):
+    pass
+
+
+
+class IcsEvent(object):
+    """
+    A compact, immutable record of one calendar event.
+
+    uid         - the iCalendar UID
+    safe_id     - the UID with non-alphanumeric characters removed
+                  (used as the Google Calendar event id)
+    start, end  - start and end times, as UTC epoch seconds
+    summary     - event title
+    location    - event location
+    sequence    - iCalendar SEQUENCE (revision number), as an int
+    organizer   - organizer address (mailto:...)
+    url         - permalink to the event on Groups.io
+    """
+    __slots__ = ('uid', 'safe_id', 'start', 'end', 'summary',
+                 'location', 'sequence', 'organizer', 'url')
+
+    def __init__(self, uid, safe_id, start, end, summary,
+                 location, sequence, organizer, url):
+        for k, v in zip(self.__slots__, (uid, safe_id, start, end, summary,
+                                         location, sequence, organizer, url)):
+            object.__setattr__(self, k, v)
+
+    def __setattr__(self, k, v):
+        raise AttributeError("IcsEvent is immutable")
+
+    def __delattr__(self, k):
+        raise AttributeError("IcsEvent is immutable")
+
+    def astuple(self):
+        return tuple(getattr(self, k) for k in self.__slots__)
+
+    def __eq__(self, other):
+        return isinstance(other, IcsEvent) and self.astuple()==other.astuple()
+
+    def __ne__(self, other):
+        return not self==other
+
+    def __hash__(self):
+        return hash(self.astuple())
+
+    def __repr__(self):
+        return 'IcsEvent(%s)'%(', '.join('%s=%r'%(k, getattr(self, k)) for k in self.__slots__))
 
 
 
@@ -129,14 +835,25 @@ def get_event_url(vevent):
         logging.error(err)
         raise Exception(err)
 
+    return make_event_url(vevent['ORGANIZER'], vevent['UID'])
+
+
+
+def make_event_url(organizer, uid):
+    """
+    Given the ORGANIZER and UID of a Groups.io event,
+    extract the subgroup name and event ID and use
+    them to assemble the Groups.io permalink.
+    Returns None if the organizer is not a
+    Groups.io subgroup.
+    """
     # Get subgroup name from organizer
-    z = vevent['ORGANIZER']
-    r = re.search(r'mailto:(.*)@dcppc.groups.io',z)
-    subgroup = r.group(1)
+    subgroup = get_event_subgroup(organizer)
+    if subgroup is None:
+        return None
 
     # Get event id from UID
-    u = vevent['UID']
-    p = u.split('@')[0]
+    p = uid.split('@')[0]
     event_id = p.split('.')[-1]
 
     # Assemble these into a URL
@@ -146,21 +863,101 @@ def get_event_url(vevent):
 
 
 
+def get_event_subgroup(organizer):
+    """
+    Given the ORGANIZER of a Groups.io event
+    (e.g. mailto:FSWG@dcppc.groups.io), return
+    the name of its subgroup (e.g. FSWG).
+    Returns None if the organizer is not a Groups.io
+    subgroup, or if the name has characters other than
+    letters, digits, _ and - (the name is used as a
+    file name for the subgroup .ics files).
+    """
+    r = SUBGROUP_ORGANIZER.search(organizer)
+    if r is None or not SUBGROUP_NAME.fullmatch(r.group(1)):
+        return None
+    return r.group(1)
+
+
+
+def get_sync_window(past_days=SYNC_PAST_DAYS, future_days=SYNC_FUTURE_DAYS, now=None):
+    """
+    Return the rolling sync window as a tuple
+    (start, end) of epoch seconds: from past_days
+    days ago to future_days days from now.
+    Either bound can be None (no bound).
+    """
+    if now is None:
+        now = int(time.time())
+    start = None
+    end = None
+    if past_days is not None:
+        start = now - past_days*24*60*60
+    if future_days is not None:
+        end = now + future_days*24*60*60
+    return (start, end)
+
+
+
+def in_sync_window(start, end, window):
+    """
+    Given the start and end of an event as epoch
+    seconds, check if the event overlaps the sync
+    window. This uses the same rule as the timeMin
+    and timeMax parameters of the Google Calendar
+    API (the event ends after the window starts, and
+    starts before the window ends), so both sides
+    of the diff agree on which events are in the window.
+    """
+    if window is None or start is None:
+        return True
+    if end is None:
+        end = start
+    window_start, window_end = window
+    if window_start is not None and end <= window_start:
+        return False
+    if window_end is not None and start >= window_end:
+        return False
+    return True
+
+
+
+def ics_utc_to_epoch(value):
+    """
+    Given a UTC date-time value from an .ics file
+    (e.g. 20180918T150000Z), return UTC epoch seconds
+    """
+    return timegm((
+        int(value[0:4]), int(value[4:6]), int(value[6:8]),
+        int(value[9:11]), int(value[11:13]), int(value[13:15]),
+        0, 0, 0
+    ))
+
+
 
-def htmlify_event_url(vevent):
+def ical_dt_to_epoch(dt):
+    """
+    Given a date or datetime from icalendar,
+    return UTC epoch seconds. Naive datetimes
+    and dates are assumed to be in UTC.
     """
-    Given a VEVENT object, create a permalink to it
+    if isinstance(dt, datetime.datetime):
+        if dt.tzinfo is None:
+            return timegm(dt.timetuple())
+        return timegm(dt.utctimetuple())
+    return timegm(dt.timetuple())
+
+
+
+
+def htmlify_event_url(event):
+    """
+    Given an IcsEvent record, create a permalink to it
     on groups.io and return a string of the form:
 
     <a href="...groupsiolink...">...groupsiolink...</a>
     """
-    if vevent.name != 'VEVENT':
-        err = 'Error: htmlify_event_url() was called on something that is not a VEVENT!\n'
-        err += 'Check the calling script and try again.'
-        logging.error(err)
-        raise Exception(err)
-
-    event_url = get_event_url(vevent)
+    event_url = event.url
 
     html = '<a href="%s">%s</a>'%(event_url,event_url)
 
@@ -181,37 +978,148 @@ def get_ical_contents(ics_file):
 
 
 
-def get_calendar_contents(ics_url):
+def read_ical_list(ical_list):
+    """
+    Given the name of a file with one .ics URL per line,
+    return a list of tuples (url, interval), in order.
+
+    A line may give a polling interval (in seconds) for
+    its feed after the URL, e.g.:
+
+        https://dcppc.groups.io/g/main/ics/2242649/1234987694/feed.ics 600
+
+    interval is None if the line does not give one.
+    Blank lines and lines starting with # are skipped.
+    """
+    feeds = []
+    with open(ical_list,'r') as f:
+        for line in f:
+            tokens = line.split()
+            if len(tokens)==0 or tokens[0].startswith('#'):
+                continue
+            interval = None
+            if len(tokens)>1:
+                try:
+                    interval = int(tokens[1])
+                except ValueError:
+                    err = "ERROR: Bad polling interval for feed %s in %s: %s"%(tokens[0], ical_list, tokens[1])
+                    logging.error(err)
+                    raise Exception(err)
+            feeds.append((tokens[0], interval))
+    return feeds
+
+
+
+def get_calendar_contents(ics_url, timeout=FETCH_TIMEOUT):
     """
     This takes a URL for an .ics calendar file
     and returns the .ics file contents as a string
+    (or None if it could not be downloaded within
+    timeout seconds, retries included)
+
+    If the download fails, the last good copy of
+    the feed (from the HTTP cache) is returned instead,
+    so a temporary outage does not make the events of
+    the feed disappear. None is returned only if there
+    is no such copy.
     """
     url = ics_url.strip()
     logging.info("Extracting contents of calendar at URL %s"%(url))
-    r = requests.get(url)
+    try:
+        status_code, content = conditional_get(url, deadline=time.time()+timeout)
+    except requests.exceptions.RequestException:
+        logging.info(" [-] FAILED, could not fetch %s"%(url))
+        return get_last_good_contents(url)
 
-    if r.status_code==200:
+    if status_code in [200, 304]:
     
         # If the request went okay,
         # - get the content of the ics file
+        #   (304 means our cached copy is current)
         # - decode it
         # - add it to the list
-        content = r.content
-        try:
-            result = content.decode('utf-8')
-            logging.info(" [+] Success!")
-            return result
-
-        except UnicodeDecodeError:
-            result = content.decode('ISO-8859-1')
-            logging.info(" [+] Success!")
-            return result
+        logging.info(" [+] Success!")
+        return decode_calendar_contents(content)
     else:
-        logging.info(" [-] FAILED with status code %s"%(r.status_code))
-        logging.info(r.content.decode('utf-8'))
+        logging.info(" [-] FAILED with status code %s"%(status_code))
+        logging.info(content.decode('utf-8', 'replace'))
+        return get_last_good_contents(url)
+
+
+
+def get_last_good_contents(url):
+    """
+    Return the last copy of the .ics file at url that
+    was downloaded successfully (from the HTTP cache),
+    or None if there is none
+    """
+    entry = load_cache_entry(url)
+    if entry is None:
+        logging.warning("No earlier copy of %s, its events will be missing"%(url))
         return None
+    logging.warning("Using the last good copy of %s"%(url))
+    return decode_calendar_contents(entry['body'])
+
 
 
+def decode_calendar_contents(content):
+    """
+    Decode the contents of an .ics file (bytes)
+    """
+    try:
+        return content.decode('utf-8')
+    except UnicodeDecodeError:
+        return content.decode('ISO-8859-1')
+
+
+
+def get_all_calendar_contents(ics_urls, max_workers=FETCH_WORKERS, timeout=FETCH_TIMEOUT):
+    """
+    This takes a list of URLs for .ics calendar files
+    and downloads them concurrently using a bounded
+    thread pool. Each feed gets its own time budget
+    (timeout seconds, retries included), so the whole
+    download takes about as long as the slowest feed.
+
+    Returns a list of .ics file contents (strings, or
+    None for feeds that failed), in the same order as
+    ics_urls, so that merging the results is deterministic.
+    """
+    urls = [u.strip() for u in ics_urls if u.strip()!='']
+    if len(urls)==0:
+        return []
+
+    n_workers = max(1, min(max_workers, len(urls)))
+    logging.info("Fetching %d calendars with %d workers"%(len(urls),n_workers))
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        # map() preserves the input order
+        results = list(executor.map(
+            lambda url: get_calendar_contents(url, timeout=timeout),
+            urls
+        ))
+    return results
+
+
+
+def parse_calendar_contents(url, contents):
+    """
+    Given the URL of an .ics feed and its contents
+    (as returned by get_calendar_contents()), return
+    a list of IcsEvent records.
+
+    Returns None if the feed could not be fetched
+    (contents is None) or could not be parsed, so a
+    broken feed is skipped like a failed download
+    instead of stopping the whole run.
+    """
+    if contents is None:
+        return None
+    try:
+        return ics_components_list(contents)
+    except Exception:
+        logging.exception("Could not parse the feed at %s, skipping it"%(url))
+        return None
+
 
 
 def get_safe_event_id(event_id):
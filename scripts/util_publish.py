@@ -0,0 +1,189 @@
+import logging
+import hashlib
+import gzip
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+"""
+Publishing Utilities
+
+
+Description:
+
+    This file contains utility methods for publishing
+    static files (e.g., the integrated .ics feed) to the
+    htdocs directory served by nginx.
+
+    Each published file gets precompressed siblings
+    (file.gz, and file.br if the brotli module is
+    installed) for nginx gzip_static/brotli_static.
+
+    nginx derives the ETag and Last-Modified of a static
+    file from its modification time and size, so a file
+    is only replaced when the hash of its contents changed.
+    Otherwise it keeps its modification time, and clients
+    polling it get 304 Not Modified.
+
+
+Publish Methods:
+
+    publish_file() - given a temporary file with the new contents
+        of a published file, write its compressed siblings and then
+        move it into place (if its contents changed)
+
+    write_compressed_siblings() - given the new contents of a published
+        file, write its .gz (and .br) siblings, with the same
+        modification time
+
+    remove_file() - remove a file, if it exists
+
+    write_published_file() - given a file name and an iterable of lines,
+        write the lines to a temporary file and publish it
+
+    remove_published_file() - remove a published file and its siblings
+
+    get_file_hash() - given a file name, return the hash of its
+        contents (or None if there is no such file)
+
+
+Constants:
+
+    GZIP_LEVEL - compression level for .gz siblings
+
+    BROTLI_QUALITY - compression quality for .br siblings
+"""
+
+
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+
+
+
+def publish_file(tmp_file, target_file):
+    """
+    Given a temporary file holding the new contents
+    of target_file, write its compressed siblings, then
+    rename it into place, unless the contents did not
+    change (then the temporary file is removed, and
+    target_file and its siblings are left alone).
+
+    The siblings go first so that nginx never serves
+    the old compressed contents next to the new file
+    for longer than it takes to rename it. If anything
+    fails, the temporary file is removed.
+
+    Returns True if target_file was replaced.
+    """
+    new_hash = get_file_hash(tmp_file)
+    siblings = [target_file+'.gz']
+    if brotli is not None:
+        siblings.append(target_file+'.br')
+    if new_hash==get_file_hash(target_file) and all(os.path.exists(s) for s in siblings):
+        os.remove(tmp_file)
+        logging.info("No changes to %s"%(target_file))
+        return False
+
+    try:
+        write_compressed_siblings(tmp_file, target_file)
+        os.rename(tmp_file, target_file)
+    except Exception:
+        remove_file(tmp_file)
+        raise
+    logging.info("Published %s (sha1 %s)"%(target_file, new_hash))
+    return True
+
+
+
+def write_compressed_siblings(source_file, target_file):
+    """
+    Given a file holding the new contents of a published
+    file (source_file, e.g. the temporary file that is
+    about to become target_file), write target_file.gz
+    (and target_file.br, if brotli is installed).
+    Siblings are written to temporary names and renamed
+    into place, and get the modification time of
+    source_file (kept when it is renamed to target_file),
+    so all variants have the same Last-Modified.
+    """
+    with open(source_file,'rb') as f:
+        data = f.read()
+    st = os.stat(source_file)
+
+    siblings = []
+    # mtime=0 keeps the .gz file the same for the same contents
+    siblings.append((target_file+'.gz', gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)))
+    if brotli is not None:
+        siblings.append((target_file+'.br', brotli.compress(data, quality=BROTLI_QUALITY)))
+
+    for sibling, compressed in siblings:
+        try:
+            with open(sibling+'.tmp','wb') as f:
+                f.write(compressed)
+            os.utime(sibling+'.tmp', (st.st_atime, st.st_mtime))
+            os.rename(sibling+'.tmp', sibling)
+        except Exception:
+            remove_file(sibling+'.tmp')
+            raise
+
+
+
+def write_published_file(target_file, lines):
+    """
+    Given a file name and an iterable of lines (strings,
+    with their line endings), write the lines one at a
+    time to a temporary file, then publish it with
+    publish_file(). Returns True if target_file was replaced.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(target_file)), exist_ok=True)
+    tmp_file = target_file+'.tmp'
+    try:
+        with open(tmp_file,'w',encoding='utf-8',newline='') as f:
+            for line in lines:
+                f.write(line)
+    except Exception:
+        remove_file(tmp_file)
+        raise
+    return publish_file(tmp_file, target_file)
+
+
+
+def remove_published_file(target_file):
+    """
+    Remove a published file and its compressed siblings
+    (siblings first, so nginx never serves them alone)
+    """
+    for name in [target_file+'.gz', target_file+'.br', target_file]:
+        remove_file(name)
+    logging.info("Removed %s"%(target_file))
+
+
+
+def remove_file(file_name):
+    """
+    Remove file_name, if it exists
+    """
+    try:
+        os.remove(file_name)
+    except (IOError, OSError):
+        pass
+
+
+
+def get_file_hash(file_name):
+    """
+    Return the sha1 hash of the contents of file_name,
+    or None if the file does not exist
+    """
+    h = hashlib.sha1()
+    try:
+        with open(file_name,'rb') as f:
+            for chunk in iter(lambda: f.read(1<<16), b''):
+                h.update(chunk)
+    except (IOError, OSError):
+        return None
+    return h.hexdigest()
@@ -0,0 +1,129 @@
+import logging
+import threading
+import time
+
+
+"""
+Rate Limiting Utilities
+
+
+Description:
+
+    This file contains the rate limiter shared by every
+    thread that sends requests to the Google Calendar API.
+
+
+Classes:
+
+    AdaptiveRateLimiter - a token bucket whose rate adapts to
+        the responses we get (AIMD): the rate goes up a little
+        with every successful request, and is cut in half when
+        Google tells us we are over quota. It also keeps counters
+        of throttled, retried and dropped requests.
+
+
+Constants:
+
+    RATE_INCREASE - how much the rate (requests per second) goes up
+        for every second of successful requests
+
+    RATE_DECREASE - factor the rate is multiplied by when throttled
+
+    RATE_DECREASE_INTERVAL - only cut the rate once per interval (seconds),
+        so a batch full of rate limit errors only counts once
+"""
+
+
+RATE_INCREASE = 0.1
+RATE_DECREASE = 0.5
+RATE_DECREASE_INTERVAL = 1.0
+
+
+
+class AdaptiveRateLimiter(object):
+    """
+    A token bucket shared by all worker threads.
+
+    Tokens are added at rate tokens per second (starting at
+    rate, and kept between min_rate and max_rate), up to burst
+    tokens. acquire(n) takes n tokens, sleeping until they are
+    available. success(n) and throttled() adjust the rate.
+
+    counters holds the number of requests, throttled requests
+    (rate limit errors), retried requests and dropped requests
+    (requests that still failed after every retry).
+    """
+    def __init__(self, rate, burst, min_rate=None, max_rate=None):
+        self.rate = float(rate)
+        self.min_rate = float(min_rate if min_rate is not None else rate/10.0)
+        self.max_rate = float(max_rate if max_rate is not None else rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.last = time.time()
+        self.last_decrease = 0
+        self.lock = threading.Lock()
+        self.counters = {
+            'requests' : 0,
+            'throttled' : 0,
+            'retried' : 0,
+            'dropped' : 0,
+        }
+
+    def acquire(self, n=1):
+        """
+        Take n tokens, sleeping until they are available
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now-self.last)*self.rate)
+            self.last = now
+            # Take the tokens now (possibly going into debt),
+            # then wait outside the lock until the debt is paid
+            self.tokens -= n
+            self.counters['requests'] += n
+            wait = -self.tokens/self.rate if self.tokens<0 else 0
+        if wait>0:
+            time.sleep(wait)
+
+    def success(self, n=1):
+        """
+        n requests succeeded: additive increase
+        """
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + RATE_INCREASE*n/self.rate)
+
+    def throttled(self):
+        """
+        Google said we are over quota: multiplicative decrease
+        """
+        with self.lock:
+            self.counters['throttled'] += 1
+            now = time.time()
+            if now - self.last_decrease < RATE_DECREASE_INTERVAL:
+                return
+            self.last_decrease = now
+            self.rate = max(self.min_rate, self.rate*RATE_DECREASE)
+            # Do not let saved-up tokens undo the decrease
+            self.tokens = min(self.tokens, 0)
+            logging.info("Throttled by Google, slowing down to %0.2f requests per second"%(self.rate))
+
+    def count(self, name, n=1):
+        """
+        Add n to one of the counters
+        """
+        with self.lock:
+            self.counters[name] += n
+
+    def reset_counters(self):
+        with self.lock:
+            for k in self.counters:
+                self.counters[k] = 0
+
+    def log_counters(self):
+        logging.info("API requests: %d sent, %d throttled, %d retried, %d dropped (rate %0.2f/s)"%(
+            self.counters['requests'],
+            self.counters['throttled'],
+            self.counters['retried'],
+            self.counters['dropped'],
+            self.rate
+        ))
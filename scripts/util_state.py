@@ -0,0 +1,283 @@
+import logging
+import hashlib
+import sqlite3
+import json
+import time
+import os
+
+
+"""
+Local State Utilities
+
+
+Description:
+
+    This file contains utility methods for keeping
+    state on local disk between runs (e.g., the local
+    mirror of the Google Calendar and its sync token,
+    and the fingerprints of events we have synced),
+    and the journal of changes being pushed to Google.
+
+    Everything stored here can be rebuilt from Google
+    Calendar and the .ics feeds, so losing the state
+    directory only costs one slow run.
+
+
+State Methods:
+
+    get_state_file() - given a state name and a key (e.g. a calendar id),
+        return the path of the file holding that state
+
+    load_state() - given a state name and a key, load the state from
+        disk (returns None if there is no state)
+
+    save_state() - given a state name, a key and a JSON-serializable
+        object, save the state to disk (atomically)
+
+    clear_state() - given a state name and a key, remove the state
+
+
+Fingerprint Methods:
+
+    open_state_db() - open (and create, if needed) the sqlite database
+        holding the fingerprints of synced events
+
+    load_fingerprints() - given a calendar id, return a map of event ids
+        to the fingerprint of each event as of its last successful write
+
+    save_fingerprints() - given a calendar id and a list of fingerprints,
+        insert or replace them in the database
+
+    delete_fingerprints() - given a calendar id and a list of event ids,
+        remove their fingerprints from the database
+
+
+Journal Methods:
+
+    start_journal() - given a calendar id and a list of planned operations,
+        record them all in the journal (replacing any older journal)
+
+    load_journal() - given a calendar id, return the operations in the
+        journal that are not done yet
+
+    finish_journal_ops() - given a calendar id and a list of journal
+        sequence numbers, mark those operations as done
+
+    clear_journal() - given a calendar id, remove its journal
+
+
+Constants:
+
+    STATE_DIR - directory where local state is stored
+
+    STATE_DB - sqlite database holding the fingerprints of synced events
+        and the journal
+"""
+
+
+STATE_DIR = '/tmp/calendars/state'
+STATE_DB = os.path.join(STATE_DIR, 'calendars.sqlite')
+
+FINGERPRINT_COLUMNS = ['event_id', 'uid', 'sequence', 'content_hash', 'etag']
+
+
+
+def get_state_file(name, key):
+    """
+    Given a state name (e.g. 'gcal_mirror') and a key
+    (e.g. a calendar id), return the path of the file
+    holding that state
+    """
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return os.path.join(STATE_DIR, '%s_%s.json'%(name, digest))
+
+
+
+def load_state(name, key):
+    """
+    Load the state with the given name and key.
+    Returns None if there is no state, or if the
+    state file can't be read.
+    """
+    state_file = get_state_file(name, key)
+    try:
+        with open(state_file,'r') as f:
+            return json.load(f)
+    except (IOError, OSError):
+        return None
+    except ValueError:
+        logging.warning("Ignoring corrupt state file %s"%(state_file))
+        return None
+
+
+
+def save_state(name, key, state):
+    """
+    Save the state with the given name and key.
+    The state is written to a temporary file and
+    renamed into place, so a crash never leaves
+    a torn state file.
+    """
+    os.makedirs(STATE_DIR, exist_ok=True)
+    state_file = get_state_file(name, key)
+    with open(state_file+'.tmp','w') as f:
+        json.dump(state, f)
+    os.rename(state_file+'.tmp', state_file)
+
+
+
+def clear_state(name, key):
+    """
+    Remove the state with the given name and key
+    """
+    try:
+        os.remove(get_state_file(name, key))
+    except (IOError, OSError):
+        pass
+
+
+
+def open_state_db(db_file=None):
+    """
+    Open the sqlite database holding the fingerprints
+    of synced events and the journal, creating it if needed.
+    Returns a sqlite3 connection.
+    """
+    if db_file is None:
+        db_file = STATE_DB
+    os.makedirs(os.path.dirname(db_file), exist_ok=True)
+    conn = sqlite3.connect(db_file)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS fingerprints (
+            calendar_id  TEXT NOT NULL,
+            event_id     TEXT NOT NULL,
+            uid          TEXT,
+            sequence     INTEGER,
+            content_hash TEXT,
+            etag         TEXT,
+            updated      REAL,
+            PRIMARY KEY (calendar_id, event_id)
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS journal (
+            calendar_id  TEXT NOT NULL,
+            seq          INTEGER NOT NULL,
+            op           TEXT NOT NULL,
+            event_id     TEXT,
+            payload      TEXT,
+            done         INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (calendar_id, seq)
+        )
+    """)
+    conn.commit()
+    return conn
+
+
+
+def load_fingerprints(conn, calendar_id):
+    """
+    Given a calendar id, return a map of event ids
+    to fingerprints (dicts with keys event_id, uid,
+    sequence, content_hash and etag), as of the last
+    successful write of each event to Google Calendar.
+    """
+    cursor = conn.execute(
+            "SELECT %s FROM fingerprints WHERE calendar_id=?"%(", ".join(FINGERPRINT_COLUMNS)),
+            (calendar_id,)
+    )
+    fingerprints = {}
+    for row in cursor:
+        fp = dict(zip(FINGERPRINT_COLUMNS, row))
+        fingerprints[fp['event_id']] = fp
+    return fingerprints
+
+
+
+def save_fingerprints(conn, calendar_id, fingerprints):
+    """
+    Given a calendar id and a list of fingerprints
+    (dicts with keys event_id, uid, sequence,
+    content_hash and etag), insert or replace them
+    """
+    now = time.time()
+    rows = [
+        (calendar_id,) + tuple(fp[k] for k in FINGERPRINT_COLUMNS) + (now,)
+        for fp in fingerprints
+    ]
+    conn.executemany(
+            "INSERT OR REPLACE INTO fingerprints "
+            "(calendar_id, %s, updated) VALUES (?, ?, ?, ?, ?, ?, ?)"%(", ".join(FINGERPRINT_COLUMNS)),
+            rows
+    )
+    conn.commit()
+
+
+
+def delete_fingerprints(conn, calendar_id, event_ids):
+    """
+    Given a calendar id and a list of event ids,
+    remove their fingerprints
+    """
+    conn.executemany(
+            "DELETE FROM fingerprints WHERE calendar_id=? AND event_id=?",
+            [(calendar_id, eid) for eid in event_ids]
+    )
+    conn.commit()
+
+
+
+def start_journal(conn, calendar_id, ops):
+    """
+    Given a calendar id and a list of planned operations
+    (tuples of op name, event id and a JSON-serializable
+    payload), record them in the journal, in order.
+    Any older journal for this calendar is replaced.
+    Everything is written in a single transaction, so
+    the journal is either complete or not there at all.
+    """
+    with conn:
+        conn.execute("DELETE FROM journal WHERE calendar_id=?", (calendar_id,))
+        conn.executemany(
+                "INSERT INTO journal (calendar_id, seq, op, event_id, payload, done) "
+                "VALUES (?, ?, ?, ?, ?, 0)",
+                [(calendar_id, seq, op, event_id, json.dumps(payload))
+                    for seq, (op, event_id, payload) in enumerate(ops)]
+        )
+
+
+
+def load_journal(conn, calendar_id):
+    """
+    Given a calendar id, return the operations in its
+    journal that are not done yet, in order, as a list
+    of tuples (seq, op name, event id, payload)
+    """
+    cursor = conn.execute(
+            "SELECT seq, op, event_id, payload FROM journal "
+            "WHERE calendar_id=? AND done=0 ORDER BY seq",
+            (calendar_id,)
+    )
+    return [(seq, op, event_id, json.loads(payload)) for seq, op, event_id, payload in cursor]
+
+
+
+def finish_journal_ops(conn, calendar_id, seqs):
+    """
+    Given a calendar id and a list of journal
+    sequence numbers, mark those operations as done
+    """
+    with conn:
+        conn.executemany(
+                "UPDATE journal SET done=1 WHERE calendar_id=? AND seq=?",
+                [(calendar_id, seq) for seq in seqs]
+        )
+
+
+
+def clear_journal(conn, calendar_id):
+    """
+    Given a calendar id, remove its journal
+    """
+    with conn:
+        conn.execute("DELETE FROM journal WHERE calendar_id=?", (calendar_id,))
@@ -0,0 +1,128 @@
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, unquote
+
+
+"""
+Webhook Utilities
+
+
+Description:
+
+    This file contains a small HTTP server that receives
+    notifications and passes them on to a running SyncDaemon
+    (see util_daemon.py), so a change is synced right away
+    instead of waiting for the next polling cycle.
+
+    Two kinds of notifications are accepted (POST):
+
+    /gcal - a Google Calendar push notification (events.watch).
+        The X-Goog-Channel-ID and X-Goog-Channel-Token headers must
+        match the channel opened by the daemon (403 if it did not
+        open one). Triggers an (incremental) sync of the calendar.
+
+    /feed/<subgroup> - the .ics feed of one Groups.io subgroup changed.
+        Triggers a fetch of that feed only (no more than once every
+        DAEMON_MIN_INTERVAL seconds), and a sync if it changed.
+
+
+Classes:
+
+    WebhookServer - threaded HTTP server
+
+    WebhookHandler - handles the notifications (one per request)
+
+
+Webhook Methods:
+
+    start_webhook_server() - start the webhook server in a background
+        thread, passing notifications to the given SyncDaemon
+
+
+Constants:
+
+    WEBHOOK_HOST - address the webhook server listens on (local only,
+        put it behind nginx to receive notifications from Google)
+
+    WEBHOOK_PORT - default port the webhook server listens on
+"""
+
+
+WEBHOOK_HOST = '127.0.0.1'
+WEBHOOK_PORT = 8901
+
+
+
+class WebhookServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """
+    Handle one notification POSTed to the webhook server.
+    The SyncDaemon to notify is self.server.sync_daemon.
+    """
+    def do_POST(self):
+        path = urlparse(self.path).path
+        if path=='/gcal':
+            self.handle_gcal()
+        elif path.startswith('/feed/'):
+            self.handle_feed(unquote(path[len('/feed/'):]))
+        else:
+            self.respond(404)
+
+    def handle_gcal(self):
+        sync_daemon = self.server.sync_daemon
+        channel = sync_daemon.channel
+        if channel is None \
+                or self.headers.get('X-Goog-Channel-ID')!=channel['id'] \
+                or self.headers.get('X-Goog-Channel-Token')!=channel['token']:
+            logging.warning("Ignoring push notification for an unknown channel")
+            self.respond(403)
+            return
+
+        state = self.headers.get('X-Goog-Resource-State')
+        if state=='sync':
+            # Sent once, when the channel is opened
+            logging.info("Push channel is open")
+        else:
+            logging.info("Push notification (%s), syncing the calendar"%(state))
+            sync_daemon.request_sync()
+        self.respond(200)
+
+    def handle_feed(self, subgroup):
+        sync_daemon = self.server.sync_daemon
+        n_feeds = sync_daemon.request_feed(subgroup)
+        if n_feeds==0:
+            logging.warning("Feed notification for unknown subgroup %s"%(subgroup))
+            self.respond(404)
+            return
+        logging.info("Feed notification for subgroup %s, fetching %d feeds"%(subgroup, n_feeds))
+        self.respond(200)
+
+    def respond(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logging.info("Webhook: "+format%args)
+
+
+
+def start_webhook_server(sync_daemon, port=WEBHOOK_PORT, host=WEBHOOK_HOST):
+    """
+    Start the webhook server on host:port in a background
+    thread. Notifications are passed to sync_daemon.
+    Returns the server (call shutdown() to stop it).
+    """
+    server = WebhookServer((host, port), WebhookHandler)
+    server.sync_daemon = sync_daemon
+    thread = threading.Thread(target=server.serve_forever, name='webhook')
+    thread.daemon = True
+    thread.start()
+    logging.info("Webhook server listening on %s:%d"%(host, port))
+    return server